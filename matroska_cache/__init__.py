@@ -1,11 +1,20 @@
-__version__ = __import__('pkg_resources').get_distribution('matroska_cache').version
-
-
 from .cache import MatroskaCache
 from .exc import NotInCache
 from . import dep
 
-try:
-    from .sa_tools import sa_dependencies, sa_modified_names
-except ImportError:
-    pass
+
+def __getattr__(name: str):
+    """ Lazy attributes: slow and optional imports are only done when actually used """
+    # The version: from package metadata
+    if name == '__version__':
+        try:
+            from importlib.metadata import version
+        except ImportError:  # Python 3.7
+            from importlib_metadata import version
+        return version('matroska_cache')
+    # SqlAlchemy tools: ImportError if SqlAlchemy is not installed
+    elif name in ('sa_dependencies', 'sa_modified_names', 'sa_bulk_dependencies'):
+        from . import sa_tools
+        return getattr(sa_tools, name)
+    else:
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
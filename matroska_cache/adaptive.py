@@ -0,0 +1,183 @@
+""" Adaptive TTLs: learn how long entries actually live before they're invalidated
+
+`expires=` is often a guess. Entries whose dependencies rarely change are recomputed on schedule, too often;
+entries that are invalidated within seconds have no use for a long TTL.
+
+The adaptive TTL policy watches a sample of entries, grouped by key pattern ('article-*'), and learns,
+for every pattern, the rate at which its entries are invalidated.
+Every put() then gets a TTL that outlives `coverage` of the entries' natural lifetimes: it's the invalidations that
+remove entries, not expiration. The TTL is always within [min_ttl, max_ttl].
+
+Example:
+    cache.adaptive_ttl = AdaptiveTTL(redis, prefix='cache', min_ttl=60, max_ttl=86400)
+
+    cache.put('article-1', ..., expires=600)  # `expires` is used until enough has been learned
+
+The math: lifetimes are assumed to be exponentially distributed, and some of them are cut short by expiration
+(censored). The maximum-likelihood estimate of the invalidation rate is then
+
+    rate = invalidations / exposure
+
+where `exposure` is the total time sampled entries have spent in cache: until invalidated, or until expired.
+The TTL that outlives a fraction `coverage` of lifetimes is `-ln(1 - coverage) / rate`.
+
+Statistics are stored in Redis, one small hash per pattern: all workers learn together.
+Every worker reads them at most once per `refresh_interval`.
+"""
+import math
+import random
+import re
+import time
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from redis import Redis
+
+
+class AdaptiveTTL:
+    """ Pick TTLs by observed invalidation rates """
+
+    def __init__(self, redis: Redis, *,
+                 prefix: str,
+                 min_ttl: int = 60,
+                 max_ttl: int = 86400,
+                 coverage: float = 0.9,
+                 pattern: Callable[[str], Optional[str]] = None,
+                 sample_rate: float = 0.1,
+                 min_samples: int = 20,
+                 max_samples: int = 10000,
+                 refresh_interval: float = 60.0,
+                 ):
+        """
+        Args:
+            redis: Redis client to store statistics in
+            prefix: Prefix for the keys. Use the same one as the backend's.
+            min_ttl: The shortest TTL to give, seconds
+            max_ttl: The longest TTL to give, seconds
+            coverage: The fraction of entries that should be invalidated before they expire
+            pattern: Get the pattern of a key; None to opt the key out. Default: replace numbers with '*'
+            sample_rate: The fraction of put()s to observe
+            min_samples: Use the learned TTL after that many sampled put()s. Until then, use `expires`.
+            max_samples: Halve the statistics when there are more samples than that: recent behavior matters more
+            refresh_interval: Re-read the statistics from Redis every that many seconds
+        """
+        self.redis = redis
+        self.prefix = prefix
+        self.min_ttl = min_ttl
+        self.max_ttl = max_ttl
+        self.coverage = coverage
+        self.pattern = pattern or default_pattern
+        self.sample_rate = sample_rate
+        self.min_samples = min_samples
+        self.max_samples = max_samples
+        self.refresh_interval = refresh_interval
+
+        # { pattern => (learned TTL or None, when it was read) }
+        self._learned: Dict[str, Tuple[Optional[int], float]] = {}
+
+    def ttl_for(self, key: str, default: int) -> int:
+        """ Get the TTL for a key
+
+        Args:
+            key: The cache key
+            default: The TTL to use if nothing has been learned about this key yet
+        """
+        pattern = self.pattern(key)
+        if pattern is None:
+            return default
+
+        # Learned, recently?
+        learned = self._learned.get(pattern)
+        if learned is None or learned[1] + self.refresh_interval < time.monotonic():
+            learned = self._learned[pattern] = (self._learn(pattern), time.monotonic())
+
+        ttl = learned[0]
+        return default if ttl is None else ttl
+
+    def record_put(self, key: str, expires: int):
+        """ Observe a put(): maybe """
+        if random.random() >= self.sample_rate:
+            return
+        pattern = self.pattern(key)
+        if pattern is None:
+            return
+
+        # Remember when it was born, and count the time it will spend in cache if it's never invalidated
+        with self.redis.pipeline(transaction=False) as p:
+            p.setex(self._key('born', key), expires, f'{time.time()}:{expires}')
+            p.hincrby(self._key('ttl', pattern), 'puts', 1)
+            p.hincrbyfloat(self._key('ttl', pattern), 'exposure', expires)
+            p.execute()
+
+    def record_invalidated(self, keys: Iterable[str], *, limit: int = 100):
+        """ Observe invalidated keys: the sampled ones have died
+
+        Args:
+            keys: Invalidated keys
+            limit: Only check that many keys: this is statistics, after all
+        """
+        keys = [key for key in keys if self.pattern(key) is not None][:limit]
+        if not keys:
+            return
+
+        # Find out which ones were sampled: one round-trip
+        with self.redis.pipeline(transaction=False) as p:
+            for key in keys:
+                p.get(self._key('born', key))
+                p.delete(self._key('born', key))
+            born = p.execute()[0::2]
+
+        # Count the invalidations. The time they did not spend in cache is taken off the exposure
+        now = time.time()
+        with self.redis.pipeline(transaction=False) as p:
+            for key, value in zip(keys, born):
+                if value is None:
+                    continue
+                born_at, expires = value.split(':')
+                age = min(now - float(born_at), float(expires))
+                p.hincrby(self._key('ttl', self.pattern(key)), 'invalidations', 1)
+                p.hincrbyfloat(self._key('ttl', self.pattern(key)), 'exposure', age - float(expires))
+            p.execute()
+
+    def stats(self, pattern: str) -> Dict[str, float]:
+        """ Get the statistics for a pattern: 'puts', 'invalidations', 'exposure' """
+        values = self.redis.hmget(self._key('ttl', pattern), STATS_FIELDS)
+        return {field: float(value or 0) for field, value in zip(STATS_FIELDS, values)}
+
+    def _learn(self, pattern: str) -> Optional[int]:
+        """ Compute the TTL for a pattern from the statistics in Redis. None if not enough data """
+        stats = self.stats(pattern)
+
+        # Forget the past, gradually
+        # NOTE: not atomic; increments made in between may be lost. That's fine for statistics.
+        if stats['puts'] > self.max_samples:
+            self.redis.hset(self._key('ttl', pattern), mapping={field: value / 2 for field, value in stats.items()})
+
+        ttl = compute_ttl(stats, coverage=self.coverage, min_samples=self.min_samples)
+        if ttl is None:
+            return None
+        return int(min(max(ttl, self.min_ttl), self.max_ttl))
+
+    def _key(self, type: str, name: str) -> str:
+        return f'{self.prefix}::{type}::{name}'
+
+
+def compute_ttl(stats: Dict[str, float], *, coverage: float, min_samples: int) -> Optional[float]:
+    """ Compute the TTL that outlives `coverage` of lifetimes; None if not enough data. Can be infinite """
+    if stats['puts'] < min_samples or stats['exposure'] <= 0:
+        return None
+
+    rate = stats['invalidations'] / stats['exposure']
+    if rate <= 0:
+        return math.inf
+    return -math.log(1 - coverage) / rate
+
+
+def default_pattern(key: str) -> str:
+    """ Replace numbers with '*': 'article-1' -> 'article-*' """
+    return _NUMBERS.sub('*', key)
+
+
+_NUMBERS = re.compile(r'\d+')
+
+# Fields of the statistics hash
+STATS_FIELDS: List[str] = ['puts', 'invalidations', 'exposure']
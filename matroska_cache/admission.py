@@ -0,0 +1,123 @@
+""" Admission policy: decide whether an entry is worth caching at all
+
+Cheap-to-compute entries that nobody reads again crowd out the expensive ones,
+and drive up Redis memory and the size of the dependency sets.
+
+An admission policy looks at three things:
+
+* cost: how long it took to compute the entry (you measure it and give it to put())
+* size: how many bytes it takes
+* reuse: how often the key is requested, tracked with a compact frequency sketch
+
+and computes the score: seconds of compute saved per KB of cache memory:
+
+    score = cost * (1 + frequency) / size_kb
+
+Entries with a score below `reject_below` are not stored; those below `cap_below` are stored with a shorter TTL.
+
+Example:
+    cache.admission = AdmissionPolicy(reject_below=0.001, cap_below=0.01, capped_expires=30)
+
+    started = time.perf_counter()
+    data = load_articles()
+    cache.put('articles-list', data, ..., expires=600, cost=time.perf_counter() - started)
+"""
+import json
+import threading
+from dataclasses import dataclass
+from typing import Any, Callable, List, Optional
+
+from .sketch import CountMinSketch
+
+
+@dataclass
+class AdmissionDecision:
+    """ The decision made for a put() """
+    key: str
+    # Store it or not
+    admit: bool
+    # The TTL to use (possibly capped)
+    expires: int
+    # The computed score; None if the cost was unknown
+    score: Optional[float]
+    # Estimated number of recent requests for this key
+    frequency: int
+    # The compute cost (seconds), and the payload size (bytes)
+    cost: Optional[float]
+    size: int
+    # Short description of the decision: 'admit', 'reject', 'cap', 'unknown-cost'
+    reason: str
+
+    __slots__ = 'key', 'admit', 'expires', 'score', 'frequency', 'cost', 'size', 'reason'
+
+
+AdmissionHook = Callable[[AdmissionDecision], None]
+
+
+class AdmissionPolicy:
+    """ Cost-aware admission for MatroskaCache.put() """
+
+    def __init__(self, *,
+                 reject_below: float = None,
+                 cap_below: float = None,
+                 capped_expires: int = 60,
+                 sketch: CountMinSketch = None,
+                 hooks: List[AdmissionHook] = (),
+                 ):
+        """ Init the policy
+
+        Args:
+            reject_below: Do not store entries with a score below this. Default: store everything
+            cap_below: Cap the TTL of entries with a score below this. Default: never cap
+            capped_expires: The TTL for capped entries, seconds
+            sketch: Frequency sketch to track key popularity with
+            hooks: Functions to report every decision to. Use them for metrics.
+        """
+        self.reject_below = reject_below
+        self.cap_below = cap_below
+        self.capped_expires = capped_expires
+        self.sketch = sketch or CountMinSketch()
+        # The sketch is not thread-safe, and every request thread counts accesses
+        self._lock = threading.Lock()
+        self.hooks: List[AdmissionHook] = list(hooks)
+
+    def record_access(self, key: str):
+        """ Count a request for `key`: both hits and misses are demand """
+        with self._lock:
+            self.sketch.add(key)
+
+    def decide(self, key: str, data: Any, *, cost: Optional[float], expires: int, size: int = None) -> AdmissionDecision:
+        """ Decide whether `data` is worth caching
+
+        Args:
+            size: The payload size, when known: saves serializing `data` once again
+        """
+        if size is None:
+            size = payload_size(data)
+        with self._lock:
+            frequency = self.sketch.estimate(key)
+
+        # Unknown cost: nothing to decide upon
+        if cost is None:
+            decision = AdmissionDecision(key, True, expires, None, frequency, cost, size, 'unknown-cost')
+        else:
+            score = cost * (1 + frequency) / max(size / 1024, 1/1024)
+
+            if self.reject_below is not None and score < self.reject_below:
+                decision = AdmissionDecision(key, False, expires, score, frequency, cost, size, 'reject')
+            elif self.cap_below is not None and score < self.cap_below and expires > self.capped_expires:
+                decision = AdmissionDecision(key, True, self.capped_expires, score, frequency, cost, size, 'cap')
+            else:
+                decision = AdmissionDecision(key, True, expires, score, frequency, cost, size, 'admit')
+
+        for hook in self.hooks:
+            hook(decision)
+        return decision
+
+
+def payload_size(data: Any) -> int:
+    """ Estimate the size of the payload, in bytes, the way the backend would serialize it """
+    if isinstance(data, str):
+        return len(data)
+    else:
+        return len(json.dumps(data))
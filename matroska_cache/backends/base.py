@@ -32,27 +32,51 @@ Example invalidate:
 """
 
 from abc import ABC, abstractmethod
-from typing import Any, Iterable
+from dataclasses import dataclass
+from typing import Any, Iterable, List, Dict, Optional
 
 from matroska_cache.dep.base import DependencyBase
 from matroska_cache.exc import NotInCache  # noqa
 
 
+@dataclass
+class PutToken:
+    """ Dependency versions captured by begin(), before the data was computed """
+    # { dependency key => version }. None: never invalidated (or forgotten)
+    versions: Dict[str, Optional[str]]
+
+    __slots__ = 'versions',
+
+
 class MatroskaCacheBackendBase(ABC):
     log_enabled: bool = False
 
     @abstractmethod
-    def put(self, data: Any, key: str, *, expires: int, dependencies: Iterable[DependencyBase]):
+    def put(self, data: Any, key: str, *, expires: int, dependencies: Iterable[DependencyBase], token: PutToken = None,
+            max_lifetime: int = None) -> bool:
         """ Put `data` into cache, keyed by `key`, depending on `dependencies`
 
         Args:
-            data: The data to put into cache
+            data: The data to put into cache. MatroskaCache gives `Serialized` data: serialize() returns it as is.
             key: The key under which caching is done. Has to be unique.
             dependencies: The list of objects that the data in cache depends on.
                 If any of those dependencies becomes invalid, this piece of data will be invalidated as well.
             expires: The number of seconds the data will expire in
+            token: The token from begin(). If any of its dependencies has been invalidated since, refuse to store.
+            max_lifetime: Sliding expiration: extend the TTL on every read, but keep the data no longer than that.
+                Backends that don't support it raise NotImplementedError.
+        Returns:
+            Whether the data was stored
         """
 
+    def begin(self, dependencies: Iterable[DependencyBase]) -> PutToken:
+        """ Capture dependency versions before computing the data to put()
+
+        Raises:
+            NotImplementedError: the backend does not support it
+        """
+        raise NotImplementedError(f'{type(self).__name__} does not support put() tokens')
+
     @abstractmethod
     def get(self, key: str) -> Any:
         """ Get a piece of cached data, if still available
@@ -65,14 +89,42 @@ class MatroskaCacheBackendBase(ABC):
             NotInCache: no data found
         """
 
+    def get_many(self, keys: Iterable[str]) -> Dict[str, Any]:
+        """ Get many pieces of cached data at once
+
+        Backends should override it to do it in one round-trip.
+
+        Returns:
+            { key => data } for the keys that are available. Missing keys are omitted.
+        """
+        ret = {}
+        for key in keys:
+            try:
+                ret[key] = self.get(key)
+            except NotInCache:
+                pass
+        return ret
+
     @abstractmethod
     def has(self, key: str) -> bool:
         """ See whether the cache has `key` stored in it """
 
     @abstractmethod
-    def delete(self, key: str):
-        """ Remove cached data by key """
+    def delete(self, key: str) -> List[str]:
+        """ Remove cached data by key
+
+        Entries that depend on it through `CacheKey` are invalidated as well.
+
+        Returns:
+            The list of cache keys invalidated through it: not including `key` itself
+        """
 
     @abstractmethod
-    def invalidate(self, dependencies: Iterable[DependencyBase]):
-        """ Invalidate all cache records with `dependency` as their dependency """
+    def invalidate(self, dependencies: Iterable[DependencyBase]) -> List[str]:
+        """ Invalidate all cache records with `dependency` as their dependency
+
+        Invalidation cascades: entries that depend on invalidated entries through `CacheKey` are invalidated as well.
+
+        Returns:
+            The list of cache keys that have been invalidated
+        """
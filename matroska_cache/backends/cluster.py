@@ -0,0 +1,47 @@
+""" Redis Cluster helpers: hash slots """
+from typing import Dict, Iterable, List
+
+# Redis Cluster has 16384 hash slots
+CLUSTER_SLOTS = 16384
+
+
+def key_slot(key: str) -> int:
+    """ Get the Redis Cluster hash slot for `key`
+
+    Implements the `{hash tag}` rule: if the key contains a non-empty "{...}", only that part is hashed.
+    """
+    start = key.find('{')
+    if start != -1:
+        end = key.find('}', start + 1)
+        if end > start + 1:
+            key = key[start + 1:end]
+    return crc16(key.encode()) % CLUSTER_SLOTS
+
+
+def group_by_slot(keys: Iterable[str]) -> Dict[int, List[str]]:
+    """ Group keys by their hash slot: keys within one group can be used in one multi-key command """
+    groups: Dict[int, List[str]] = {}
+    for key in keys:
+        groups.setdefault(key_slot(key), []).append(key)
+    return groups
+
+
+def crc16(data: bytes) -> int:
+    """ CRC16-CCITT (XMODEM), as used by Redis Cluster """
+    crc = 0
+    for byte in data:
+        crc = ((crc << 8) & 0xFFFF) ^ _CRC16_TABLE[((crc >> 8) ^ byte) & 0xFF]
+    return crc
+
+
+def _crc16_table() -> List[int]:
+    table = []
+    for i in range(256):
+        crc = i << 8
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x1021) if crc & 0x8000 else (crc << 1)
+        table.append(crc & 0xFFFF)
+    return table
+
+
+_CRC16_TABLE = _crc16_table()
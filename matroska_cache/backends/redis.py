@@ -1,73 +1,328 @@
 import itertools
-import json
 import logging
-from typing import Any, Iterable, List
+from collections import Counter
+import random
+import time
+import zlib
+from typing import Any, Iterable, List, Set, Sequence, Dict, Optional, Callable, Tuple
 
 from redis import Redis, WatchError
 
-from .base import MatroskaCacheBackendBase, DependencyBase, NotInCache
+from .base import MatroskaCacheBackendBase, DependencyBase, NotInCache, PutToken
+from .cluster import group_by_slot
+from .serialization import serialize, unserialize
+from ..dep.cache_key import CacheKey
 
 logger = logging.getLogger(__name__)
 
 
 class RedisBackend(MatroskaCacheBackendBase):
-    def __init__(self, redis: Redis, *, prefix: str):
+    def __init__(self, redis: Redis, *, prefix: str, cluster: bool = False,
+                 replicas: Sequence[Redis] = (),
+                 read_policy: str = 'round-robin',
+                 read_your_invalidations: Optional[float] = None,
+                 wait_replicas: Optional[int] = None,
+                 wait_timeout: int = 100,
+                 race_protection: bool = False,
+                 version_ttl: int = 3600,
+                 sliding_expiration: bool = False,
+                 small_values: int = 0,
+                 small_buckets: int = 1024,
+                 small_hexpire: bool = False,
+                 small_sweep_every: int = 100,
+                 ):
         """ Init the Redis backend for the matroska cache
 
+        Redis Cluster: multi-key transactions fail with CROSSSLOT, because keys live in different slots. Two options:
+        * Small cache: use a hash tag prefix, e.g. prefix='{cache}'. All keys go into one slot (one node), transactions work.
+        * Large cache: use `cluster=True`. No cross-slot commands are used; see `_cluster_invalidate()`.
+
+        Read replicas: get(), get_many(), has() go to `replicas`; writes and invalidations go to the primary, `redis`.
+        Because replicas lag, an entry that has just been invalidated may still be readable from a replica.
+        To read your own invalidations, use:
+        * `read_your_invalidations`: for that many seconds after an invalidate(), read from the primary
+        * `wait_replicas`: after an invalidate(), WAIT until that many replicas have it. If they don't
+          within `wait_timeout`, fall back to `read_your_invalidations`
+
+        Race protection: a worker reads from the DB; another one changes the DB and invalidates; the first one put()s stale data.
+        With `race_protection`, every invalidate() bumps the version of every dependency, and begin() captures those versions.
+        A put() with the token refuses to store the data if any of the versions has changed.
+
+        Sliding expiration: with `sliding_expiration`, put(max_lifetime=) entries get their TTL extended when read.
+        Reads fetch the TTL in the same round-trip (GET + PTTL). When less than half of `expires` remains,
+        the TTL is extended back to `expires` (but not beyond `max_lifetime`): at most one EXPIRE per half-window per key,
+        no matter how hot the key is. Dependency keys are given the full `max_lifetime` on put(), so they're never extended.
+        NOTE: all processes have to use the same `sliding_expiration`: sliding entries are stored with a header.
+
+        Small values: every top-level Redis key costs some 50-70 bytes of overhead; for values under 200 bytes,
+        that's more than the payload. With `small_values`, values up to that many bytes (serialized) are stored as fields
+        of `small_buckets` hashes instead, picked by key digest: "small::<n>" = { key => "<deadline>:<data>" }.
+        Small hashes use the compact listpack encoding: set `hash-max-listpack-value` (`hash-max-ziplist-value` before
+        Redis 7.0) above `small_values`, and keep `small_buckets` at about (number of small entries / 100).
+        Hash fields don't expire: every field has its deadline stored, and expired fields are never returned.
+        They're removed by sweeps: every `small_sweep_every` put()s sweep one bucket; sweep_small_values() sweeps them all.
+        With `small_hexpire`, fields are also given a TTL with HEXPIRE (requires Redis 7.4+): no sweeping needed.
+        Reads fetch both locations in one round-trip (GET + HGET). Sliding entries always get a key of their own.
+        NOTE: all processes have to use the same `small_values` settings. Not supported in cluster mode.
+
         Args:
-            redis: Redis client
+            redis: Redis client. With `cluster=True`, a Redis Cluster client.
             prefix: Prefix string for our cache keys
+            cluster: Redis Cluster mode. Requires Redis 7.0+ (EXPIRE NX/GT),
+                and a cluster client: `redis.cluster.RedisCluster` from redis-py 4.1+
+            replicas: Redis clients for read replicas
+            read_policy: How to pick a replica: 'round-robin', 'random'
+            read_your_invalidations: The number of seconds to read from the primary after an invalidate()
+            wait_replicas: The number of replicas to WAIT for after an invalidate()
+            wait_timeout: WAIT timeout, milliseconds
+            race_protection: Track dependency versions for begin() and put(token=)
+            version_ttl: Remember dependency versions for that many seconds.
+                Must be longer than it takes to compute your data. Tokens older than that are refused.
+            sliding_expiration: Support put(max_lifetime=). Every read then also fetches the TTL.
+            small_values: Store values up to that many bytes in hash buckets. 0: disabled
+            small_buckets: The number of hash buckets for small values
+            small_hexpire: Expire small values with HEXPIRE. Requires Redis 7.4+
+            small_sweep_every: Sweep expired small values from a bucket once per that many put()s
         """
         self.redis = redis
         self.prefix = prefix
+        self.cluster = cluster
+
+        # Counters: 'watch_retries': WATCH conflicts that were retried, 'watch_giveups': operations given up after too many conflicts,
+        # 'sliding_extensions': TTLs extended on read, 'small_swept': expired small values removed
+        self.stats = Counter()
+
+        # Read replicas
+        self.replicas = list(replicas)
+        self._replicas_cycle = itertools.cycle(self.replicas)
+        self._read_policy = read_policy
+        self._read_your_invalidations = read_your_invalidations
+        self._wait_replicas = wait_replicas
+        self._wait_timeout = wait_timeout
+        self._read_primary_until = 0.0
+        if read_policy not in ('round-robin', 'random'):
+            raise ValueError(f'Unknown read policy: {read_policy!r}')
+
+        # Race protection
+        self.race_protection = race_protection
+        self._version_ttl = version_ttl
+
+        # Sliding expiration
+        self.sliding_expiration = sliding_expiration
+
+        # Small values
+        self.small_values = small_values
+        self._small_buckets = small_buckets
+        self._small_hexpire = small_hexpire
+        self._small_sweep_every = small_sweep_every
+        self._small_puts = 0
+        if small_values and cluster:
+            raise ValueError('small_values is not supported in cluster mode')
 
     def get(self, key: str) -> Any:
         # Get the data; fail if the key does not exist
-        data = self.redis.get(self._key('data', key))
+        data_key = self._key('data', key)
+        if self.sliding_expiration or self.small_values:
+            data, = self._read(self._reader(), [data_key])
+        else:
+            data = self._reader().get(data_key)
         if data is None:
             raise NotInCache(key)
 
         # Unserialize
         return unserialize(data)
 
-    def has(self, key: str) -> bool:
-        return self.redis.exists(self._key('data', key)) == 1
+    def get_many(self, keys: Iterable[str]) -> Dict[str, Any]:
+        keys = list(keys)
+        if not keys:
+            return {}
 
-    def delete(self, key: str):
-        self.redis.unlink(self._key('data', key))
+        # Load: one round-trip
+        data_keys = [self._key('data', key) for key in keys]
+        values = self._read(self._reader(), data_keys)
+
+        # Unserialize
+        return {key: unserialize(data)
+                for key, data in zip(keys, values)
+                if data is not None}
 
-    def put(self, key: str, data: Any, dependencies: Iterable[DependencyBase], expires: int):
+    def has(self, key: str) -> bool:
         data_key = self._key('data', key)
+        if not self.small_values:
+            return self._reader().exists(data_key) == 1
+
+        with self._reader().pipeline(transaction=False) as p:
+            p.exists(data_key)
+            p.hget(*self._small_location(data_key))
+            exists, small_value = p.execute()
+        return exists == 1 or (small_value is not None and _unpack_small(small_value, time.time()) is not None)
 
-        # Store the dependency information
-        self._remember_dependencies_for(data_key, dependencies, expires)
+    def delete(self, key: str) -> List[str]:
+        data_key = self._key('data', key)
+        dependency = CacheKey(key)
+        with self.redis.pipeline(transaction=False) as p:
+            p.unlink(data_key)
+            if self.small_values:
+                p.hdel(*self._small_location(data_key))
+            p.exists(dependency.prefixed_key(self._key('rdep', '')))
+            has_dependents = p.execute()[-1]
+
+        # Nested entries depend on it. Most entries have none: then, skip the invalidation transaction.
+        # Race protection has to bump the version anyway: somebody may be computing a nested entry right now
+        if not has_dependents and not self.race_protection:
+            return []
+        return self.invalidate([dependency])
+
+    def put(self, key: str, data: Any, dependencies: Iterable[DependencyBase], expires: int, token: PutToken = None,
+            max_lifetime: int = None) -> bool:
+        data_key = self._key('data', key)
+        value = serialize(data)
+        dependencies = list(dependencies)
+
+        # Sliding expiration: the data may live up to `max_lifetime`, and so do its dependencies
+        dependencies_expire = expires
+        if max_lifetime is not None:
+            if not self.sliding_expiration:
+                raise NotImplementedError('put(max_lifetime=) requires RedisBackend(sliding_expiration=True)')
+            value = f'{DATA_SLIDING}{expires}:{int(time.time()) + max_lifetime}:{value}'
+            dependencies_expire = max(expires, max_lifetime)
+
+        if token is not None and token.versions:
+            # Store the dependency information, then the data: if the versions still match
+            self._remember_dependencies_for(data_key, dependencies, dependencies_expire)
+            stored = self._put_if_versions_match(data_key, value, expires, token)
+        else:
+            # Store the data together with the dependency information
+            self._remember_dependencies_for(data_key, dependencies, dependencies_expire, data=value, data_expires=expires)
+            stored = True
+
+        if stored:
+            self._stored(data_key, dependencies, value, dependencies_expire)
+
+            # Small values: sweep a bucket once in a while
+            if self.small_values and not self._small_hexpire:
+                self._small_puts += 1
+                if self._small_puts % self._small_sweep_every == 0:
+                    self._sweep_small_bucket(self._small_location(data_key)[0])
+        return stored
+
+    def for_tenant(self, tenant: str, *, quota_bytes: int = None, lru_resolution: float = 10.0) -> 'RedisBackend':
+        """ Get a backend for one tenant: with its own namespace, byte accounting, quota, and LRU eviction
+
+        See `matroska_cache.backends.tenant`
 
-        # Store the data
-        self.redis.setex(data_key, expires, serialize(data))
+        Args:
+            tenant: Tenant id
+            quota_bytes: Max bytes this tenant's entries may take. Least recently used entries are evicted beyond that.
+            lru_resolution: Only record a read of the same key for LRU once per that many seconds
+        """
+        from .tenant import TenantRedisBackend
+        return TenantRedisBackend(self, tenant, quota_bytes=quota_bytes, lru_resolution=lru_resolution)
+
+    def _stored(self, data_key: str, dependencies: List[DependencyBase], value: str, expires: int):
+        """ Called after put() has stored the data. For subclasses """
+
+    def begin(self, dependencies: Iterable[DependencyBase]) -> PutToken:
+        if not self.race_protection:
+            raise NotImplementedError('begin() requires RedisBackend(race_protection=True)')
+
+        dependency_keys = list({dependency.cached_key() for dependency in dependencies})
+        return PutToken(dict(zip(dependency_keys, self._load_versions(self.redis, dependency_keys))))
+
+    def _put_if_versions_match(self, data_key: str, data: str, expires: int, token: PutToken) -> bool:
+        """ Store the data, unless any of the dependencies from `token` has been invalidated """
+        dependency_keys = list(token.versions)
+        expected_versions = list(token.versions.values())
+
+        # Cluster: check, set, check again. See _cluster_invalidate(): it bumps versions before reading rdep sets.
+        # If the second check does not see the bump, the invalidation will see our rdep, and remove the data.
+        if self.cluster:
+            if self._load_versions(self.redis, dependency_keys) != expected_versions:
+                return False
+            self._store_now(data_key, data, expires)
+            if self._load_versions(self.redis, dependency_keys) != expected_versions:
+                self.redis.unlink(data_key)
+                return False
+            return True
+
+        # Atomically: fail if any version changes while we're checking
+        ver_keys = [self._key('ver', dependency_key) for dependency_key in dependency_keys]
+        with self.redis.pipeline() as t:
+            for _ in range(0, 10):
+                try:
+                    t.watch(*ver_keys)
+                    if self._load_versions(t, dependency_keys) != expected_versions:
+                        t.unwatch()
+                        self.log_enabled and logger.info(f'Refused to put stale data: {data_key}')
+                        return False
 
-    def invalidate(self, dependencies: Iterable[DependencyBase]):
+                    t.multi()
+                    self._store(t, data_key, data, expires)
+                    t.execute()
+                    return True
+                except WatchError:
+                    # A version has changed. Retry, and see.
+                    self.stats['watch_retries'] += 1
+                    continue
+        self._give_up('put', data_key)
+        return False
+
+    def _load_versions(self, redis: Redis, dependency_keys: List[str]) -> List[Optional[str]]:
+        """ Load dependency versions """
+        ver_keys = [self._key('ver', dependency_key) for dependency_key in dependency_keys]
+        if not self.cluster:
+            return redis.mget(ver_keys)
+
+        with redis.pipeline(transaction=False) as p:
+            for ver_key in ver_keys:
+                p.get(ver_key)
+            return p.execute()
+
+    def _bump_versions(self, redis: Redis, deps: Iterable[str]):
+        """ Bump versions of rdep keys `deps`. Use it in a pipeline """
+        rdep_prefix_len = len(self._key('rdep', ''))
+        for rdep_key in deps:
+            ver_key = self._key('ver', rdep_key[rdep_prefix_len:])
+            redis.incr(ver_key)
+            redis.expire(ver_key, self._version_ttl)
+
+    def invalidate(self, dependencies: Iterable[DependencyBase]) -> List[str]:
         if not dependencies:
-            return
+            return []
 
         # Get the list of keys that depend on `dependency` (every single one of them)
         # Use a set to ensure their uniqueness
-        deps = {self._key('rdep', dependency.key())
+        rdep_prefix = self._key('rdep', '')
+        deps = {dependency.prefixed_key(rdep_prefix)
                 for dependency in dependencies}
 
+        if self.cluster:
+            data_keys = self._cluster_invalidate(deps)
+        else:
+            data_keys = self._invalidate(deps)
+
+        # Replicas: make sure we don't read the invalidated data from a lagging replica
+        if self.replicas:
+            self._after_invalidate_replicas()
+
+        # Report cache keys, without our prefix
+        data_prefix_len = len(self._key('data', ''))
+        return [data_key[data_prefix_len:] for data_key in data_keys]
+
+    def _invalidate(self, deps: Set[str]) -> List[str]:
+        """ Invalidate: atomically, in one transaction
+
+        Returns:
+            Invalidated data keys
+        """
         # Atomically, in a transaction
         with self.redis.pipeline() as t:
             # It's scary to do `while True`, so we only try 10 times
             for _ in range(0, 10):
                 try:
-                    # Fail the transaction if any of those keys gets changed
-                    t.watch(*deps)
-
-                    # Get the data keys to invalidate
-                    # To get the data keys, we load every reverse-dependency key
-                    with t.pipeline(transaction=False) as p:
-                        for rdep_key in deps:
-                            p.smembers(rdep_key)
-                        data_keys = list(itertools.chain(*p.execute()))
+                    # Get the data keys to invalidate, and
+                    # fail the transaction if any of those keys gets changed
+                    data_keys, dependents = self._collect_dependents(deps, watch=t.watch)
 
                     # Invalidate those data keys
                     # Invalidate dependency keys as well. Otherwise they may accumulate lots of dead data keys
@@ -77,7 +332,17 @@ class RedisBackend(MatroskaCacheBackendBase):
 
                         # Atomically delete everything
                         t.multi()
-                        t.unlink(*data_keys, *deps)
+                        t.unlink(*data_keys, *dependents)
+                        if self.small_values:
+                            for bucket_key, fields in self._small_locations(data_keys).items():
+                                t.hdel(bucket_key, *fields)
+                        if self.race_protection:
+                            self._bump_versions(t, dependents)
+                        t.execute()
+                    # Nothing to delete, but somebody may be computing the data right now
+                    elif self.race_protection:
+                        t.multi()
+                        self._bump_versions(t, deps)
                         t.execute()
 
                     # Great success!
@@ -85,9 +350,126 @@ class RedisBackend(MatroskaCacheBackendBase):
                     break
                 except WatchError:
                     # Conflict. Retry.
+                    self.stats['watch_retries'] += 1
                     continue
+            else:
+                self._give_up('invalidate', ', '.join(deps))
+                return []
+
+        return data_keys
+
+    def _cluster_invalidate(self, deps: Set[str]) -> List[str]:
+        """ Invalidate without cross-slot transactions: Redis Cluster mode
 
-    def _remember_dependencies_for(self, data_key: str, dependencies: Iterable[DependencyBase], expires: int):
+        Two phases:
+        1. Read the rdep sets and UNLINK data keys, grouped by slot
+        2. SREM exactly those members from the rdep sets (not DEL!)
+
+        A data key that registers itself as a dependency in between the two phases remains in the rdep set,
+        and is not lost for the next invalidate(). Empty sets are removed by Redis automatically.
+
+        The cluster client's non-transactional pipeline sends every command to its node: one round-trip per node.
+
+        Returns:
+            Invalidated data keys
+        """
+        # Versions go first: see _put_if_versions_match()
+        if self.race_protection:
+            with self.redis.pipeline(transaction=False) as p:
+                self._bump_versions(p, deps)
+                p.execute()
+
+        # Phase 1: read
+        data_keys, dependents = self._collect_dependents(deps)
+        if not data_keys:
+            return []
+
+        # Phase 1: unlink data keys. Nested entries' versions go first as well: `CacheKey`s the invalidation cascades to
+        with self.redis.pipeline(transaction=False) as p:
+            if self.race_protection:
+                self._bump_versions(p, dependents.keys() - deps)
+            for slot_keys in group_by_slot(data_keys).values():
+                p.unlink(*slot_keys)
+            p.execute()
+
+        # Phase 2: forget them
+        with self.redis.pipeline(transaction=False) as p:
+            for rdep_key, rdep_members in dependents.items():
+                if rdep_members:
+                    p.srem(rdep_key, *rdep_members)
+            p.execute()
+
+        self.log_enabled and logger.info('Invalidated data keys: ' + ' ; '.join(data_keys))
+        return data_keys
+
+    def _collect_dependents(self, deps: Iterable[str], watch: Callable[..., Any] = None) -> Tuple[List[str], Dict[str, List[str]]]:
+        """ Load data keys that depend on `deps`, including nested entries that depend on them through `CacheKey`
+
+        Every level of nesting is one round-trip. Every data key is only visited once, so cycles are fine.
+
+        Args:
+            deps: rdep keys
+            watch: Function to WATCH the rdep keys with before they are read
+
+        Returns:
+            * unique data keys
+            * { rdep key => [data key, ...] }
+        """
+        dependents: Dict[str, List[str]] = {}
+        data_keys: List[str] = []
+        seen_data_keys = set()
+        data_prefix_len = len(self._key('data', ''))
+
+        level = list(deps)
+        while level:
+            if watch is not None:
+                watch(*level)
+
+            # Load every reverse-dependency key
+            with self.redis.pipeline(transaction=False) as p:
+                for rdep_key in level:
+                    p.smembers(rdep_key)
+                members = p.execute()
+
+            # Collect new data keys
+            next_level = []
+            for rdep_key, rdep_members in zip(level, members):
+                dependents[rdep_key] = list(rdep_members)
+                new_data_keys = [data_key for data_key in rdep_members if data_key not in seen_data_keys]
+                seen_data_keys.update(new_data_keys)
+                data_keys.extend(new_data_keys)
+
+                # Cascade: entries that depend on these ones
+                next_level.extend(
+                    self._key('rdep', CacheKey(data_key[data_prefix_len:]).key())
+                    for data_key in new_data_keys
+                )
+            level = [rdep_key for rdep_key in next_level if rdep_key not in dependents]
+
+        return data_keys, dependents
+
+    def _reader(self) -> Redis:
+        """ Get the Redis client to read from: a replica, or the primary """
+        if not self.replicas or time.monotonic() < self._read_primary_until:
+            return self.redis
+        elif self._read_policy == 'random':
+            return random.choice(self.replicas)
+        else:
+            return next(self._replicas_cycle)
+
+    def _after_invalidate_replicas(self):
+        """ Read-your-invalidations guard """
+        # WAIT for replicas to confirm
+        if self._wait_replicas:
+            if self.redis.wait(self._wait_replicas, self._wait_timeout) >= self._wait_replicas:
+                return
+
+        # Read from the primary for a while
+        if self._read_your_invalidations:
+            self._read_primary_until = time.monotonic() + self._read_your_invalidations
+
+    def _remember_dependencies_for(self, data_key: str, dependencies: Iterable[DependencyBase], expires: int,
+                                   data: str = None, data_expires: int = None):
         """ Update dependency information for `key`
 
         This method stores two keys:
@@ -96,14 +478,31 @@ class RedisBackend(MatroskaCacheBackendBase):
 
         After storing those, it updates the expiration time on every dependency key:
         sets it to `expires`, but makes sure that the resulting TTL is not getting shorter
+
+        Args:
+            data: The serialized data to store together with the dependency information
+            data_expires: The number of seconds the data will expire in. Default: `expires`
         """
+        if data_expires is None:
+            data_expires = expires
+
         # Dependencies as a string with "rdep::" prefix
         # Use a set to ensure their uniqueness
-        deps = {self._key('rdep', dependency.key())
+        rdep_prefix = self._key('rdep', '')
+        deps = {dependency.prefixed_key(rdep_prefix)
                 for dependency in dependencies}
         if not deps:
+            if data is not None:
+                self._store_now(data_key, data, data_expires)
             return
 
+        if self.cluster:
+            # No cross-slot transactions. Store the data first:
+            # an invalidate() in between would not find it, but would not forget its dependencies either
+            if data is not None:
+                self._store_now(data_key, data, data_expires)
+            return self._cluster_remember_dependencies_for(data_key, deps, expires)
+
         # 1. Store reverse dependency information: `dep` is a depencency of `data`
         #    Format: "rdep:<dependency>" = set(<data-key>, ...)
         # 2. Extend the expiration time of these keys
@@ -117,11 +516,15 @@ class RedisBackend(MatroskaCacheBackendBase):
         #   if <expires> greater than <ttl>:
         #       EXPIRE <dep> <expires>
 
-        # Add `data_key` as a reverse dependency of every `deps`
-        # We'll use a pipeline to speed things up. We don't need a transaction here, because we want this data to be saved anyway
-        p = self.redis.pipeline(transaction=False)
+        # Add `data_key` as a reverse dependency of every `deps`.
+        # The data goes in the same transaction: if an invalidate() came in between the two,
+        # it would remove `data_key` from the rdep sets, and the data stored next would be orphaned:
+        # never to be found by the following invalidations.
+        p = self.redis.pipeline(transaction=data is not None)
         for dep in deps:
             p.sadd(dep, data_key)
+        if data is not None:
+            self._store(p, data_key, data, data_expires)
         p.execute()
 
         # Extend the TTLs
@@ -157,7 +560,180 @@ class RedisBackend(MatroskaCacheBackendBase):
                     break
                 except WatchError:
                     # Conflict. Retry.
+                    self.stats['watch_retries'] += 1
                     continue
+            else:
+                self._give_up('dependency TTL update', data_key)
+
+    def _cluster_remember_dependencies_for(self, data_key: str, deps: Set[str], expires: int):
+        """ Update dependency information for `key`: Redis Cluster mode
+
+        No transactions: every rdep key is updated by single-key commands, in one pipeline.
+        Extending TTLs without cutting them short is done by Redis itself:
+        EXPIRE NX sets the TTL for new keys; EXPIRE GT only prolongs it.
+        """
+        with self.redis.pipeline(transaction=False) as p:
+            for dep in deps:
+                p.sadd(dep, data_key)
+                p.execute_command('EXPIRE', dep, expires, 'NX')
+                p.execute_command('EXPIRE', dep, expires, 'GT')
+            p.execute()
+
+    def _read(self, reader: Redis, data_keys: List[str]) -> List[Optional[str]]:
+        """ Read data keys, in one round-trip
+
+        With sliding expiration, TTLs are read as well, and extended when due.
+        With small values, their hash fields are read as well.
+
+        Returns:
+            Serialized data, without headers. None for missing keys.
+        """
+        # Plain keys. Cluster: MGET fails with CROSSSLOT; use the pipeline
+        if not self.sliding_expiration and not self.small_values and not self.cluster:
+            return reader.mget(data_keys)
+
+        with reader.pipeline(transaction=False) as p:
+            for data_key in data_keys:
+                p.get(data_key)
+                if self.sliding_expiration:
+                    p.pttl(data_key)
+                if self.small_values:
+                    p.hget(*self._small_location(data_key))
+            results = p.execute()
+
+        # Every key has a row of results: GET [PTTL] [HGET]
+        row = 1 + self.sliding_expiration + bool(self.small_values)
+        values = results[0::row]
+
+        # Small values: if not found as a key
+        if self.small_values:
+            now = time.time()
+            values = [
+                value if value is not None or small_value is None else _unpack_small(small_value, now)
+                for value, small_value in zip(values, results[row - 1::row])
+            ]
+
+        if self.sliding_expiration:
+            values = self._slide(data_keys, values, results[1::row])
+        return values
+
+    def _slide(self, data_keys: List[str], values: List[Optional[str]], pttls: List[int]) -> List[Optional[str]]:
+        """ Strip the sliding expiration header; extend the TTLs of sliding entries that are due
+
+        Returns:
+            Serialized data, without the sliding expiration header
+        """
+        now = time.time()
+        ret = []
+        extend: List[Tuple[str, int]] = []
+        for data_key, value, pttl in zip(data_keys, values, pttls):
+            if value is not None and value[0] == DATA_SLIDING:
+                window, deadline, value = value[1:].split(':', 2)
+                window, deadline = int(window), int(deadline)
+
+                # Rate limit: only extend when less than half of the window remains.
+                # Once extended, every other reader sees the new TTL, so a hot key gets one EXPIRE per half-window.
+                # NOTE: if the entry is replaced in between, the new one may get its TTL extended once. That's harmless.
+                if 0 <= pttl < window * 500:
+                    new_ttl = min(window, deadline - now)
+                    if new_ttl * 1000 > pttl:
+                        extend.append((data_key, int(new_ttl * 1000)))
+            ret.append(value)
+
+        # Extend: on the primary
+        if extend:
+            with self.redis.pipeline(transaction=False) as p:
+                for data_key, ttl in extend:
+                    p.pexpire(data_key, ttl)
+                p.execute()
+            self.stats['sliding_extensions'] += len(extend)
+
+        return ret
+
+    def _store(self, redis: Redis, data_key: str, value: str, expires: int):
+        """ Store serialized data: as a key, or as a small value. Use it in a transaction
+
+        A value lives in one place: storing it removes it from the other one.
+        """
+        if not self.small_values:
+            redis.setex(data_key, expires, value)
+            return
+
+        bucket_key, field = self._small_location(data_key)
+        if len(value) <= self.small_values and value[0] != DATA_SLIDING:
+            redis.hset(bucket_key, field, f'{int(time.time()) + expires}:{value}')
+            if self._small_hexpire:
+                redis.execute_command('HEXPIRE', bucket_key, expires, 'FIELDS', 1, field)
+            redis.unlink(data_key)
+        else:
+            redis.setex(data_key, expires, value)
+            redis.hdel(bucket_key, field)
+
+    def _store_now(self, data_key: str, value: str, expires: int):
+        """ Store serialized data, outside of any transaction """
+        if not self.small_values:
+            self.redis.setex(data_key, expires, value)
+            return
+
+        with self.redis.pipeline() as t:
+            self._store(t, data_key, value, expires)
+            t.execute()
+
+    def _small_location(self, data_key: str) -> Tuple[str, str]:
+        """ Get the place of a small value: (bucket key, field) """
+        field = data_key[self._data_prefix_len():]
+        return self._key('small', str(small_bucket(field, self._small_buckets))), field
+
+    def _small_locations(self, data_keys: Iterable[str]) -> Dict[str, List[str]]:
+        """ Get the places of small values: { bucket key => [field, ...] } """
+        ret: Dict[str, List[str]] = {}
+        for data_key in data_keys:
+            bucket_key, field = self._small_location(data_key)
+            ret.setdefault(bucket_key, []).append(field)
+        return ret
+
+    def sweep_small_values(self) -> int:
+        """ Remove expired small values from every bucket
+
+        Returns:
+            The number of values removed
+        """
+        return sum(
+            self._sweep_small_bucket(self._key('small', str(bucket)))
+            for bucket in range(self._small_buckets)
+        )
+
+    def _sweep_small_bucket(self, bucket_key: str) -> int:
+        """ Remove expired small values from one bucket. Returns: the number of values removed """
+        with self.redis.pipeline() as t:
+            # Few retries: a busy bucket will be swept next time
+            for _ in range(0, 3):
+                try:
+                    t.watch(bucket_key)
+                    now = time.time()
+                    expired = [field for field, value in t.hgetall(bucket_key).items()
+                               if _unpack_small(value, now) is None]
+                    if not expired:
+                        t.unwatch()
+                        return 0
+
+                    t.multi()
+                    t.hdel(bucket_key, *expired)
+                    t.execute()
+                    self.stats['small_swept'] += len(expired)
+                    return len(expired)
+                except WatchError:
+                    self.stats['watch_retries'] += 1
+                    continue
+        return 0
+
+    def _data_prefix_len(self) -> int:
+        return len(self.prefix) + len('::data::')
+
+    def _give_up(self, operation: str, what: str):
+        """ Report an operation given up after too many WATCH conflicts """
+        self.stats['watch_giveups'] += 1
+        logger.warning(f'Gave up {operation} after too many conflicts: {what}')
 
     def _key(self, type: str, name: str):
         """ Make a Redis key name
@@ -171,28 +747,16 @@ class RedisBackend(MatroskaCacheBackendBase):
         return f'{self.prefix}::{type}::{name}'
 
 
-def serialize(data: Any):
-    """ Serialize strings and objects efficiently
-
-    String: returned as is, with 's' as a prefix
-    Json: serialized, using 'j' as the prefix
-
-    With plain strings, this is 14x faster
-    """
-    if isinstance(data, str):
-        return DATA_STRING + data
-    else:
-        return DATA_JSON + json.dumps(data)
+# Prefix for data with sliding expiration: "~<expires>:<deadline timestamp>:<serialized data>"
+DATA_SLIDING = '~'
 
 
-def unserialize(data: Any):
-    format, data = data[0], data[1:]
-    if format == DATA_STRING:
-        return data
-    elif format == DATA_JSON:
-        return json.loads(data)
+def small_bucket(key: str, buckets: int) -> int:
+    """ Pick the hash bucket for a small value """
+    return zlib.crc32(key.encode()) % buckets
 
 
-# Prefixes for data formats
-DATA_STRING = 's'
-DATA_JSON = 'j'
+def _unpack_small(value: str, now: float) -> Optional[str]:
+    """ Unpack a small value: "<deadline>:<data>". None if expired """
+    deadline, data = value.split(':', 1)
+    return data if int(deadline) > now else None
@@ -0,0 +1,46 @@
+""" Serialization of cached data """
+import json
+from typing import Any
+
+
+class Serialized(str):
+    """ Data serialized already: serialize() returns it as is
+
+    MatroskaCache.put() serializes once, and reuses the value for its policies and the backend
+    """
+    __slots__ = ()
+
+    @property
+    def payload_size(self) -> int:
+        """ The size of the payload: without the format prefix """
+        return len(self) - 1
+
+
+def serialize(data: Any):
+    """ Serialize strings and objects efficiently
+
+    String: returned as is, with 's' as a prefix
+    Json: serialized, using 'j' as the prefix
+    Serialized: returned as is
+
+    With plain strings, this is 14x faster
+    """
+    if isinstance(data, Serialized):
+        return data
+    elif isinstance(data, str):
+        return DATA_STRING + data
+    else:
+        return DATA_JSON + json.dumps(data)
+
+
+def unserialize(data: Any):
+    format, data = data[0], data[1:]
+    if format == DATA_STRING:
+        return data
+    elif format == DATA_JSON:
+        return json.loads(data)
+
+
+# Prefixes for data formats
+DATA_STRING = 's'
+DATA_JSON = 'j'
@@ -0,0 +1,293 @@
+""" SQLite backend: a cache shared by processes on one host, with no external service
+
+Many worker processes on one host (e.g. gunicorn) can share one cache file:
+
+    cache = MatroskaCache(SQLiteBackend('/var/cache/myapp/cache.sqlite', max_size=256 * 1024 * 1024))
+
+The database runs in WAL mode: readers never block, and never wait for the writer.
+
+Tables:
+* data: { key => value, expires_at, size }, indexed by `expires_at` for cleanups and evictions
+* deps: (dependency, key) pairs: the primary key is the reverse index (dependency => keys),
+  and there's a forward index (key => dependencies) to remove them together with the data.
+* versions: dependency versions, for race protection. See `MatroskaCache.begin()`
+
+Every operation is one transaction, so invalidations are atomic.
+"""
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, Iterable, List, Optional, Sequence
+
+from .base import MatroskaCacheBackendBase, DependencyBase, NotInCache, PutToken
+from .serialization import serialize, unserialize
+from ..dep.cache_key import CacheKey
+
+logger = logging.getLogger(__name__)
+
+
+class SQLiteBackend(MatroskaCacheBackendBase):
+    def __init__(self, path: str, *,
+                 max_size: Optional[int] = None,
+                 cleanup_interval: float = 60.0,
+                 race_protection: bool = False,
+                 version_ttl: int = 3600,
+                 timeout: float = 5.0,
+                 ):
+        """ Init the SQLite backend
+
+        Args:
+            path: Path to the database file. Every process that uses this path shares the cache.
+            max_size: Max total size of cached values, bytes. When exceeded, entries that expire soonest are evicted.
+            cleanup_interval: Remove expired entries and enforce `max_size` every that many seconds
+            race_protection: Track dependency versions for begin() and put(token=)
+            version_ttl: Remember dependency versions for that many seconds
+            timeout: How long to wait for a lock held by another writer, seconds
+        """
+        self.path = path
+        self.max_size = max_size
+        self.race_protection = race_protection
+        self._version_ttl = version_ttl
+        self._timeout = timeout
+        self._cleanup_interval = cleanup_interval
+        self._next_cleanup_at = time.monotonic() + cleanup_interval
+
+        # One connection per thread (and per process: connections don't survive a fork)
+        self._local = threading.local()
+
+        # Create tables
+        self._connection().executescript(SCHEMA)
+
+    def get(self, key: str) -> Any:
+        row = self._connection().execute(
+            'SELECT value FROM data WHERE key = ? AND expires_at > ?',
+            (key, time.time())
+        ).fetchone()
+        if row is None:
+            raise NotInCache(key)
+        return unserialize(row[0])
+
+    def get_many(self, keys: Iterable[str]) -> Dict[str, Any]:
+        now = time.time()
+        c = self._connection()
+
+        ret = {}
+        for chunk in _chunks(list(keys)):
+            rows = c.execute(
+                f'SELECT key, value FROM data WHERE key IN ({_placeholders(chunk)}) AND expires_at > ?',
+                (*chunk, now)
+            )
+            ret.update((key, unserialize(value)) for key, value in rows)
+        return ret
+
+    def has(self, key: str) -> bool:
+        return self._connection().execute(
+            'SELECT 1 FROM data WHERE key = ? AND expires_at > ?',
+            (key, time.time())
+        ).fetchone() is not None
+
+    def delete(self, key: str) -> List[str]:
+        with self._transaction() as c:
+            # Nested entries depend on it
+            keys = self._invalidate(c, [CacheKey(key).key()])
+            self._delete_keys(c, [key])
+        return keys
+
+    def put(self, key: str, data: Any, dependencies: Iterable[DependencyBase], expires: int, token: PutToken = None,
+            max_lifetime: int = None) -> bool:
+        if max_lifetime is not None:
+            raise NotImplementedError('SQLiteBackend does not support sliding expiration')
+
+        value = serialize(data)
+        dependency_keys = {dependency.cached_key() for dependency in dependencies}
+
+        with self._transaction() as c:
+            # Race protection
+            if token is not None and token.versions:
+                if self._load_versions(c, list(token.versions)) != list(token.versions.values()):
+                    self.log_enabled and logger.info(f'Refused to put stale data: {key}')
+                    return False
+
+            # Replace the entry, and its dependencies
+            c.execute('DELETE FROM deps WHERE key = ?', (key,))
+            c.execute(
+                'INSERT OR REPLACE INTO data (key, value, expires_at, size) VALUES (?, ?, ?, ?)',
+                (key, value, time.time() + expires, len(value))
+            )
+            c.executemany(
+                'INSERT OR IGNORE INTO deps (dep, key) VALUES (?, ?)',
+                ((dependency_key, key) for dependency_key in dependency_keys)
+            )
+
+        self._maybe_cleanup()
+        return True
+
+    def begin(self, dependencies: Iterable[DependencyBase]) -> PutToken:
+        if not self.race_protection:
+            raise NotImplementedError('begin() requires SQLiteBackend(race_protection=True)')
+
+        dependency_keys = list({dependency.cached_key() for dependency in dependencies})
+        return PutToken(dict(zip(dependency_keys, self._load_versions(self._connection(), dependency_keys))))
+
+    def invalidate(self, dependencies: Iterable[DependencyBase]) -> List[str]:
+        dependency_keys = list({dependency.cached_key() for dependency in dependencies})
+        if not dependency_keys:
+            return []
+
+        with self._transaction() as c:
+            keys = self._invalidate(c, dependency_keys)
+
+        self.log_enabled and logger.info('Invalidated data keys: ' + ' ; '.join(keys))
+        return keys
+
+    def cleanup(self):
+        """ Remove expired entries; evict entries that expire soonest if the cache is too large """
+        now = time.time()
+        with self._transaction() as c:
+            # Expired
+            expired = [key for key, in c.execute('SELECT key FROM data WHERE expires_at <= ?', (now,))]
+            self._delete_keys(c, expired)
+            c.execute('DELETE FROM versions WHERE expires_at <= ?', (now,))
+
+            # Too large
+            if self.max_size is not None:
+                total_size, = c.execute('SELECT COALESCE(SUM(size), 0) FROM data').fetchone()
+                if total_size > self.max_size:
+                    evict = []
+                    for key, size in c.execute('SELECT key, size FROM data ORDER BY expires_at'):
+                        evict.append(key)
+                        total_size -= size
+                        if total_size <= self.max_size:
+                            break
+                    self._delete_keys(c, evict)
+
+    def _invalidate(self, c: sqlite3.Connection, dependency_keys: List[str]) -> List[str]:
+        """ Invalidate, with cascading through `CacheKey`. Use within a transaction
+
+        Returns:
+            Invalidated keys
+        """
+        seen_dependency_keys = set(dependency_keys)
+        keys: List[str] = []
+        seen_keys = set()
+
+        level = dependency_keys
+        while level:
+            new_keys = []
+            for chunk in _chunks(level):
+                for key, in c.execute(f'SELECT key FROM deps WHERE dep IN ({_placeholders(chunk)})', chunk):
+                    if key not in seen_keys:
+                        seen_keys.add(key)
+                        new_keys.append(key)
+            keys.extend(new_keys)
+
+            # Cascade: entries that depend on these ones
+            level = [CacheKey(key).key() for key in new_keys]
+            level = [dependency_key for dependency_key in level if dependency_key not in seen_dependency_keys]
+            seen_dependency_keys.update(level)
+
+        # Delete
+        self._delete_keys(c, keys)
+        for chunk in _chunks(list(seen_dependency_keys)):
+            c.execute(f'DELETE FROM deps WHERE dep IN ({_placeholders(chunk)})', chunk)
+
+        # Bump versions
+        if self.race_protection:
+            expires_at = time.time() + self._version_ttl
+            c.executemany('INSERT OR IGNORE INTO versions (dep, version, expires_at) VALUES (?, 0, ?)',
+                          ((dependency_key, expires_at) for dependency_key in seen_dependency_keys))
+            c.executemany('UPDATE versions SET version = version + 1, expires_at = ? WHERE dep = ?',
+                          ((expires_at, dependency_key) for dependency_key in seen_dependency_keys))
+
+        return keys
+
+    def _delete_keys(self, c: sqlite3.Connection, keys: Sequence[str]):
+        """ Delete data keys with their dependencies """
+        for chunk in _chunks(keys):
+            placeholders = _placeholders(chunk)
+            c.execute(f'DELETE FROM data WHERE key IN ({placeholders})', chunk)
+            c.execute(f'DELETE FROM deps WHERE key IN ({placeholders})', chunk)
+
+    def _load_versions(self, c: sqlite3.Connection, dependency_keys: List[str]) -> List[Optional[int]]:
+        """ Load dependency versions """
+        versions = {}
+        now = time.time()
+        for chunk in _chunks(dependency_keys):
+            versions.update(c.execute(
+                f'SELECT dep, version FROM versions WHERE dep IN ({_placeholders(chunk)}) AND expires_at > ?',
+                (*chunk, now)
+            ))
+        return [versions.get(dependency_key) for dependency_key in dependency_keys]
+
+    def _maybe_cleanup(self):
+        now = time.monotonic()
+        if now >= self._next_cleanup_at:
+            self._next_cleanup_at = now + self._cleanup_interval
+            self.cleanup()
+
+    def _connection(self) -> sqlite3.Connection:
+        """ Get a connection for the current thread """
+        c: Optional[sqlite3.Connection] = getattr(self._local, 'connection', None)
+        if c is None or self._local.pid != os.getpid():
+            # Autocommit mode: we manage transactions ourselves
+            c = sqlite3.connect(self.path, timeout=self._timeout, isolation_level=None, check_same_thread=False)
+            c.execute('PRAGMA journal_mode = WAL')
+            # It's a cache: losing the last transactions on power loss is fine
+            c.execute('PRAGMA synchronous = NORMAL')
+            self._local.connection = c
+            self._local.pid = os.getpid()
+        return c
+
+    def _transaction(self) -> '_Transaction':
+        return _Transaction(self._connection())
+
+
+class _Transaction:
+    """ BEGIN IMMEDIATE ... COMMIT: take the write lock right away, so that reads within the transaction are consistent """
+    __slots__ = 'c',
+
+    def __init__(self, c: sqlite3.Connection):
+        self.c = c
+
+    def __enter__(self) -> sqlite3.Connection:
+        self.c.execute('BEGIN IMMEDIATE')
+        return self.c
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.c.execute('COMMIT' if exc_type is None else 'ROLLBACK')
+
+
+def _chunks(items: Sequence[str], size: int = 500) -> Iterable[Sequence[str]]:
+    """ Split into chunks: SQLite limits the number of parameters in a query """
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def _placeholders(items: Sequence[Any]) -> str:
+    return ', '.join('?' * len(items))
+
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS data (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL,
+    expires_at REAL NOT NULL,
+    size INTEGER NOT NULL
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS data_expires_at ON data (expires_at);
+
+CREATE TABLE IF NOT EXISTS deps (
+    dep TEXT NOT NULL,
+    key TEXT NOT NULL,
+    PRIMARY KEY (dep, key)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS deps_key ON deps (key);
+
+CREATE TABLE IF NOT EXISTS versions (
+    dep TEXT PRIMARY KEY,
+    version INTEGER NOT NULL,
+    expires_at REAL NOT NULL
+) WITHOUT ROWID;
+'''
@@ -0,0 +1,369 @@
+""" Tenants: per-tenant namespaces with byte accounting, quotas, and LRU eviction
+
+Many tenants share one Redis. Under `maxmemory`, one tenant caching huge listings pushes everyone else out,
+and Redis evicts data keys but keeps their rdep sets.
+
+A tenant backend keeps its keys under its own prefix, and keeps track of them:
+
+* `tenant::used`: the number of bytes the tenant's entries take: data, and dependency sets
+* `tenant::sizes`: { data key => bytes }
+* `tenant::lru`: sorted set { data key => last access time }
+* `fdep::<key>`: forward dependencies of every entry: to remove it from the rdep sets when it's evicted
+
+When a put() takes the tenant beyond its quota, least recently used entries are evicted until it's back below
+`low_watermark` of the quota: data, forward dependencies, and rdep set members, all together.
+
+Entries that expire are dropped by Redis silently, but their accounting stays.
+It's reconciled: eviction forgets expired entries first; about once every `reconcile_every` puts, the least recently used
+entries are checked; reconcile() checks them all.
+
+Example:
+    cache.for_tenant('acme', quota_bytes=50 * 1024 * 1024).put(...)
+
+NOTE: accounting is not exact: concurrent writes of the very same key may make it drift a little.
+    Use recount() to repair it. Eviction itself is exact.
+NOTE: not supported in Redis Cluster mode.
+"""
+import logging
+import random
+import time
+from typing import Any, Dict, Iterable, List, Optional
+
+from redis import WatchError
+
+from .base import DependencyBase
+from .redis import RedisBackend, _unpack_small
+
+logger = logging.getLogger(__name__)
+
+
+class TenantRedisBackend(RedisBackend):
+    """ RedisBackend for one tenant. Use RedisBackend.for_tenant() """
+
+    def __init__(self, parent: RedisBackend, tenant: str, *,
+                 quota_bytes: int = None,
+                 lru_resolution: float = 10.0,
+                 low_watermark: float = 0.9,
+                 evict_batch: int = 100,
+                 reconcile_every: int = 1000,
+                 ):
+        """
+        Args:
+            parent: The backend to take the configuration from
+            tenant: Tenant id
+            quota_bytes: Max bytes this tenant's entries may take. Default: unlimited, but still accounted for
+            lru_resolution: Only record a read of the same key for LRU once per that many seconds
+            low_watermark: Evict until the tenant is below that fraction of the quota
+            evict_batch: Evict that many entries per round-trip
+            reconcile_every: About once every that many puts, forget the least recently used entries that have expired
+        """
+        if parent.cluster:
+            raise NotImplementedError('Tenants are not supported in Redis Cluster mode')
+
+        super().__init__(
+            parent.redis,
+            prefix=f'{parent.prefix}::tenant:{tenant}',
+            replicas=parent.replicas,
+            read_policy=parent._read_policy,
+            read_your_invalidations=parent._read_your_invalidations,
+            wait_replicas=parent._wait_replicas,
+            wait_timeout=parent._wait_timeout,
+            race_protection=parent.race_protection,
+            version_ttl=parent._version_ttl,
+            sliding_expiration=parent.sliding_expiration,
+            small_values=parent.small_values,
+            small_buckets=parent._small_buckets,
+            small_hexpire=parent._small_hexpire,
+            small_sweep_every=parent._small_sweep_every,
+        )
+        self.log_enabled = parent.log_enabled
+
+        self.tenant = tenant
+        self.quota_bytes = quota_bytes
+        self._lru_resolution = lru_resolution
+        self._low_watermark = low_watermark
+        self._evict_batch = evict_batch
+        self._reconcile_every = reconcile_every
+
+        # { data key => when its read was recorded }: to rate-limit LRU updates
+        self._touched: Dict[str, float] = {}
+
+        self._used_key = self._key('tenant', 'used')
+        self._sizes_key = self._key('tenant', 'sizes')
+        self._lru_key = self._key('tenant', 'lru')
+
+    def get(self, key: str) -> Any:
+        data = super().get(key)
+        self._touch([self._key('data', key)])
+        return data
+
+    def get_many(self, keys: Iterable[str]) -> Dict[str, Any]:
+        found = super().get_many(keys)
+        self._touch([self._key('data', key) for key in found])
+        return found
+
+    def delete(self, key: str) -> List[str]:
+        keys = super().delete(key)
+        self._forget([self._key('data', key)])
+        return keys
+
+    def invalidate(self, dependencies: Iterable[DependencyBase]) -> List[str]:
+        keys = super().invalidate(dependencies)
+        self._forget([self._key('data', key) for key in keys])
+        return keys
+
+    def usage(self) -> Dict[str, Any]:
+        """ Get the tenant's usage: 'used' bytes, 'quota' bytes, the number of 'entries' """
+        with self.redis.pipeline(transaction=False) as p:
+            p.get(self._used_key)
+            p.zcard(self._lru_key)
+            used, entries = p.execute()
+        return {'used': int(used or 0), 'quota': self.quota_bytes, 'entries': entries}
+
+    def recount(self) -> int:
+        """ Repair the byte counter: recompute it from entry sizes
+
+        Returns:
+            The number of bytes used. If given up: the counter as is
+        """
+        with self.redis.pipeline() as t:
+            # It's scary to do `while True`, so we only try 10 times
+            for _ in range(0, 10):
+                try:
+                    t.watch(self._sizes_key)
+                    used = sum(int(size) for size in t.hvals(self._sizes_key))
+                    t.multi()
+                    t.set(self._used_key, used)
+                    t.execute()
+                    return used
+                except WatchError:
+                    self.stats['watch_retries'] += 1
+                    continue
+            else:
+                self._give_up('recount', self._used_key)
+                return int(self.redis.get(self._used_key) or 0)
+
+    def reconcile(self) -> int:
+        """ Forget the accounting for all entries that have expired
+
+        Returns:
+            The number of entries forgotten
+        """
+        forgotten = 0
+        batch = []
+        for data_key, _ in self.redis.zscan_iter(self._lru_key, count=self._evict_batch):
+            batch.append(data_key)
+            if len(batch) >= self._evict_batch:
+                forgotten += len(batch) - len(self._forget_expired(batch))
+                batch = []
+        if batch:
+            forgotten += len(batch) - len(self._forget_expired(batch))
+        return forgotten
+
+    def _stored(self, data_key: str, dependencies: List[DependencyBase], value: str, expires: int):
+        """ Account for a new entry; evict if over quota """
+        rdep_prefix = self._key('rdep', '')
+        rdep_keys = {dependency.prefixed_key(rdep_prefix) for dependency in dependencies}
+        size = entry_size(data_key, value, rdep_keys)
+        fdep_key = self._fdep_key(data_key)
+
+        old_size = self.redis.hget(self._sizes_key, data_key)
+        with self.redis.pipeline() as t:
+            t.unlink(fdep_key)
+            if rdep_keys:
+                t.sadd(fdep_key, *rdep_keys)
+                t.expire(fdep_key, expires)
+            t.zadd(self._lru_key, {data_key: time.time()})
+            t.hset(self._sizes_key, data_key, size)
+            t.incrby(self._used_key, size - int(old_size or 0))
+            used = t.execute()[-1]
+
+        if self.quota_bytes is not None and used > self.quota_bytes:
+            self._evict(used)
+
+        # Expired entries: check the least recently used ones once in a while.
+        # Random: tenant backends are often short-lived, e.g. one per request
+        if random.random() * self._reconcile_every < 1:
+            self._forget_expired(self.redis.zrange(self._lru_key, 0, self._evict_batch - 1))
+
+    def _touch(self, data_keys: List[str]):
+        """ Record reads for LRU. Rate-limited: a hot key is recorded once per `lru_resolution` """
+        now = time.monotonic()
+        due = [data_key for data_key in data_keys if self._touched.get(data_key, -self._lru_resolution) + self._lru_resolution <= now]
+        if not due:
+            return
+
+        # Don't let it grow forever
+        if len(self._touched) > 10000:
+            self._touched.clear()
+        self._touched.update((data_key, now) for data_key in due)
+
+        # XX: only update existing members. Don't resurrect entries that are gone
+        self.redis.zadd(self._lru_key, {data_key: time.time() for data_key in due}, xx=True)
+
+    def _evict(self, used: int):
+        """ Evict least recently used entries until below the low watermark """
+        target = self.quota_bytes * self._low_watermark
+        while used > target:
+            candidates = self.redis.zrange(self._lru_key, 0, self._evict_batch - 1)
+            if not candidates:
+                # Nothing left to evict: the counter has drifted
+                self.recount()
+                return
+
+            # Expired entries are gone already: forget them first, and see if it's enough
+            alive = self._forget_expired(candidates)
+            if len(alive) < len(candidates):
+                used = int(self.redis.get(self._used_key) or 0)
+                continue
+
+            # Only take as many as it takes to get below the target
+            victims, excess = [], used - target
+            for data_key, size in zip(candidates, self.redis.hmget(self._sizes_key, candidates)):
+                victims.append(data_key)
+                excess -= int(size or 0)
+                if excess <= 0:
+                    break
+
+            freed = self._remove(victims)
+            if not freed:
+                # Given up on conflicts, or sizes are gone: the same candidates would come again. Try on the next put()
+                logger.warning(f'Tenant {self.tenant}: eviction stalled at {used} bytes')
+                return
+            self.stats['evictions'] += len(victims)
+            used -= freed
+            self.log_enabled and logger.info(f'Tenant {self.tenant}: evicted {len(victims)} keys, {freed} bytes')
+
+    def _remove(self, data_keys: List[str]) -> int:
+        """ Remove entries with all their traces: data, forward dependencies, rdep set members, accounting
+
+        Returns:
+            The number of bytes freed
+        """
+        fdep_keys = [self._fdep_key(data_key) for data_key in data_keys]
+
+        with self.redis.pipeline() as t:
+            for _ in range(0, 10):
+                try:
+                    # Fail if any of them is put() again in the meanwhile
+                    t.watch(*self._watched_keys(data_keys))
+
+                    # Read their dependencies and sizes
+                    with t.pipeline(transaction=False) as p:
+                        for fdep_key in fdep_keys:
+                            p.smembers(fdep_key)
+                        p.hmget(self._sizes_key, data_keys)
+                        *rdep_keys_lists, sizes = p.execute()
+                    freed = sum(int(size or 0) for size in sizes)
+
+                    # Remove everything at once
+                    t.multi()
+                    t.unlink(*data_keys, *fdep_keys)
+                    if self.small_values:
+                        for bucket_key, fields in self._small_locations(data_keys).items():
+                            t.hdel(bucket_key, *fields)
+                    for data_key, rdep_keys in zip(data_keys, rdep_keys_lists):
+                        for rdep_key in rdep_keys:
+                            t.srem(rdep_key, data_key)
+                    t.zrem(self._lru_key, *data_keys)
+                    t.hdel(self._sizes_key, *data_keys)
+                    t.decrby(self._used_key, freed)
+                    t.execute()
+                    return freed
+                except WatchError:
+                    self.stats['watch_retries'] += 1
+                    continue
+            else:
+                self._give_up('eviction', ', '.join(data_keys))
+                return 0
+
+    def _forget(self, data_keys: List[str]):
+        """ Forget the accounting for entries that are gone: invalidated or deleted """
+        if not data_keys:
+            return
+
+        sizes = self.redis.hmget(self._sizes_key, data_keys)
+        with self.redis.pipeline() as t:
+            self._forget_in(t, data_keys, sizes)
+            t.execute()
+
+    def _forget_expired(self, data_keys: List[str]) -> List[str]:
+        """ Forget the accounting for entries that have expired
+
+        Returns:
+            The data keys that still exist
+        """
+        if not data_keys:
+            return []
+
+        with self.redis.pipeline() as t:
+            for _ in range(0, 10):
+                try:
+                    # Fail if any of them is put() again in the meanwhile
+                    t.watch(*self._watched_keys(data_keys))
+
+                    exists = self._exist(data_keys)
+                    expired = [data_key for data_key, found in zip(data_keys, exists) if not found]
+                    if expired:
+                        sizes = t.hmget(self._sizes_key, expired)
+                        t.multi()
+                        self._forget_in(t, expired, sizes)
+                        t.execute()
+                        self.stats['expired'] += len(expired)
+                    else:
+                        t.unwatch()
+                    return [data_key for data_key, found in zip(data_keys, exists) if found]
+                except WatchError:
+                    self.stats['watch_retries'] += 1
+                    continue
+            else:
+                self._give_up('reconciliation', ', '.join(data_keys))
+                return data_keys
+
+    def _forget_in(self, t, data_keys: List[str], sizes: List[Optional[str]]):
+        """ Forget the accounting: queue the commands into a transaction. Small values are removed as well """
+        if self.small_values:
+            for bucket_key, fields in self._small_locations(data_keys).items():
+                t.hdel(bucket_key, *fields)
+        t.unlink(*(self._fdep_key(data_key) for data_key in data_keys))
+        t.zrem(self._lru_key, *data_keys)
+        t.hdel(self._sizes_key, *data_keys)
+        t.decrby(self._used_key, sum(int(size or 0) for size in sizes))
+
+    def _exist(self, data_keys: List[str]) -> List[bool]:
+        """ Check which entries exist: as keys, or as small values that have not expired """
+        with self.redis.pipeline(transaction=False) as p:
+            for data_key in data_keys:
+                p.exists(data_key)
+                if self.small_values:
+                    p.hget(*self._small_location(data_key))
+            results = p.execute()
+
+        if not self.small_values:
+            return [bool(found) for found in results]
+
+        now = time.time()
+        return [
+            bool(found) or (small_value is not None and _unpack_small(small_value, now) is not None)
+            for found, small_value in zip(results[0::2], results[1::2])
+        ]
+
+    def _watched_keys(self, data_keys: List[str]) -> List[str]:
+        """ Keys to WATCH for entries being put() again: data keys, and small value buckets """
+        if not self.small_values:
+            return data_keys
+        return [*data_keys, *self._small_locations(data_keys)]
+
+    def _fdep_key(self, data_key: str) -> str:
+        return self._key('fdep', data_key[len(self._key('data', '')):])
+
+
+def entry_size(data_key: str, value: str, rdep_keys: Iterable[str]) -> int:
+    """ Estimate the bytes an entry takes: the data, its member in every rdep set, its fdep set, the accounting """
+    rdep_keys = list(rdep_keys)
+    return (
+        len(data_key) + len(value) +
+        len(data_key) * len(rdep_keys) +
+        sum(len(rdep_key) for rdep_key in rdep_keys) +
+        len(data_key) * 2
+    )
@@ -47,12 +47,27 @@ Example:
     cache.put('articles-list', jsonify(data), *dependencies, expires=60)
 """
 import logging
+from contextlib import contextmanager
+from contextvars import ContextVar
 from datetime import timedelta
-from typing import Any, Union
+from typing import Any, Union, Optional, Iterator, Iterable, Dict, List, Set, TYPE_CHECKING
 
-from .backends.base import MatroskaCacheBackendBase
+from .backends.base import MatroskaCacheBackendBase, PutToken
+from .backends.serialization import Serialized, serialize
 from .dep.base import DependencyBase
 from .exc import NotInCache  # noqa
+from .invalidation_queue import InvalidationQueue, BackgroundInvalidator
+from .fragments import FragmentTree, find_fragments, assemble
+from .loader import Loader, Deferred
+
+if TYPE_CHECKING:  # import time matters: only import them when used
+    from .warming import WarmingRegistry
+    from .admission import AdmissionPolicy
+    from .dep.bucket import Coarsening
+    from .hotspots import HotspotTracker
+    from .adaptive import AdaptiveTTL
+    from .replay import Recorder
+    from .stream import InvalidationStream
 
 logger = logging.getLogger(__name__)
 
@@ -61,6 +76,58 @@ class MatroskaCache:
     def __init__(self, backend: MatroskaCacheBackendBase):
         self.backend = backend
 
+        # Deferred invalidation: the queue of the current unit of work, if any
+        self._invalidation_queue: ContextVar[Optional[InvalidationQueue]] = ContextVar('invalidation_queue', default=None)
+        self._background_invalidator = BackgroundInvalidator()
+
+        # Batched reads: the loader of the current request, if any
+        self._loader: ContextVar[Optional[Loader]] = ContextVar('loader', default=None)
+
+    # Warmers: recompute invalidated entries in the background. See `matroska_cache.warming`
+    warmers: 'Optional[WarmingRegistry]' = None
+
+    # Admission policy: decide which entries are worth storing. See `matroska_cache.admission`
+    admission: 'Optional[AdmissionPolicy]' = None
+
+    # Coarsening: collapse huge lists of `Id`s into buckets. See `matroska_cache.dep.bucket`
+    coarsening: 'Optional[Coarsening]' = None
+
+    # Hot-spot tracking, and an in-process cache for hot keys. See `matroska_cache.hotspots`
+    hotspots: 'Optional[HotspotTracker]' = None
+
+    # Adaptive TTLs: learn them from observed invalidations. See `matroska_cache.adaptive`
+    adaptive_ttl: 'Optional[AdaptiveTTL]' = None
+
+    # Traffic recorder, for offline replays. See `matroska_cache.replay`
+    recorder: 'Optional[Recorder]' = None
+
+    # Publish invalidations to other services and regions. See `matroska_cache.stream`
+    stream: 'Optional[InvalidationStream]' = None
+
+    def for_tenant(self, tenant: str, *, quota_bytes: int = None) -> 'MatroskaCache':
+        """ Get a cache for one tenant: its own namespace, byte accounting, quota and LRU eviction
+
+        Requires backend support: e.g. RedisBackend. See `matroska_cache.backends.tenant`
+
+        The admission policy and coarsening are shared with this cache.
+        Hot spots, adaptive TTLs, and the recorder are not: they keep their state by the cache key,
+        and tenants' keys would collide: e.g. the in-process cache would serve one tenant's data to another.
+        Neither are warmers and the invalidation stream. Set them on the tenant's cache, if you need them.
+
+        Args:
+            tenant: Tenant id
+            quota_bytes: Max bytes this tenant's entries may take. Least recently used entries are evicted beyond that.
+        """
+        for_tenant = getattr(self.backend, 'for_tenant', None)
+        if for_tenant is None:
+            raise NotImplementedError(f'{type(self.backend).__name__} does not support tenants')
+
+        cache = MatroskaCache(for_tenant(tenant, quota_bytes=quota_bytes))
+        cache.admission = self.admission
+        cache.coarsening = self.coarsening
+        cache.log_enabled = self.log_enabled
+        return cache
+
     def get(self, key: str) -> Any:
         """ Get cached data by `key`; raise KeyError if it does not exist
 
@@ -69,29 +136,240 @@ class MatroskaCache:
         Raises:
             NotInCache: no data cached by that key
         """
-        return self.backend.get(key)
+        # Within loader(): batched & memoized
+        loader = self._loader.get()
+        if loader is not None:
+            return loader.load(key)
+
+        if self.admission is not None:
+            self.admission.record_access(key)
+
+        # Hot keys may be available in-process
+        local = None
+        if self.hotspots is not None:
+            self.hotspots.record('get', (key,))
+            local = self.hotspots.local
+            if local is not None:
+                data = local.get(key, _MISSING)
+                if data is not _MISSING:
+                    self.recorder is not None and self.recorder.record_get(key, True)
+                    return data
+
+        try:
+            data = self.backend.get(key)
+        except NotInCache:
+            self.recorder is not None and self.recorder.record_get(key, False)
+            raise
+        self.recorder is not None and self.recorder.record_get(key, True)
+
+        if self.warmers is not None:
+            self.warmers.record_hit(key)
+        if local is not None and self.hotspots.is_hot(key):
+            local.put(key, data)
+        return data
+
+    def get_many(self, keys: Iterable[str]) -> Dict[str, Any]:
+        """ Get many cached keys at once
+
+        Args:
+            keys: The cache keys
+        Returns:
+            { key => data } for the keys that are available. Missing keys are omitted.
+        """
+        # Within loader(): batched & memoized
+        loader = self._loader.get()
+        if loader is not None:
+            return loader.load_many(keys)
+
+        return self._get_many(list(keys))
+
+    def _get_many(self, keys: List[str]) -> Dict[str, Any]:
+        """ get_many(), for real """
+        if self.admission is not None:
+            for key in keys:
+                self.admission.record_access(key)
+
+        if self.hotspots is not None:
+            self.hotspots.record('get', keys)
+
+        found = self.backend.get_many(keys)
+        if self.warmers is not None:
+            for key in found:
+                self.warmers.record_hit(key)
+        if self.recorder is not None:
+            for key in keys:
+                self.recorder.record_get(key, key in found)
+        return found
+
+    def get_tree(self, key: str, *, max_depth: int = 10) -> FragmentTree:
+        """ Get a cached entry with all the fragments it references, assembled. See `matroska_cache.fragments`
+
+        Fragments are loaded breadth-first: one get_many() round-trip per level.
+
+        Args:
+            key: The cache key
+            max_depth: Max nesting depth to follow
+        Returns:
+            The assembled value, and the set of missing fragments
+        Raises:
+            NotInCache: the root entry is not in cache
+        """
+        fragments: Dict[str, Any] = {}
+        missing: Set[str] = set()
+
+        level = {key}
+        for _ in range(max_depth + 1):
+            if not level:
+                break
+
+            # Load the level
+            found = self.get_many(level)
+            fragments.update(found)
+            missing.update(level - found.keys())
+
+            # Next level: new references
+            level = {
+                ref
+                for value in found.values()
+                for ref in find_fragments(value)
+                if ref not in fragments and ref not in missing
+            }
+
+        if key in missing:
+            raise NotInCache(key)
+
+        return FragmentTree(assemble(fragments[key], fragments, frozenset((key,))), missing)
+
+    @contextmanager
+    def loader(self) -> Iterator[Loader]:
+        """ Batch and memoize reads within the block. See `matroska_cache.loader`
+
+        Example:
+            with cache.loader():
+                a = cache.get_deferred('article-1')
+                b = cache.get_deferred('article-2')
+                a.result()  # loads both, with one get_many()
+
+        Within the block, get() and get_many() are memoized, and load pending deferred keys as well.
+        Nested blocks join the outermost one.
+        """
+        # Nested: join the outer one
+        loader = self._loader.get()
+        if loader is not None:
+            yield loader
+            return
+
+        loader = Loader(self._get_many)
+        token = self._loader.set(loader)
+        try:
+            yield loader
+        finally:
+            self._loader.reset(token)
+
+    def get_deferred(self, key: str) -> Deferred:
+        """ Get a promise of cached data by `key`: use result(), or `await` it
+
+        Within loader(), all pending keys are loaded with one get_many() when any of them is resolved.
+        Outside of it, every key is loaded by itself.
+        """
+        loader = self._loader.get() or Loader(self._get_many)
+        return loader.get_deferred(key)
 
     def has(self, key: str) -> bool:
         """ Check if cache key `key` is available """
         return self.backend.has(key)
 
-    def put(self, key: str, data: Any, *dependencies: DependencyBase, expires: Union[int, timedelta]):
+    def begin(self, *dependencies: DependencyBase) -> PutToken:
+        """ Capture the state of `dependencies` before you load the data, to put() it safely
+
+        There's a race between loading the data and put()ting it: another request may change the data
+        and invalidate() it in between. Then, stale data would be put into the cache for the full TTL.
+
+        With a token, put() refuses to store the data if any of the dependencies has been invalidated since begin():
+
+            token = cache.begin(dep.Id('article', 1))
+            article = load_article(1)
+            cache.put('article-1', article, dep.Id('article', 1), expires=3600, token=token)
+
+        Requires backend support: e.g. RedisBackend(race_protection=True)
+        """
+        return self.backend.begin(dependencies)
+
+    def put(self, key: str, data: Any, *dependencies: DependencyBase, expires: Union[int, timedelta], cost: float = None, token: PutToken = None,
+            max_lifetime: Union[int, timedelta] = None) -> bool:
         """ Store data into the cache under key `key`
 
         Args:
             key: The cache key
             data: The data to store. It has to be json-serializable.
             *dependencies: List of dependencies for this cache entry. See `matroska_cache.dep`.
-            expires: The number of seconds to keep this cache entry for, or a `timedelta` object
+            expires: The number of seconds to keep this cache entry for, or a `timedelta` object.
+                With `adaptive_ttl`, only used until a TTL is learned.
+            cost: The number of seconds it took to compute `data`. Used by the admission policy.
+            token: The token from begin(). Refuse to store the data if any of its dependencies has been invalidated since.
+            max_lifetime: Sliding expiration: every get() keeps the entry for another `expires` seconds,
+                but no longer than `max_lifetime` seconds after the put(). Requires backend support,
+                e.g. RedisBackend(sliding_expiration=True)
+
+        Returns:
+            Whether the data was stored
         """
         if isinstance(expires, timedelta):
             expires = int(expires.total_seconds())
+        if isinstance(max_lifetime, timedelta):
+            max_lifetime = int(max_lifetime.total_seconds())
+
+        # Adaptive TTL: learned from invalidations
+        if self.adaptive_ttl is not None:
+            expires = self.adaptive_ttl.ttl_for(key, expires)
+
+        # Serialize once: the admission policy, the recorder, and the backend all need it
+        value = Serialized(serialize(data))
+
+        # Admission: is it worth caching?
+        if self.admission is not None:
+            decision = self.admission.decide(key, data, cost=cost, expires=expires, size=value.payload_size)
+            if not decision.admit:
+                return False
+            expires = decision.expires
+
+        # Coarsening
+        if self.coarsening is not None:
+            dependencies = self.coarsening.coarsen(dependencies)
+
+        if self.hotspots is not None:
+            self.hotspots.record('put', (dependency.cached_key() for dependency in dependencies))
+            if self.hotspots.local is not None:
+                self.hotspots.local.discard((key,))
+
+        loader = self._loader.get()
+        if loader is not None:
+            loader.forget((key,))
+
+        if self.adaptive_ttl is not None:
+            self.adaptive_ttl.record_put(key, expires)
+
+        if self.recorder is not None:
+            self.recorder.record_put(key, data, dependencies, expires, size=value.payload_size)
+
         self.log_enabled and logger.info('put(): ' + ", ".join(str(dep) for dep in dependencies))
-        return self.backend.put(key, data, expires=expires, dependencies=dependencies)
+        return self.backend.put(key, value, expires=expires, dependencies=dependencies, token=token, max_lifetime=max_lifetime)
+
+    def delete(self, key: str) -> List[str]:
+        """ Delete a cache key
+
+        Returns:
+            The list of keys invalidated through it: entries that depend on it with `CacheKey`
+        """
+        invalidated_keys = self.backend.delete(key)
 
-    def delete(self, key: str):
-        """ Delete a cache key """
-        self.backend.delete(key)
+        # Forget the key, and the keys that were invalidated through it
+        if self.hotspots is not None and self.hotspots.local is not None:
+            self.hotspots.local.discard((key, *invalidated_keys))
+        loader = self._loader.get()
+        if loader is not None:
+            loader.forget((key, *invalidated_keys))
+        return invalidated_keys
 
     def invalidate(self, *dependencies: DependencyBase):
         """ Invalidate all cache entries that depend on `dependencies`
@@ -99,8 +377,89 @@ class MatroskaCache:
         Args:
             *dependencies: List of dependencies to invalidate cache records for
         """
+        # Coarsening: invalidate their buckets as well
+        if self.coarsening is not None:
+            dependencies = self.coarsening.expand(dependencies)
+
+        # Within deferred_invalidation(), only remember them
+        queue = self._invalidation_queue.get()
+        if queue is not None:
+            queue.add(dependencies)
+            return
+
         self.log_enabled and logger.info('invalidate(): ' + ", ".join(str(dep) for dep in dependencies))
-        return self.backend.invalidate(dependencies)
+        if self.recorder is not None:
+            self.recorder.record_invalidate(dependencies)
+        invalidated_keys = self.backend.invalidate(dependencies)
+
+        # Tell other caches
+        if self.stream is not None:
+            self.stream.publish(dependencies)
+
+        if self.hotspots is not None:
+            self.hotspots.record('invalidate', (dependency.cached_key() for dependency in dependencies))
+            if self.hotspots.local is not None:
+                self.hotspots.local.discard(invalidated_keys)
+
+        loader = self._loader.get()
+        if loader is not None:
+            loader.forget(invalidated_keys)
+
+        if self.adaptive_ttl is not None and invalidated_keys:
+            self.adaptive_ttl.record_invalidated(invalidated_keys)
+
+        # Recompute them
+        if self.warmers is not None and invalidated_keys:
+            self.warmers.schedule(invalidated_keys, dependencies)
+
+        return invalidated_keys
+
+    @contextmanager
+    def deferred_invalidation(self, *, background: bool = False) -> Iterator[InvalidationQueue]:
+        """ Collect invalidate() calls and invalidate them in one batch when the block exits
+
+        Example:
+            with cache.deferred_invalidation():
+                cache.invalidate(dep.Id('article', 1))
+                cache.invalidate(dep.Id('article', 1), dep.Tag('homepage'))
+            # Invalidated here, once
+
+        Dependencies are deduplicated. Nested blocks join the outermost one.
+        The queue is flushed even if the block fails: invalidating too much is safe; too little is not.
+
+        Args:
+            background: Invalidate in a background thread and do not wait for it.
+                Use wait_invalidated() on read-after-write paths that need to see the invalidation.
+        """
+        # Nested: join the outer unit of work
+        queue = self._invalidation_queue.get()
+        if queue is not None:
+            yield queue
+            return
+
+        queue = InvalidationQueue()
+        token = self._invalidation_queue.set(queue)
+        try:
+            yield queue
+        finally:
+            self._invalidation_queue.reset(token)
+
+            if queue:
+                dependencies = list(queue.dependencies.values())
+                if background:
+                    self._background_invalidator.submit(self.invalidate, *dependencies)
+                else:
+                    self.invalidate(*dependencies)
+
+    def wait_invalidated(self, timeout: Optional[float] = None) -> bool:
+        """ Wait until all background invalidations are done
+
+        Args:
+            timeout: The number of seconds to wait for. Default: forever
+        Returns:
+            True if everything was invalidated, False on timeout
+        """
+        return self._background_invalidator.wait(timeout)
 
     log_enabled: bool = False
 
@@ -108,3 +467,7 @@ class MatroskaCache:
         """ Buff: +7 to your debugging skills """
         self.log_enabled = enabled
         self.backend.log_enabled = enabled
+
+
+# Marker for missing values
+_MISSING = object()
@@ -4,8 +4,15 @@ from .id import Id
 from .tag import Tag
 from .ntag import NTag
 from .scopes import Scopes
+from .ranges import Range, In, NumericBuckets, DateBuckets
+from .cache_key import CacheKey
+from .raw_key import RawKey
 
-try:
-    from .primary_key import PrimaryKey
-except ImportError as e:
-    pass
+
+def __getattr__(name: str):
+    """ Lazy attributes: PrimaryKey imports SqlAlchemy, so only do it when used """
+    if name == 'PrimaryKey':
+        from .primary_key import PrimaryKey
+        return PrimaryKey
+    else:
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
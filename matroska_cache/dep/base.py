@@ -1,11 +1,20 @@
 from abc import ABC, abstractmethod
 from dataclasses import dataclass
+from typing import Dict, Tuple
 
 
-@dataclass
+@dataclass(eq=False)
 class DependencyBase(ABC):
-    # Performance
-    __slots__ = ()
+    """ Base for dependencies
+
+    Their key is computed once, and they're compared and hashed by it.
+    Two dependencies with the same key are the same dependency: Id('article', 1) == Id('article', '1') == RawKey('id:article:1')
+    Setting a field drops the cached keys. Don't modify a dependency that's in a set or a dict, though: its hash changes.
+
+    Subclasses: use @dataclass(eq=False) to keep key-based comparison
+    """
+    # Performance. Caches for key() and prefixed_key()
+    __slots__ = '_cached_key', '_cached_prefixed_key'
 
     # key() prefix. Used for overrides in subclasses
     PREFIX = '?'
@@ -13,3 +22,73 @@ class DependencyBase(ABC):
     @abstractmethod
     def key(self) -> str:
         """ Get string representation of this dependency """
+
+    def cached_key(self) -> str:
+        """ Get key(), computed only once """
+        try:
+            key = self._cached_key
+        except AttributeError:
+            key = None
+        if key is None:
+            self._cached_key = key = self.key()
+        return key
+
+    def prefixed_key(self, prefix: str) -> str:
+        """ Get `prefix + key()`: the name a backend stores it under. Computed once for the last prefix used """
+        try:
+            cached = self._cached_prefixed_key
+        except AttributeError:
+            cached = None
+        if cached is not None and cached[0] == prefix:
+            return cached[1]
+
+        key = prefix + self.cached_key()
+        self._cached_prefixed_key = (prefix, key)
+        return key
+
+    def __setattr__(self, name, value):
+        object.__setattr__(self, name, value)
+
+        # A field has changed: cached keys are stale
+        if name not in _CACHES:
+            object.__setattr__(self, '_cached_key', None)
+            object.__setattr__(self, '_cached_prefixed_key', None)
+
+    @classmethod
+    def interned(cls, *args):
+        """ Get a shared instance of a frequently used dependency, with its key already computed
+
+        Example:
+            dep.Tag.interned('homepage')
+        """
+        try:
+            return _interned[cls, args]
+        except KeyError:
+            pass
+
+        # Don't let it grow forever
+        if len(_interned) >= INTERN_MAX_SIZE:
+            _interned.clear()
+
+        dependency = cls(*args)
+        dependency.cached_key()
+        _interned[cls, args] = dependency
+        return dependency
+
+    def __eq__(self, other):
+        if not isinstance(other, DependencyBase):
+            return NotImplemented
+        return self.cached_key() == other.cached_key()
+
+    def __hash__(self):
+        return hash(self.cached_key())
+
+
+# Attributes that cache the key
+_CACHES = frozenset(DependencyBase.__slots__)
+
+# The max number of interned dependencies. The table is dropped when full.
+INTERN_MAX_SIZE = 10000
+
+# { (class, args) => dependency }
+_interned: Dict[Tuple[type, tuple], DependencyBase] = {}
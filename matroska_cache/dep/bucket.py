@@ -0,0 +1,103 @@
+import zlib
+from typing import Dict, Iterable, List, Tuple, Union
+
+from .base import DependencyBase, dataclass
+from .id import Id
+
+
+@dataclass(eq=False)
+class IdBucket(DependencyBase):
+    """ A coarse dependency that stands for many `Id`s of the same type
+
+    Generated by `Coarsening`; you don't normally use it directly.
+
+    Example:
+        IdBucket('pk', 'Article', 17)
+        # -> 'pk:Article:bucket:17'
+    """
+    prefix: str
+    type: str
+    bucket: int
+    __slots__ = 'prefix', 'type', 'bucket'
+
+    PREFIX = 'bucket'
+
+    def key(self) -> str:
+        return f'{self.prefix}:{self.type}:{self.PREFIX}:{self.bucket}'
+
+
+class Coarsening:
+    """ Collapse huge lists of `Id` dependencies into buckets
+
+    Caching a 10k-row listing yields 10k `Id` dependencies: 10k SADDs on every put, and the entry sits in 10k rdep sets.
+    With coarsening, when an entry has more than `threshold` `Id`s of the same type, they're replaced with buckets,
+    and invalidating an `Id` invalidates its bucket as well.
+
+    This trades a little over-invalidation for large savings on writes and memory.
+
+    Example:
+        cache.coarsening = Coarsening(threshold=100, buckets=256)
+
+    Two bucketing schemes are supported:
+    * hash buckets (default): `crc32(id) % buckets`. Good for any kind of ids.
+    * range buckets (`range_size=1000`): `id // range_size`. Good for integer ids listed in order:
+      a listing of 1000 sequential ids goes into 1 or 2 buckets. Non-integer ids fall back to hash buckets.
+
+    NOTE: all processes have to use the same configuration, otherwise invalidation won't find the buckets!
+    """
+
+    def __init__(self, threshold: int = 100, *, buckets: int = 1024, range_size: int = None):
+        """
+        Args:
+            threshold: Coarsen when an entry has more than that many `Id`s of the same type
+            buckets: The number of hash buckets per type
+            range_size: Use range buckets of this size for integer ids
+        """
+        self.threshold = threshold
+        self.buckets = buckets
+        self.range_size = range_size
+
+    def bucket_for(self, dependency: Id) -> IdBucket:
+        """ Get the bucket an `Id` dependency falls into """
+        id = dependency.id
+        if self.range_size and (isinstance(id, int) or (isinstance(id, str) and id.isdigit())):
+            bucket = int(id) // self.range_size
+        else:
+            bucket = zlib.crc32(str(id).encode()) % self.buckets
+        return IdBucket(dependency.PREFIX, dependency.type, bucket)
+
+    def coarsen(self, dependencies: Iterable[DependencyBase]) -> List[DependencyBase]:
+        """ Replace large groups of `Id`s with buckets. Use it on put() """
+        dependencies = list(dependencies)
+
+        # Group Ids by type
+        groups: Dict[Tuple[str, str], List[Id]] = {}
+        for dependency in dependencies:
+            if isinstance(dependency, Id):
+                groups.setdefault((dependency.PREFIX, dependency.type), []).append(dependency)
+
+        # Large groups get coarsened
+        coarsened = {group for group, ids in groups.items() if len(ids) > self.threshold}
+        if not coarsened:
+            return dependencies
+
+        ret: List[DependencyBase] = []
+        seen_buckets = set()
+        for dependency in dependencies:
+            if isinstance(dependency, Id) and (dependency.PREFIX, dependency.type) in coarsened:
+                bucket = self.bucket_for(dependency)
+                if bucket.key() not in seen_buckets:
+                    seen_buckets.add(bucket.key())
+                    ret.append(bucket)
+            else:
+                ret.append(dependency)
+        return ret
+
+    def expand(self, dependencies: Iterable[DependencyBase]) -> List[Union[DependencyBase, IdBucket]]:
+        """ Add buckets for every `Id`. Use it on invalidate() """
+        dependencies = list(dependencies)
+        return dependencies + [
+            self.bucket_for(dependency)
+            for dependency in dependencies
+            if isinstance(dependency, Id)
+        ]
@@ -0,0 +1,35 @@
+from .base import DependencyBase, dataclass
+
+
+@dataclass(eq=False)
+class CacheKey(DependencyBase):
+    """ Dependency on another cache entry: for nested cache entries
+
+    Usage:
+        when the cached data is built from other cached fragments, depend on their keys
+        instead of repeating every dependency of every fragment
+
+    Example:
+        cache.put('article-1', render_article(1), dep.Id('article', 1), ...)
+        cache.put('article-2', render_article(2), dep.Id('article', 2), ...)
+
+        cache.put(
+            'articles-page',
+            [...],
+            dep.CacheKey('article-1'),
+            dep.CacheKey('article-2'),
+        )
+
+        # Invalidated or deleted, the inner entry takes the outer one down with it
+        cache.invalidate(dep.Id('article', 1))
+        cache.has('articles-page')  # -> False
+
+    Invalidation cascades transitively, and cycles are safe.
+    """
+    name: str
+    __slots__ = 'name',
+
+    PREFIX = 'key'
+
+    def key(self) -> str:
+        return f'{self.PREFIX}:{self.name}'
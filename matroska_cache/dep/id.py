@@ -1,9 +1,9 @@
-from typing import Union
+from typing import Iterable, List, Union
 
 from .base import DependencyBase, dataclass
 
 
-@dataclass
+@dataclass(eq=False)
 class Id(DependencyBase):
     """ Dependency on an id of some object
 
@@ -26,6 +26,9 @@ class Id(DependencyBase):
         cache.invalidate(
             Id('article', 1)
         )
+
+        # Many at once
+        cache.put('articles-list', [...], *Id.many('article', article_ids))
     """
     type: str
     id: Union[int, str]
@@ -35,3 +38,23 @@ class Id(DependencyBase):
 
     def key(self) -> str:
         return f'{self.PREFIX}:{self.type}:{self.id}'
+
+    @classmethod
+    def many(cls, type: str, ids: Iterable[Union[int, str]]) -> List['Id']:
+        """ Make dependencies on many ids of the same type, with their keys precomputed
+
+        Faster than calling Id() in a loop: skips __init__() and shares the key prefix
+        """
+        prefix = f'{cls.PREFIX}:{type}:'
+        new = object.__new__
+        # Bypass __setattr__: the key is set right away
+        set_field = object.__setattr__
+
+        ret = []
+        for id in ids:
+            dependency = new(cls)
+            set_field(dependency, 'type', type)
+            set_field(dependency, 'id', id)
+            set_field(dependency, '_cached_key', f'{prefix}{id}')
+            ret.append(dependency)
+        return ret
@@ -1,7 +1,7 @@
 from .tag import Tag, dataclass
 
 
-@dataclass
+@dataclass(eq=False)
 class NTag(Tag):
     """ Namespaced tag that uses its class name as the prefix.
 
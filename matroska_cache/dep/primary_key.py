@@ -1,4 +1,4 @@
-from typing import Tuple, Any, Union
+from typing import Tuple, Any, Union, Iterable, List
 
 from sqlalchemy.orm.base import instance_state
 from sqlalchemy.orm.state import InstanceState
@@ -6,7 +6,7 @@ from sqlalchemy.orm.state import InstanceState
 from .id import Id, dataclass
 
 
-@dataclass()
+@dataclass(eq=False)
 class PrimaryKey(Id):
     """ Dependency on a primary key of an instance
 
@@ -38,13 +38,33 @@ class PrimaryKey(Id):
             model = model.__name__
         super().__init__(model, identity)
 
+    @classmethod
+    def many(cls, model: Union[str, type], ids: Iterable[Union[str, int]]) -> List['PrimaryKey']:
+        if isinstance(model, type):
+            model = model.__name__
+        return super().many(model, ids)
+
     @classmethod
     def from_instance(cls, instance: object):
-        state: InstanceState = instance_state(instance)
-        return cls(
-            state.class_.__name__,
-            cls._instance_identity_to_str(state.identity)
-        )
+        return cls.from_state(instance_state(instance))
+
+    @classmethod
+    def from_instances(cls, instances: Iterable[object]) -> List['PrimaryKey']:
+        """ Make dependencies on many instances at once """
+        return [cls.from_state(instance_state(instance)) for instance in instances]
+
+    @classmethod
+    def from_state(cls, state: InstanceState):
+        """ Make a dependency from an instance state, with its key precomputed """
+        model = state.class_.__name__
+        id = cls._instance_identity_to_str(state.identity)
+
+        # Bypass __setattr__: the key is set right away
+        dependency = object.__new__(cls)
+        object.__setattr__(dependency, 'type', model)
+        object.__setattr__(dependency, 'id', id)
+        object.__setattr__(dependency, '_cached_key', f'{cls.PREFIX}:{model}:{id}')
+        return dependency
 
     @classmethod
     def _instance_identity_to_str(cls, identity: Tuple[Any]) -> str:
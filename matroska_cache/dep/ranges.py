@@ -0,0 +1,104 @@
+""" Range and set-membership conditions for `Scopes`
+
+Equality conditions map to one dependency each: `condition(category='python')`.
+Ranges can't be enumerated, so fields filtered by ranges are split into buckets:
+
+    article_scopes = Scopes('article', production_mode=False, buckets={
+        'price': NumericBuckets(step=100),
+        'created': DateBuckets(step=timedelta(days=1)),
+    })
+
+    @article_scopes.describes('status', 'price')
+    def article_status_price(article: Article):
+        return {'status': article.status, 'price': article.price}
+
+    # A listing depends on every bucket its range overlaps, and on every value of the IN list:
+    cache.put('articles', ..., *article_scopes.condition(status=In('draft', 'published'), price=Range(150, 420)), expires=600)
+    # -> 'status=draft' and 'status=published' x 'price=#1' .. 'price=#4'
+
+    # An object invalidates the bucket it falls into
+    article_scopes.invalidate_for(article, cache, previous=old_article)
+
+A range that spans too many buckets, or is open-ended, uses a wildcard: it is invalidated by any value of the field.
+"""
+import math
+from abc import ABC, abstractmethod
+from datetime import date, datetime, timedelta, timezone
+from typing import Any, List, Optional
+
+
+class Range:
+    """ A condition value: `low <= value <= high`. Either bound may be None: open-ended """
+    __slots__ = 'low', 'high'
+
+    def __init__(self, low: Any = None, high: Any = None):
+        self.low = low
+        self.high = high
+
+    def __repr__(self):
+        return f'Range({self.low!r}, {self.high!r})'
+
+
+class In:
+    """ A condition value: `value IN (...)` """
+    __slots__ = 'values',
+
+    def __init__(self, *values: Any):
+        self.values = values
+
+    def __repr__(self):
+        return f'In{self.values!r}'
+
+
+class BucketScheme(ABC):
+    """ How to split the values of a field into buckets """
+
+    # Ranges that span more buckets than that use the wildcard
+    max_buckets: int
+
+    @abstractmethod
+    def bucket(self, value: Any) -> int:
+        """ Get the bucket a value falls into """
+
+    def buckets(self, value: Range) -> Optional[List[int]]:
+        """ Get the buckets a range overlaps. None if there are too many of them, or the range is open-ended """
+        if value.low is None or value.high is None:
+            return None
+
+        low, high = self.bucket(value.low), self.bucket(value.high)
+        if high - low + 1 > self.max_buckets:
+            return None
+        return list(range(low, high + 1))
+
+
+class NumericBuckets(BucketScheme):
+    """ Buckets for numbers: [origin, origin + step), [origin + step, origin + 2*step), ... """
+
+    def __init__(self, step: float, *, origin: float = 0, max_buckets: int = 100):
+        self.step = step
+        self.origin = origin
+        self.max_buckets = max_buckets
+
+    def bucket(self, value: float) -> int:
+        return math.floor((value - self.origin) / self.step)
+
+
+class DateBuckets(BucketScheme):
+    """ Buckets for dates and datetimes: `step` long, starting at the epoch
+
+    Naive datetimes are taken as is; aware ones are converted to UTC first.
+    """
+
+    def __init__(self, step: timedelta = timedelta(days=1), *, max_buckets: int = 100):
+        self.step = step
+        self.max_buckets = max_buckets
+
+    def bucket(self, value: date) -> int:
+        if not isinstance(value, datetime):
+            value = datetime(value.year, value.month, value.day)
+        elif value.tzinfo is not None:
+            value = value.astimezone(timezone.utc).replace(tzinfo=None)
+        return (value - _EPOCH) // self.step
+
+
+_EPOCH = datetime(1970, 1, 1)
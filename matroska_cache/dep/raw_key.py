@@ -0,0 +1,19 @@
+from .base import DependencyBase, dataclass
+
+
+@dataclass(eq=False)
+class RawKey(DependencyBase):
+    """ Dependency given by its key(): when only the key is known
+
+    Usage:
+        invalidate dependencies received from another process, e.g. from an invalidation stream
+
+    Example:
+        key = dep.Id('article', 1).key()  # 'id:article:1'
+        cache.invalidate(dep.RawKey(key))  # same as invalidate(dep.Id('article', 1))
+    """
+    dependency_key: str
+    __slots__ = 'dependency_key',
+
+    def key(self) -> str:
+        return self.dependency_key
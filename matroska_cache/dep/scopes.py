@@ -1,13 +1,17 @@
 from __future__ import annotations
 
+import itertools
+import time
 import warnings
-from typing import Any, List, Callable, Tuple, Union, Collection, FrozenSet, Optional, Iterable, Set
+from typing import Any, List, Callable, Tuple, Union, Collection, FrozenSet, Optional, Iterable, Set, Mapping, Dict
 
 from .base import DependencyBase, dataclass
+from .ranges import BucketScheme, Range, In
 from .tag import Tag
 
 
 ExtractorFunc = Callable[[Any], Optional[dict]]
+FallbackHook = Callable[['FallbackEvent'], None]
 
 
 class Scopes:
@@ -83,8 +87,27 @@ class Scopes:
 
     This approach with `Scopes()` is a declarative approach:
     you first declare *the intention* of caching by category, and `Scopes()` will check that everything is set up properly.
+
+    ---
+
+    Ranges and IN lists: condition(status=In('draft', 'published'), price=Range(100, 500)).
+    Fields filtered by ranges need a bucketing scheme: see `matroska_cache.dep.ranges`.
+
+    ---
+
+    Fallbacks. In production mode, errors do not raise. Instead:
+    * An extractor that fails, or returns the wrong fields, invalidates every scope of its own signature:
+      e.g. all `condition(category=...)`, but not `condition(author=...)`.
+      To avoid a cache-miss storm, that happens at most once per `fallback_interval` per signature;
+      in between, those scopes may be stale.
+    * An entry with an undeclared signature, or a range on a field with no buckets, is invalidated by every change.
+    Every fallback is reported to `on_fallback`: use it for metrics.
+    The global InvalidateAll kill switch is still there: invalidate it to wipe every scope of the type.
     """
-    def __init__(self, object_type: str, *, production_mode: bool):
+    def __init__(self, object_type: str, *, production_mode: bool, buckets: Mapping[str, BucketScheme] = None,
+                 on_fallback: FallbackHook = None,
+                 fallback_interval: float = 60.0,
+                 ):
         """ Initialize scopes for a particular kind of object
 
         Args:
@@ -92,8 +115,12 @@ class Scopes:
             production_mode: Whether the cache is currently operating on a production server.
                 If there is an error with how you configured the `Scopes` object, its will be disabled.
                 In development (production_mode=False), an exception will be raised.
+            buckets: Bucketing schemes for fields that are filtered by ranges: { field name => scheme }
+            on_fallback: The function to report every fallback to. Default: issue a warning
+            fallback_interval: Invalidate all scopes of a failing signature at most once per that many seconds
         """
         self._object_type = object_type
+        self._buckets: Dict[str, BucketScheme] = dict(buckets or {})
         self._extractor_fns: List[ExtractorInfo] = []
         self._known_extractor_signatures: Set[Tuple[str]] = set()
 
@@ -104,6 +131,11 @@ class Scopes:
         self._invalidate_all = InvalidateAll(self._object_type)
         self._production_mode = production_mode
 
+        # Fallbacks: per-signature invalidation, rate-limited
+        self._on_fallback = on_fallback or self._warn_fallback
+        self._fallback_interval = fallback_interval
+        self._fallback_at: Dict[Tuple[str, ...], float] = {}
+
     def describes(self, *param_names, watch_modified: Optional[Iterable[str]] = None):
         """ Decorator for a function that extracts data for a conditional dependency.
 
@@ -157,16 +189,21 @@ class Scopes:
             return fn
         return decorator
 
-    def invalidate_for(self, item: Any, cache: 'MatroskaCache', modified: Collection[str] = None, **info):
+    def watched_names(self) -> FrozenSet[str]:
+        """ Get the names of all attributes the extractor functions watch """
+        return frozenset().union(*(extractor_info.watch_modified for extractor_info in self._extractor_fns))
+
+    def invalidate_for(self, item: Any, cache: 'MatroskaCache', modified: Collection[str] = None, *, previous: Any = None, **info):
         """ Invalidate all caches that may see `item` in their listings.
 
         Args:
             item: The new/deleted item that may enter or leave the scope of some listing
             cache: MatroskaCache to invalidate
             modified: (optional) list of field names that have been modified. Useful to ignore non-relevant updates.
+            previous: (optional) the item before the change: it may leave the scopes it was in
             **info: Extra info that may be passed to your extractor functions
         """
-        cache.invalidate(*self.object_invalidates(item, modified, **info))
+        cache.invalidate(*self.object_invalidates(item, modified, previous=previous, **info))
 
     def condition(self, **conditions: Any) -> List[Union[ConditionalDependency, InvalidateAll]]:
         """ Get dependencies for a conditional scope.
@@ -175,6 +212,7 @@ class Scopes:
 
         Args:
             **conditions: The description of your filtering conditions, in the `name=value` form.
+                Values may also be `Range(low, high)` (for fields with buckets), and `In(value, ...)`.
 
         Returns:
             List of scope dependencies to be used on your cache entry
@@ -183,17 +221,23 @@ class Scopes:
         filter_params_signature = tuple(sorted(conditions))
 
         if filter_params_signature in self._known_extractor_signatures:
+            # Ranges & IN lists: one dependency for every combination of values
+            try:
+                values = [self._condition_values(name, value) for name, value in conditions.items()]
+            except ValueError as e:
+                if self._production_mode:
+                    return self._undeclared_fallback(filter_params_signature, 'bad-condition', e)
+                raise RuntimeError(str(e)) from e
+
             return [
-                ConditionalDependency(self._object_type, conditions),
-                # Got to declare this kill switch as a dependency; otherwise, it won't work.
+                *(ConditionalDependency(self._object_type, dict(zip(conditions, combination)))
+                  for combination in itertools.product(*values)),
+                # Got to declare these kill switches as dependencies; otherwise, they won't work.
+                SignatureFallback(self._object_type, filter_params_signature),
                 self._invalidate_all,
             ]
         elif self._production_mode:
-            warnings.warn(
-                f'Matroska cache: no extractor @describes for {filter_params_signature!r}. '
-                f'Caching disabled. '
-            )
-            return [self._invalidate_all]
+            return self._undeclared_fallback(filter_params_signature, 'undeclared-signature', None)
         else:
             raise RuntimeError(
                 f'No extractor function is described for condition {filter_params_signature!r}. '
@@ -201,7 +245,7 @@ class Scopes:
                 f'It will not fail in production, but caching will be disabled.'
             )
 
-    def object_invalidates(self, item: Any, modified: Collection[str] = None, **info) -> List[Union[ConditionalDependency, InvalidateAll]]:
+    def object_invalidates(self, item: Any, modified: Collection[str] = None, *, previous: Any = None, **info) -> List[Union[ConditionalDependency, InvalidateAll]]:
         """ Get dependencies that will invalidate all caches that may see `item` in their listings.
 
         This function takes the `item` and calls every extractor function decorated by `@scope.describes()`.
@@ -212,11 +256,26 @@ class Scopes:
             modified: (optional) list of field names that have been modified. Useful to ignore non-relevant updates.
                 If not provided, all extractor functions will be run to invalidate dependencies.
                 If provided, only those that are watching those attributes will be run.
+            previous: (optional) The item before the change. Scopes that it leaves are invalidated as well:
+                e.g. an article whose price has changed from 150 to 900 leaves the bucket of 150.
             **info: Additional arguments to pass to *all* the extractor functions.
 
         Returns:
             List of dependencies to be used with `cache.invalidate()`
         """
+        ret = self._object_invalidates(item, modified, **info)
+        if previous is not None:
+            ret += self._object_invalidates(previous, modified, **info)
+
+        # Entries that could not be described are invalidated by every change
+        if self._production_mode:
+            ret.append(SignatureFallback(self._object_type, UNDECLARED))
+
+        # Unique
+        return list({dependency.key(): dependency for dependency in ret}.values())
+
+    def _object_invalidates(self, item: Any, modified: Collection[str] = None, **info) -> List[Union[ConditionalDependency, InvalidateAll]]:
+        """ object_invalidates() for one item """
         if modified:
             modified = set(modified)
 
@@ -229,10 +288,11 @@ class Scopes:
             # Run the extractor function and get dependency parameters
             try:
                 params = extractor_info.func(item, **info)
-            except Exception:
-                # In production mode, just invalidate all
+            except Exception as e:
+                # In production mode, invalidate every scope of this signature
                 if self._production_mode:
-                    return [self._invalidate_all]
+                    ret.extend(self._signature_fallback(extractor_info, 'extractor-error', e))
+                    continue
                 # In development mode, report the error
                 else:
                     raise
@@ -242,10 +302,14 @@ class Scopes:
                 continue
             # If it returned a correct set of fields (as @describes()ed), generate a dependency
             elif set(params) == extractor_info.param_names:
-                ret.append(ConditionalDependency(self._object_type, params))
-            # In production mode, just invalidate all
+                values = [self._object_values(name, value) for name, value in params.items()]
+                ret.extend(
+                    ConditionalDependency(self._object_type, dict(zip(params, combination)))
+                    for combination in itertools.product(*values)
+                )
+            # In production mode, invalidate every scope of this signature
             elif self._production_mode:
-                return [self._invalidate_all]
+                ret.extend(self._signature_fallback(extractor_info, 'bad-return', None))
             # In development mode, report an error
             else:
                 raise RuntimeError(
@@ -255,8 +319,66 @@ class Scopes:
                 )
         return ret
 
+    def _signature_fallback(self, extractor_info: ExtractorInfo, reason: str, error: Optional[Exception]) -> List[SignatureFallback]:
+        """ An extractor has failed: invalidate every scope of its signature. Rate-limited """
+        signature = tuple(sorted(extractor_info.param_names))
 
-@dataclass
+        now = time.monotonic()
+        suppressed = now - self._fallback_at.get(signature, -self._fallback_interval) < self._fallback_interval
+        if not suppressed:
+            self._fallback_at[signature] = now
+
+        self._on_fallback(FallbackEvent(self._object_type, signature, reason, error, suppressed))
+        return [] if suppressed else [SignatureFallback(self._object_type, signature)]
+
+    def _undeclared_fallback(self, signature: Tuple[str, ...], reason: str, error: Optional[Exception]) -> List[SignatureFallback]:
+        """ An entry can't be described: make it depend on every change """
+        self._on_fallback(FallbackEvent(self._object_type, signature, reason, error, False))
+        return [SignatureFallback(self._object_type, UNDECLARED), self._invalidate_all]
+
+    @staticmethod
+    def _warn_fallback(event: 'FallbackEvent'):
+        if not event.suppressed:
+            warnings.warn(f'Matroska cache: {event.object_type} scopes {event.signature!r} fall back: {event.reason} {event.error or ""}')
+
+    def _condition_values(self, name: str, value: Any) -> List[Any]:
+        """ Expand a condition value into the values to depend on
+
+        Raises:
+            ValueError: a range on a field with no buckets
+        """
+        scheme = self._buckets.get(name)
+        if isinstance(value, In):
+            return list(dict.fromkeys(v for item in value.values for v in self._condition_values(name, item)))
+        elif scheme is None:
+            if isinstance(value, Range):
+                raise ValueError(f'Condition {name!r} is a range, but there are no buckets for it')
+            return [value]
+        elif isinstance(value, Range):
+            buckets = scheme.buckets(value)
+            # Too many buckets, or open-ended: any value will do
+            return [WILDCARD] if buckets is None else [f'#{bucket}' for bucket in buckets]
+        elif value is None:
+            return [None]
+        else:
+            return [f'#{scheme.bucket(value)}']
+
+    def _object_values(self, name: str, value: Any) -> List[Any]:
+        """ Get the values of an object's field to invalidate """
+        scheme = self._buckets.get(name)
+        if scheme is None:
+            return [value]
+        elif value is None:
+            return [None, WILDCARD]
+        else:
+            return [f'#{scheme.bucket(value)}', WILDCARD]
+
+
+# The value of a bucketed field that matches any value: used for wide and open-ended ranges
+WILDCARD = '*'
+
+
+@dataclass(eq=False)
 class ConditionalDependency(DependencyBase):
     """ Internal dependency used by Scope
 
@@ -329,3 +451,32 @@ class InvalidateAll(Tag):
 
     def __init__(self, object_type: str):
         super().__init__(f'{object_type}::InvalidateAll')
+
+
+class SignatureFallback(Tag):
+    """ A custom tag, used in production, to invalidate all scopes of one signature when its extractor fails """
+
+    PREFIX = ConditionalDependency.PREFIX
+
+    def __init__(self, object_type: str, signature: Tuple[str, ...]):
+        super().__init__(f'{object_type}::fallback:' + '&'.join(signature))
+
+
+# The signature for entries that can't be described: invalidated by every change
+UNDECLARED = ('?',)
+
+
+@dataclass
+class FallbackEvent:
+    """ A fallback in production mode: report it to your metrics """
+    object_type: str
+    # The signature of scopes that are affected
+    signature: Tuple[str, ...]
+    # 'extractor-error', 'bad-return', 'undeclared-signature', 'bad-condition'
+    reason: str
+    # The exception, if any
+    error: Optional[Exception]
+    # Rate-limited: the scopes were not invalidated this time
+    suppressed: bool
+
+    __slots__ = 'object_type', 'signature', 'reason', 'error', 'suppressed'
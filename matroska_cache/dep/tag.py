@@ -1,7 +1,7 @@
 from .base import DependencyBase, dataclass
 
 
-@dataclass
+@dataclass(eq=False)
 class Tag(DependencyBase):
     """ Dependency on an arbitrary tag
 
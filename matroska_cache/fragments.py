@@ -0,0 +1,79 @@
+""" Fragments: cached values that reference other cached values
+
+A dashboard is assembled from fragments, each of which is cached separately.
+Instead of reading them one by one, put references into the parent entry:
+
+    cache.put('widget-1', {...}, ..., expires=600)
+    cache.put('widget-2', {...}, ..., expires=600)
+    cache.put('dashboard', {
+        'title': 'Dashboard',
+        'widgets': [fragment('widget-1'), fragment('widget-2')],
+    }, dep.CacheKey('widget-1'), dep.CacheKey('widget-2'), expires=600)
+
+and get the whole tree with one round-trip per level of nesting:
+
+    tree = cache.get_tree('dashboard')
+    tree.value  # -> {'title': 'Dashboard', 'widgets': [{...}, {...}]}
+    tree.missing  # -> set(): fragments that were not in cache. Recompute only those.
+
+Missing fragments are left in place as references.
+"""
+from dataclasses import dataclass
+from typing import Any, Dict, Iterator, Set
+
+# The reference marker: {'$fragment': key}
+FRAGMENT_REF = '$fragment'
+
+
+def fragment(key: str) -> dict:
+    """ Make a reference to another cached fragment. Put it into your cached data """
+    return {FRAGMENT_REF: key}
+
+
+def fragment_key(value: Any) -> str:
+    """ Get the key of a fragment reference, or None if `value` is not one """
+    if isinstance(value, dict) and len(value) == 1 and FRAGMENT_REF in value:
+        return value[FRAGMENT_REF]
+    return None
+
+
+@dataclass
+class FragmentTree:
+    """ The result of get_tree() """
+    # The assembled value
+    value: Any
+    # Keys of fragments that were not in cache
+    missing: Set[str]
+
+    __slots__ = 'value', 'missing'
+
+
+def find_fragments(value: Any) -> Iterator[str]:
+    """ Find fragment references within `value` """
+    key = fragment_key(value)
+    if key is not None:
+        yield key
+    elif isinstance(value, dict):
+        for item in value.values():
+            yield from find_fragments(item)
+    elif isinstance(value, list):
+        for item in value:
+            yield from find_fragments(item)
+
+
+def assemble(value: Any, fragments: Dict[str, Any], _path: frozenset = frozenset()) -> Any:
+    """ Replace fragment references within `value` with fragments
+
+    References to missing fragments, and references that make a cycle, are left as is.
+    """
+    key = fragment_key(value)
+    if key is not None:
+        if key in fragments and key not in _path:
+            return assemble(fragments[key], fragments, _path | {key})
+        return value
+    elif isinstance(value, dict):
+        return {k: assemble(v, fragments, _path) for k, v in value.items()}
+    elif isinstance(value, list):
+        return [assemble(v, fragments, _path) for v in value]
+    else:
+        return value
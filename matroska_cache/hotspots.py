@@ -0,0 +1,204 @@
+""" Hot-spot tracking: find hot keys and heavy dependencies before they saturate Redis
+
+Cheap enough to leave on in production: every operation costs a few hash computations, and memory is fixed.
+
+Example:
+    cache.hotspots = HotspotTracker(k=20, dump_interval=60)
+
+    cache.hotspots.top('get')         # -> [('articles-list', 1200), ...]: hot keys
+    cache.hotspots.top('put')         # -> [('tag:homepage', 300), ...]: dependencies that are put() most often
+    cache.hotspots.top('invalidate')  # -> [('id:article:1', 80), ...]: dependencies that are invalidated most often
+
+With `hot_threshold` and `local_ttl`, hot keys are also cached in-process for a short while:
+
+    cache.hotspots = HotspotTracker(hot_threshold=1000, local_ttl=1.0)
+
+NOTE: the in-process cache only sees invalidations made by this process. Others are only noticed after `local_ttl`.
+NOTE: values from the in-process cache are shared: don't modify them!
+"""
+import logging
+import threading
+import time
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+from .sketch import CountMinSketch
+
+logger = logging.getLogger(__name__)
+
+
+class TopK:
+    """ Heavy hitters: a count-min sketch counts everything, and `k` top candidates are remembered """
+
+    def __init__(self, k: int = 20, sketch: CountMinSketch = None):
+        self.k = k
+        self.sketch = sketch or CountMinSketch()
+        self._candidates: Dict[str, int] = {}
+        # The weakest candidate, once there are `k` of them: a new key has to beat it
+        self._min_key: Optional[str] = None
+        self._min_count = 0
+
+    def add(self, key: str) -> int:
+        """ Count `key`; return its estimated count """
+        count = self.sketch.add(key)
+        candidates = self._candidates
+
+        if key in candidates:
+            candidates[key] = count
+            # The weakest one got stronger: find the new weakest
+            if key == self._min_key:
+                self._find_min()
+        elif len(candidates) < self.k:
+            candidates[key] = count
+            if len(candidates) == self.k:
+                self._find_min()
+        elif count > self._min_count:
+            # Replace the weakest candidate
+            del candidates[self._min_key]
+            candidates[key] = count
+            self._find_min()
+        return count
+
+    def estimate(self, key: str) -> int:
+        return self.sketch.estimate(key)
+
+    def top(self, n: int = None) -> List[Tuple[str, int]]:
+        """ Get the top `n` keys with their counts """
+        return sorted(self._candidates.items(), key=lambda item: item[1], reverse=True)[:n]
+
+    def decay(self):
+        """ Halve all counts """
+        self.sketch.decay()
+        self._candidates = {key: count >> 1 for key, count in self._candidates.items()}
+        # Halving keeps the order: the weakest one stays the weakest
+        if self._min_key is not None:
+            self._min_count = self._candidates[self._min_key]
+
+    def _find_min(self):
+        self._min_key = min(self._candidates, key=self._candidates.__getitem__)
+        self._min_count = self._candidates[self._min_key]
+
+
+class HotspotTracker:
+    """ Per-process tracker of hot keys and heavy dependencies """
+
+    # What's tracked: get() keys, put() dependencies, invalidate() dependencies
+    CHANNELS = ('get', 'put', 'invalidate')
+
+    def __init__(self, k: int = 20, *,
+                 width: int = 4096,
+                 decay_interval: float = 60.0,
+                 dump_interval: Optional[float] = None,
+                 on_dump: Callable[[Dict[str, List[Tuple[str, int]]]], None] = None,
+                 hot_threshold: Optional[int] = None,
+                 local_ttl: Optional[float] = None,
+                 local_max_size: int = 1000,
+                 ):
+        """
+        Args:
+            k: The number of top offenders to keep per channel
+            width: Count-min sketch width
+            decay_interval: Halve all counts every that many seconds, so that only recent activity matters
+            dump_interval: Report top offenders every that many seconds
+            on_dump: The function to report top offenders to. Default: log them
+            hot_threshold: A get() key with that many (decayed) hits is hot
+            local_ttl: Cache hot keys in-process for that many seconds
+            local_max_size: Max number of keys in the in-process cache
+        """
+        self._channels = {channel: TopK(k, CountMinSketch(width)) for channel in self.CHANNELS}
+        self._decay_interval = decay_interval
+        self._decayed_at = time.monotonic()
+        self._dump_interval = dump_interval
+        self._dumped_at = time.monotonic()
+        self._on_dump = on_dump or self._log_dump
+        # Every channel has its own lock: get(), put(), invalidate() don't wait for each other.
+        # The maintenance lock is taken before channel locks, never after
+        self._channel_locks = {channel: threading.Lock() for channel in self.CHANNELS}
+        self._lock = threading.Lock()
+
+        # In-process cache for hot keys
+        self.hot_threshold = hot_threshold
+        self.local = LocalCache(local_ttl, local_max_size) if hot_threshold and local_ttl else None
+
+    def record(self, channel: str, keys: Iterable[str]):
+        """ Count `keys` in a channel """
+        topk = self._channels[channel]
+        with self._channel_locks[channel]:
+            for key in keys:
+                topk.add(key)
+
+        # Time-based maintenance
+        now = time.monotonic()
+        if now - self._decayed_at > self._decay_interval or self._dump_due(now):
+            dump = None
+            with self._lock:
+                if now - self._decayed_at > self._decay_interval:
+                    self._decayed_at = now
+                    for channel, topk in self._channels.items():
+                        with self._channel_locks[channel]:
+                            topk.decay()
+                if self._dump_due(now):
+                    self._dumped_at = now
+                    dump = self.dump()
+
+            # Report outside of the lock: a slow `on_dump` must not stall the cache
+            if dump is not None:
+                self._on_dump(dump)
+
+    def top(self, channel: str, n: int = None) -> List[Tuple[str, int]]:
+        """ Get the top offenders in a channel: [(key, count), ...] """
+        with self._channel_locks[channel]:
+            return self._channels[channel].top(n)
+
+    def dump(self) -> Dict[str, List[Tuple[str, int]]]:
+        """ Get the top offenders in every channel """
+        return {channel: self.top(channel) for channel in self.CHANNELS}
+
+    def is_hot(self, key: str) -> bool:
+        """ Is this get() key hot? """
+        return self.hot_threshold is not None and self._channels['get'].estimate(key) >= self.hot_threshold
+
+    def _dump_due(self, now: float) -> bool:
+        return self._dump_interval is not None and now - self._dumped_at >= self._dump_interval
+
+    @staticmethod
+    def _log_dump(dump: Dict[str, List[Tuple[str, int]]]):
+        for channel, top in dump.items():
+            logger.info(f'Hot spots, {channel}: ' + ', '.join(f'{key}={count}' for key, count in top))
+
+
+class LocalCache:
+    """ A tiny in-process cache with a TTL. Thread-safe: it's used from every request thread """
+
+    def __init__(self, ttl: float, max_size: int):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._data: Dict[str, Tuple[float, Any]] = {}
+        self._lock = threading.Lock()
+
+    def get(self, key: str, default=None) -> Any:
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return default
+            elif item[0] < time.monotonic():
+                self._data.pop(key, None)
+                return default
+            return item[1]
+
+    def put(self, key: str, value: Any):
+        with self._lock:
+            if len(self._data) >= self.max_size:
+                self._evict()
+            self._data[key] = (time.monotonic() + self.ttl, value)
+
+    def discard(self, keys: Iterable[str]):
+        with self._lock:
+            for key in keys:
+                self._data.pop(key, None)
+
+    def _evict(self):
+        """ Drop expired items; if still full, drop the oldest half. Call with the lock held """
+        now = time.monotonic()
+        self._data = {key: item for key, item in self._data.items() if item[0] >= now}
+        if len(self._data) >= self.max_size:
+            self._data = dict(sorted(self._data.items(), key=lambda item: item[1][0])[len(self._data) // 2:])
@@ -0,0 +1,214 @@
+""" Look inside the dependency graph of a Redis cache
+
+Usage:
+    python -m matroska_cache.inspect --url redis://localhost:6379/0 --prefix cache
+    python -m matroska_cache.inspect --url redis://localhost:6379/0 --prefix cache --json
+
+It walks over every `<prefix>::rdep::*` key with an incremental SCAN, and reports, per dependency type (`id`, `pk`, `tag`, `condition`, ...):
+
+* fan-out histogram: how many data keys depend on a single dependency
+* top-N heaviest dependencies
+* dead-member ratio: how many members point to data keys that have already expired
+* MEMORY USAGE samples
+
+This is a production tool: use `--rate` to limit the number of keys inspected per second.
+"""
+import argparse
+import heapq
+import json
+import sys
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from redis import Redis, ResponseError
+
+from .backends.redis import small_bucket
+
+
+def inspect_dependencies(redis: Redis, prefix: str, *,
+                         top: int = 20,
+                         sample_members: int = 20,
+                         memory_samples: int = 20,
+                         scan_count: int = 500,
+                         rate_limit: Optional[float] = None,
+                         small_buckets: Optional[int] = None,
+                         ) -> Dict[str, Any]:
+    """ Walk the reverse-dependency keys and collect statistics
+
+    Args:
+        redis: Redis client. Must use `decode_responses=True`
+        prefix: The prefix used by the RedisBackend
+        top: The number of heaviest dependencies to report
+        sample_members: Check that many members of every dependency for being dead (SSCAN, one page)
+        memory_samples: Run MEMORY USAGE on that many dependency keys of every type
+        scan_count: SCAN batch size hint
+        rate_limit: Max number of dependency keys to inspect per second. Default: unlimited
+        small_buckets: The backend's `small_buckets`, if it stores small values: to find them in their hash buckets
+
+    Returns:
+        A JSON-serializable report
+    """
+    rdep_prefix = f'{prefix}::rdep::'
+    data_prefix = f'{prefix}::data::'
+
+    types: Dict[str, Dict[str, Any]] = {}
+    heaviest: List[Tuple[int, str]] = []  # min-heap of (fan-out, dependency key)
+    memory_supported = True
+    started_at = time.monotonic()
+    n_inspected = 0
+
+    cursor = None
+    while cursor != 0:
+        # SCAN one batch
+        cursor, rdep_keys = redis.scan(cursor or 0, match=rdep_prefix + '*', count=scan_count)
+        if not rdep_keys:
+            continue
+
+        # Fan-out and a page of members for every key
+        with redis.pipeline(transaction=False) as p:
+            for rdep_key in rdep_keys:
+                p.scard(rdep_key)
+                p.sscan(rdep_key, 0, count=sample_members)
+            results = p.execute()
+        fanouts: List[int] = results[0::2]
+        member_pages: List[List[str]] = [members[:sample_members] for _, members in results[1::2]]
+
+        # Dead members: see which data keys still exist
+        with redis.pipeline(transaction=False) as p:
+            for members in member_pages:
+                for member in members:
+                    p.exists(member)
+                    if small_buckets:
+                        field = member[len(data_prefix):]
+                        p.hexists(f'{prefix}::small::{small_bucket(field, small_buckets)}', field)
+            results = p.execute()
+        if small_buckets:
+            results = [key_exists or field_exists for key_exists, field_exists in zip(results[0::2], results[1::2])]
+        alive = iter(results)
+
+        for rdep_key, fanout, members in zip(rdep_keys, fanouts, member_pages):
+            dependency_key = rdep_key[len(rdep_prefix):]
+            stats = types.setdefault(_dependency_type(dependency_key), {
+                'dependencies': 0,
+                'members': 0,
+                'sampled_members': 0,
+                'dead_members': 0,
+                'histogram': {},
+                'memory_samples': [],
+            })
+
+            stats['dependencies'] += 1
+            stats['members'] += fanout
+            stats['sampled_members'] += len(members)
+            stats['dead_members'] += sum(1 for _ in members if not next(alive))
+            bucket = _histogram_bucket(fanout)
+            stats['histogram'][bucket] = stats['histogram'].get(bucket, 0) + 1
+
+            # Top N
+            if len(heaviest) < top:
+                heapq.heappush(heaviest, (fanout, dependency_key))
+            elif fanout > heaviest[0][0]:
+                heapq.heapreplace(heaviest, (fanout, dependency_key))
+
+            # Memory samples
+            if memory_supported and len(stats['memory_samples']) < memory_samples:
+                try:
+                    stats['memory_samples'].append(redis.memory_usage(rdep_key))
+                except ResponseError:
+                    # MEMORY is not supported, or disabled
+                    memory_supported = False
+
+        # Rate limit
+        n_inspected += len(rdep_keys)
+        if rate_limit:
+            ahead = n_inspected / rate_limit - (time.monotonic() - started_at)
+            if ahead > 0:
+                time.sleep(ahead)
+
+    # Finalize
+    for stats in types.values():
+        stats['dead_ratio'] = stats['dead_members'] / stats['sampled_members'] if stats['sampled_members'] else 0.0
+        stats['histogram'] = dict(sorted(stats['histogram'].items(), key=lambda item: int(item[0].split('-')[0])))
+
+        samples = [n for n in stats.pop('memory_samples') if n is not None]
+        stats['memory'] = {
+            'sampled': len(samples),
+            'avg_bytes': sum(samples) / len(samples) if samples else None,
+            'estimated_total_bytes': int(sum(samples) / len(samples) * stats['dependencies']) if samples else None,
+        }
+
+    return {
+        'prefix': prefix,
+        'types': types,
+        'top': [{'dependency': key, 'members': fanout} for fanout, key in sorted(heaviest, reverse=True)],
+        'elapsed': time.monotonic() - started_at,
+    }
+
+
+def format_report(report: Dict[str, Any]) -> str:
+    """ Format the report as human-readable text """
+    lines = [f'Dependencies under {report["prefix"]!r}:', '']
+
+    for type, stats in sorted(report['types'].items()):
+        memory = stats['memory']
+        lines.append(f'{type}: {stats["dependencies"]} dependencies, {stats["members"]} members, '
+                     f'dead ratio {stats["dead_ratio"]:.1%} (of {stats["sampled_members"]} sampled)')
+        if memory['sampled']:
+            lines.append(f'  memory: avg {memory["avg_bytes"]:.0f} bytes, est. total {memory["estimated_total_bytes"]} bytes '
+                         f'({memory["sampled"]} samples)')
+        lines.append('  fan-out histogram:')
+        for bucket, count in stats['histogram'].items():
+            lines.append(f'    {bucket:>12}: {count}')
+        lines.append('')
+
+    lines.append('Heaviest dependencies:')
+    for item in report['top']:
+        lines.append(f'  {item["members"]:>8}  {item["dependency"]}')
+
+    return '\n'.join(lines)
+
+
+def _dependency_type(dependency_key: str) -> str:
+    """ Dependency type is the key() prefix: 'id', 'pk', 'tag', 'condition', ... """
+    return dependency_key.split(':', 1)[0]
+
+
+def _histogram_bucket(n: int) -> str:
+    """ Power-of-2 histogram buckets: '0', '1', '2-3', '4-7', ... """
+    if n <= 1:
+        return str(n)
+    low = 1 << (n.bit_length() - 1)
+    return f'{low}-{2 * low - 1}'
+
+
+def main(argv: List[str] = None):
+    parser = argparse.ArgumentParser(prog='python -m matroska_cache.inspect', description='Inspect the dependency graph of a Redis cache')
+    parser.add_argument('--url', default='redis://localhost:6379/0', help='Redis URL')
+    parser.add_argument('--prefix', default='cache', help='The prefix used by the RedisBackend')
+    parser.add_argument('--top', type=int, default=20, help='Report that many heaviest dependencies')
+    parser.add_argument('--sample-members', type=int, default=20, help='Members per dependency to check for being dead')
+    parser.add_argument('--memory-samples', type=int, default=20, help='MEMORY USAGE samples per dependency type')
+    parser.add_argument('--rate', type=float, default=None, help='Max dependency keys to inspect per second')
+    parser.add_argument('--small-buckets', type=int, default=None, help='The backend stores small values in that many buckets')
+    parser.add_argument('--json', action='store_true', help='Output JSON')
+    args = parser.parse_args(argv)
+
+    redis = Redis.from_url(args.url, decode_responses=True)
+    report = inspect_dependencies(
+        redis, args.prefix,
+        top=args.top,
+        sample_members=args.sample_members,
+        memory_samples=args.memory_samples,
+        rate_limit=args.rate,
+        small_buckets=args.small_buckets,
+    )
+
+    if args.json:
+        json.dump(report, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+    else:
+        print(format_report(report))
+
+
+if __name__ == '__main__':
+    main()
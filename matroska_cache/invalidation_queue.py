@@ -0,0 +1,82 @@
+""" Deferred invalidation: collect invalidate() calls and send them to the back-end in one batch
+
+A write endpoint would often call `cache.invalidate()` several times, often with the very same dependencies.
+Every call is a full round-trip to the back-end on the request's critical path.
+
+Within `MatroskaCache.deferred_invalidation()`, invalidate() only records dependencies into a queue,
+and when the context manager exits, they are all invalidated at once:
+
+    with cache.deferred_invalidation():
+        cache.invalidate(dep.Id('article', 1))
+        cache.invalidate(dep.Id('article', 1), dep.Tag('homepage'))
+    # -> one backend.invalidate() call with 2 unique dependencies
+"""
+import logging
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from typing import Callable, Dict, Iterable, Optional, Set
+
+from .dep.base import DependencyBase
+
+logger = logging.getLogger(__name__)
+
+
+class InvalidationQueue:
+    """ A set of dependencies waiting to be invalidated
+
+    Dependencies are deduplicated by their key()
+    """
+    __slots__ = 'dependencies',
+
+    def __init__(self):
+        self.dependencies: Dict[str, DependencyBase] = {}
+
+    def add(self, dependencies: Iterable[DependencyBase]):
+        """ Record dependencies for invalidation """
+        for dependency in dependencies:
+            self.dependencies.setdefault(dependency.cached_key(), dependency)
+
+    def __len__(self):
+        return len(self.dependencies)
+
+
+class BackgroundInvalidator:
+    """ Runs invalidations in a background thread and lets you wait for them
+
+    The executor is only started when the first job arrives.
+    A single worker is used: invalidations are applied in the order they were submitted.
+    """
+
+    def __init__(self):
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._pending: Set[Future] = set()
+        self._lock = threading.Lock()
+
+    def submit(self, invalidate: Callable[..., None], *dependencies: DependencyBase):
+        """ Run `invalidate(*dependencies)` in the background """
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='matroska-invalidate')
+
+            future = self._executor.submit(invalidate, *dependencies)
+            self._pending.add(future)
+        future.add_done_callback(self._done)
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """ Wait for all pending invalidations to complete
+
+        Returns:
+            True if everything was invalidated, False on timeout
+        """
+        with self._lock:
+            pending = list(self._pending)
+        _, not_done = wait(pending, timeout)
+        return not not_done
+
+    def _done(self, future: Future):
+        with self._lock:
+            self._pending.discard(future)
+
+        # Errors in background threads would go unnoticed; report them
+        if not future.cancelled() and future.exception() is not None:
+            logger.error('Background invalidation failed', exc_info=future.exception())
@@ -0,0 +1,131 @@
+""" Request-scoped batching of cache reads, DataLoader-style
+
+Templates and serializers call `cache.get()` deep inside, one key at a time: N keys, N round-trips.
+Within `MatroskaCache.loader()`, reads are batched and memoized:
+
+    with cache.loader():
+        a = cache.get_deferred('article-1')
+        b = cache.get_deferred('article-2')
+        a.result()  # one get_many() for both keys
+        b.result()  # no round-trip
+        cache.get('article-1')  # no round-trip, no json.loads(): memoized for the rest of the block
+
+With asyncio, pending keys are fetched on the next event loop tick:
+every coroutine gets a chance to register its keys before the batch goes out:
+
+    async def render(key):
+        return await cache.get_deferred(key)
+
+    with cache.loader():
+        await asyncio.gather(render('article-1'), render('article-2'))  # one get_many()
+
+NOTE: memoized values are shared: don't modify them!
+NOTE: memoized values only see put(), delete(), invalidate() made by this block; not by others.
+"""
+from typing import Any, Callable, Dict, Iterable, List
+
+from .exc import NotInCache
+
+
+class Loader:
+    """ Collects keys to load, loads them in one batch, and remembers the results """
+
+    def __init__(self, load_many: Callable[[List[str]], Dict[str, Any]]):
+        """
+        Args:
+            load_many: The function that loads many keys at once. Missing keys are omitted from the result.
+        """
+        self._load_many = load_many
+        # Keys to load with the next batch. A dict is an ordered set
+        self._pending: Dict[str, None] = {}
+        # Loaded keys: { key => data }. Missing keys have `_MISSING`
+        self._memo: Dict[str, Any] = {}
+
+    def get_deferred(self, key: str) -> 'Deferred':
+        """ Get a promise of the key's data. It's loaded with the next batch """
+        if key not in self._memo:
+            self._pending[key] = None
+        return Deferred(self, key)
+
+    def dispatch(self):
+        """ Load all pending keys, in one batch """
+        if not self._pending:
+            return
+
+        keys = list(self._pending)
+        self._pending.clear()
+        found = self._load_many(keys)
+        for key in keys:
+            self._memo[key] = found.get(key, _MISSING)
+
+    def load(self, key: str) -> Any:
+        """ Get the data now; together with all pending keys
+
+        Raises:
+            NotInCache
+        """
+        if key not in self._memo:
+            self._pending[key] = None
+            self.dispatch()
+
+        data = self._memo[key]
+        if data is _MISSING:
+            raise NotInCache(key)
+        return data
+
+    def load_many(self, keys: Iterable[str]) -> Dict[str, Any]:
+        """ Get the data for many keys now; together with all pending keys. Missing keys are omitted """
+        keys = list(keys)
+        for key in keys:
+            if key not in self._memo:
+                self._pending[key] = None
+        self.dispatch()
+
+        return {
+            key: self._memo[key]
+            for key in keys
+            if self._memo[key] is not _MISSING
+        }
+
+    def is_loaded(self, key: str) -> bool:
+        return key in self._memo
+
+    def forget(self, keys: Iterable[str]):
+        """ Forget memoized keys: they've changed """
+        for key in keys:
+            self._memo.pop(key, None)
+
+
+class Deferred:
+    """ The promise of a cached value. Resolved with result(), or by awaiting it """
+    __slots__ = '_loader', 'key'
+
+    def __init__(self, loader: Loader, key: str):
+        self._loader = loader
+        self.key = key
+
+    def done(self) -> bool:
+        """ Has the value been loaded? """
+        return self._loader.is_loaded(self.key)
+
+    def result(self) -> Any:
+        """ Get the value. Loads all pending keys if not loaded yet
+
+        Raises:
+            NotInCache
+        """
+        return self._loader.load(self.key)
+
+    def __await__(self):
+        # Skip a tick: let other coroutines register their keys, then load them all at once
+        if not self.done():
+            import asyncio  # import time matters: only import it when used
+            yield from asyncio.sleep(0).__await__()
+        return self.result()
+
+    def __repr__(self):
+        return f'<Deferred {self.key!r}{" (done)" if self.done() else ""}>'
+
+
+# Marker for missing values
+_MISSING = object()
@@ -0,0 +1,344 @@
+""" Record cache traffic, and replay it offline against any backend
+
+New TTLs, coarsening, a different backend: try them against real traffic, without touching production.
+
+Record a sample of the traffic into a compact binary log:
+
+    cache.recorder = Recorder('/tmp/cache-traffic.bin', sample_rate=0.1)
+    ...
+    cache.recorder.close()
+
+Keys are stored as 64-bit hashes; payloads are not stored at all: only their sizes.
+Dependency keys are stored as is: they're needed to replay invalidations.
+Keys are sampled by their hash, so a sampled key has all of its get()s and put()s recorded.
+Invalidations are always recorded.
+
+Replay it:
+
+    python -m matroska_cache.replay /tmp/cache-traffic.bin --backend fakeredis --speed 10
+    python -m matroska_cache.replay /tmp/cache-traffic.bin --backend redis --url redis://localhost:6379/15
+
+or from Python, with a MatroskaCache configured the way you want to try:
+
+    report = replay('/tmp/cache-traffic.bin', cache, speed=0)
+    print(format_report(report))
+
+The report has: hit rate, latency percentiles per operation, invalidation fan-out, Redis memory.
+"""
+import argparse
+import hashlib
+import json
+import logging
+import struct
+import sys
+import threading
+import time
+from dataclasses import dataclass
+from typing import Any, BinaryIO, Dict, Iterable, Iterator, List, Optional, Tuple, Union, TYPE_CHECKING
+
+from .dep.base import DependencyBase
+from .dep.cache_key import CacheKey
+from .dep.raw_key import RawKey
+
+if TYPE_CHECKING:
+    from .cache import MatroskaCache
+
+logger = logging.getLogger(__name__)
+
+# File format: MAGIC, then records:
+#   header: op (B), timestamp (d), key hash (Q)
+#   get: hit (B)
+#   put: payload size (I), expires (I), dependencies
+#   invalidate: dependencies
+# dependencies: count (I), then every dependency: length (H), utf-8 key
+MAGIC = b'MCREC1\n'
+
+OP_GET = 1
+OP_PUT = 2
+OP_INVALIDATE = 3
+
+_HEADER = struct.Struct('<BdQ')
+_GET = struct.Struct('<B')
+_PUT = struct.Struct('<II')
+_COUNT = struct.Struct('<I')
+_LENGTH = struct.Struct('<H')
+
+
+def key_hash(key: str) -> int:
+    """ Hash a cache key: 64 bits """
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), 'little')
+
+
+class Recorder:
+    """ Records a sample of cache traffic into a binary log
+
+    Recording never breaks the cache: failures are logged, and the record is dropped.
+    """
+
+    def __init__(self, file: Union[str, BinaryIO], *, sample_rate: float = 1.0):
+        """
+        Args:
+            file: The file to write to: a path, or a binary file object
+            sample_rate: The fraction of keys to record
+        """
+        self._file = open(file, 'wb') if isinstance(file, str) else file
+        self._file.write(MAGIC)
+        self._sample_below = int(sample_rate * 2 ** 64)
+        self._lock = threading.Lock()
+
+    def record_get(self, key: str, hit: bool):
+        try:
+            h = key_hash(key)
+            if h < self._sample_below:
+                self._write(_HEADER.pack(OP_GET, time.time(), h) + _GET.pack(hit))
+        except Exception:
+            logger.exception('Failed to record get()')
+
+    def record_put(self, key: str, data: Any, dependencies: Iterable[DependencyBase], expires: int, *, size: int = None):
+        try:
+            h = key_hash(key)
+            if h < self._sample_below:
+                if size is None:
+                    from .admission import payload_size
+                    size = payload_size(data)
+                self._write(
+                    _HEADER.pack(OP_PUT, time.time(), h) +
+                    _PUT.pack(size, expires) +
+                    _pack_dependencies(dependencies)
+                )
+        except Exception:
+            logger.exception('Failed to record put()')
+
+    def record_invalidate(self, dependencies: Iterable[DependencyBase]):
+        try:
+            self._write(_HEADER.pack(OP_INVALIDATE, time.time(), 0) + _pack_dependencies(dependencies))
+        except Exception:
+            logger.exception('Failed to record invalidate()')
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+    def _write(self, record: bytes):
+        with self._lock:
+            self._file.write(record)
+
+
+def _pack_dependencies(dependencies: Iterable[DependencyBase]) -> bytes:
+    keys = []
+    for dependency in dependencies:
+        # Keys are hashed, so references to other keys have to be hashed as well
+        if isinstance(dependency, CacheKey):
+            keys.append(RecordedDependency.for_cache_key(key_hash(dependency.name)).key().encode())
+        else:
+            keys.append(dependency.cached_key().encode())
+    return _COUNT.pack(len(keys)) + b''.join(_LENGTH.pack(len(key)) + key for key in keys)
+
+
+@dataclass
+class Record:
+    """ A recorded operation """
+    op: int
+    timestamp: float
+    # Key hash. 0 for invalidations
+    key: int
+    # get(): hit or miss
+    hit: bool
+    # put(): payload size and TTL
+    size: int
+    expires: int
+    # put(), invalidate(): dependency keys
+    dependencies: Tuple[str, ...]
+
+    __slots__ = 'op', 'timestamp', 'key', 'hit', 'size', 'expires', 'dependencies'
+
+
+def read_log(file: Union[str, BinaryIO]) -> Iterator[Record]:
+    """ Read a log written by the Recorder """
+    f = open(file, 'rb') if isinstance(file, str) else file
+    try:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError('Not a cache traffic log')
+
+        while True:
+            header = f.read(_HEADER.size)
+            if len(header) < _HEADER.size:
+                return  # EOF. A truncated last record is fine: the recorder may have been killed
+            op, timestamp, h = _HEADER.unpack(header)
+
+            if op == OP_GET:
+                hit, = _GET.unpack(f.read(_GET.size))
+                yield Record(op, timestamp, h, bool(hit), 0, 0, ())
+            elif op == OP_PUT:
+                size, expires = _PUT.unpack(f.read(_PUT.size))
+                yield Record(op, timestamp, h, False, size, expires, _read_dependencies(f))
+            elif op == OP_INVALIDATE:
+                yield Record(op, timestamp, h, False, 0, 0, _read_dependencies(f))
+            else:
+                raise ValueError(f'Corrupt log: unknown op {op}')
+    finally:
+        if f is not file:
+            f.close()
+
+
+def _read_dependencies(f: BinaryIO) -> Tuple[str, ...]:
+    count, = _COUNT.unpack(f.read(_COUNT.size))
+    keys = []
+    for _ in range(count):
+        length, = _LENGTH.unpack(f.read(_LENGTH.size))
+        keys.append(f.read(length).decode())
+    return tuple(keys)
+
+
+class RecordedDependency(RawKey):
+    """ A dependency replayed from a log: only its key is known """
+    __slots__ = ()
+
+    @classmethod
+    def for_cache_key(cls, h: int) -> 'RecordedDependency':
+        """ CacheKey() dependency on a hashed key """
+        return cls(CacheKey(_replay_key(h)).key())
+
+
+def _replay_key(h: int) -> str:
+    """ The cache key to replay a key hash with """
+    return f'{h:016x}'
+
+
+def replay(file: Union[str, BinaryIO], cache: 'MatroskaCache', *, speed: float = 0, memory: Optional[Any] = None) -> Dict[str, Any]:
+    """ Replay a log against a cache
+
+    get()s are replayed as is; put()s store a dummy payload of the recorded size; invalidate()s invalidate the recorded dependencies.
+
+    Args:
+        file: The log
+        cache: The cache to replay it against. Configure it the way you want to try.
+        speed: Replay speed: 1 = real time, 10 = 10x faster. 0 = as fast as possible
+        memory: A Redis client to report memory usage from. Default: the backend's `redis`, if any
+    Returns:
+        The report: see format_report()
+    """
+    from .exc import NotInCache
+
+    latencies: Dict[str, List[float]] = {'get': [], 'put': [], 'invalidate': []}
+    hits = recorded_hits = 0
+    fan_out: List[int] = []
+
+    started_at = time.monotonic()
+    first_timestamp = None
+    for record in read_log(file):
+        # Keep the pace
+        if first_timestamp is None:
+            first_timestamp = record.timestamp
+        if speed:
+            delay = (record.timestamp - first_timestamp) / speed - (time.monotonic() - started_at)
+            if delay > 0:
+                time.sleep(delay)
+
+        t = time.perf_counter()
+        if record.op == OP_GET:
+            try:
+                cache.get(_replay_key(record.key))
+                hits += 1
+            except NotInCache:
+                pass
+            recorded_hits += record.hit
+            latencies['get'].append(time.perf_counter() - t)
+        elif record.op == OP_PUT:
+            cache.put(_replay_key(record.key), 'x' * record.size,
+                      *(RecordedDependency(key) for key in record.dependencies),
+                      expires=max(record.expires, 1))
+            latencies['put'].append(time.perf_counter() - t)
+        elif record.op == OP_INVALIDATE:
+            invalidated = cache.invalidate(*(RecordedDependency(key) for key in record.dependencies))
+            latencies['invalidate'].append(time.perf_counter() - t)
+            fan_out.append(len(invalidated or ()))
+
+    # Memory
+    if memory is None:
+        memory = getattr(cache.backend, 'redis', None)
+    used_memory = None
+    if memory is not None:
+        try:
+            used_memory = memory.info('memory').get('used_memory')
+        except Exception:  # not supported, e.g. by fakeredis
+            pass
+
+    gets = len(latencies['get'])
+    return {
+        'seconds': time.monotonic() - started_at,
+        'operations': {op: len(values) for op, values in latencies.items()},
+        'hit_rate': hits / gets if gets else None,
+        'recorded_hit_rate': recorded_hits / gets if gets else None,
+        'latency_ms': {op: _percentiles(values) for op, values in latencies.items() if values},
+        'fan_out': {
+            'mean': sum(fan_out) / len(fan_out) if fan_out else 0,
+            'max': max(fan_out, default=0),
+        },
+        'used_memory': used_memory,
+    }
+
+
+def _percentiles(values: List[float]) -> Dict[str, float]:
+    """ p50, p90, p99, max: milliseconds """
+    values = sorted(values)
+    return {
+        name: round(values[min(int(len(values) * p), len(values) - 1)] * 1000, 3)
+        for name, p in (('p50', 0.5), ('p90', 0.9), ('p99', 0.99), ('max', 1.0))
+    }
+
+
+def format_report(report: Dict[str, Any]) -> str:
+    """ Format the replay() report for humans """
+    def rate(value: Optional[float]) -> str:
+        return '-' if value is None else f'{value:.1%}'
+
+    lines = [
+        f'Replayed in {report["seconds"]:.1f}s: ' + ', '.join(f'{count} {op}' for op, count in report['operations'].items()),
+        f'Hit rate: {rate(report["hit_rate"])} (recorded: {rate(report["recorded_hit_rate"])})',
+        'Latency, ms:',
+    ]
+    for op, percentiles in report['latency_ms'].items():
+        lines.append(f'  {op:<10} ' + ' '.join(f'{name}={value}' for name, value in percentiles.items()))
+    lines.append(f'Invalidation fan-out: mean={report["fan_out"]["mean"]:.1f} max={report["fan_out"]["max"]}')
+    if report['used_memory'] is not None:
+        lines.append(f'Redis memory: {report["used_memory"] / 1024 / 1024:.1f} MB')
+    return '\n'.join(lines)
+
+
+def main(argv: List[str] = None):
+    parser = argparse.ArgumentParser(prog='python -m matroska_cache.replay', description='Replay recorded cache traffic against a backend')
+    parser.add_argument('log', help='The log written by the Recorder')
+    parser.add_argument('--backend', choices=('fakeredis', 'redis', 'sqlite'), default='fakeredis')
+    parser.add_argument('--url', default='redis://localhost:6379/0', help='Redis URL')
+    parser.add_argument('--path', default=':memory:', help='SQLite database path')
+    parser.add_argument('--prefix', default='replay', help='The prefix for the RedisBackend')
+    parser.add_argument('--speed', type=float, default=0, help='Replay speed: 1 = real time. Default: as fast as possible')
+    parser.add_argument('--json', action='store_true', help='Output JSON')
+    args = parser.parse_args(argv)
+
+    from .cache import MatroskaCache
+    if args.backend == 'sqlite':
+        from .backends.sqlite import SQLiteBackend
+        backend = SQLiteBackend(args.path)
+    else:
+        from .backends.redis import RedisBackend
+        if args.backend == 'fakeredis':
+            from fakeredis import FakeRedis
+            redis = FakeRedis(decode_responses=True)
+        else:
+            from redis import Redis
+            redis = Redis.from_url(args.url, decode_responses=True)
+        backend = RedisBackend(redis, prefix=args.prefix)
+
+    report = replay(args.log, MatroskaCache(backend), speed=args.speed)
+
+    if args.json:
+        json.dump(report, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+    else:
+        print(format_report(report))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,14 +1,23 @@
 import itertools
-from typing import TypeVar, Mapping, Union, Iterable, List, Set
+from typing import TypeVar, Mapping, Union, Iterable, List, Set, Tuple, Dict, Any
 
+import sqlalchemy as sa
+from sqlalchemy.orm import Mapper
+from sqlalchemy.orm.attributes import set_committed_value
 from sqlalchemy.orm.base import instance_state
 from sqlalchemy.orm.relationships import RelationshipProperty
 from sqlalchemy.orm.state import InstanceState
+from sqlalchemy.sql.dml import Update, Delete
 
 from matroska_cache.dep import PrimaryKey
+from matroska_cache.dep.base import DependencyBase
+from matroska_cache.dep.scopes import Scopes
 
 SAInstanceT = TypeVar('SAInstanceT', bound=object)
 
+# SqlAlchemy (major, minor): statement internals differ between 1.3 and 1.4
+SA_VERSION = tuple(int(n) for n in sa.__version__.split('.')[:2])
+
 # The dict used for plucking
 PluckMap = Mapping[str, Union[int, 'PluckMap']]
 
@@ -42,7 +51,7 @@ def sa_dependencies(instance: Union[SAInstanceT, Iterable[SAInstanceT]], map: Pl
     # Include self
     ret = []
     if instance not in _seen:
-        ret.append(PrimaryKey.from_instance(instance))
+        ret.append(PrimaryKey.from_state(state))
     _seen.add(instance)
 
     # If there's anything left to iterate, do it
@@ -73,3 +82,198 @@ def sa_modified_names(instance: object) -> Set[str]:
     # `dict` contains current values, and when those are modified, old values go into `committed_state`.
     # Therefore, `set(committed_state)` is what we want.
     return set(instance_state(instance).committed_state)
+
+
+def sa_bulk_dependencies(connection, model: type, statement: Union[Update, Delete], *scopes: Scopes,
+                         returning: bool = False,
+                         ) -> Tuple[Any, List[DependencyBase]]:
+    """ Execute a bulk UPDATE or DELETE, and get dependencies for every row it has touched
+
+    Bulk statements skip ORM instances: neither PrimaryKey.from_instance(), nor Scopes.invalidate_for() ever see
+    those rows. This function finds them: `PrimaryKey`s of the rows, and the scopes they enter and leave.
+
+    Example:
+        statement = sa.update(Article.__table__).where(Article.author_id == 1).values(status='archived')
+        result, dependencies = sa_bulk_dependencies(ssn, Article, statement, article_scopes)
+        ssn.commit()
+        cache.invalidate(*dependencies)
+
+    For `Query.update()` and `Query.delete()`, use a Core statement with the same condition:
+        sa.update(Article.__table__).where(query.whereclause).values(...)
+
+    How rows are found:
+    * The primary keys, and the columns the scopes watch, are selected before the statement is executed:
+      SELECT ... FOR UPDATE, in the same transaction, so that the rows can't change in between.
+      Dialects without FOR UPDATE (SQLite) ignore it.
+    * UPDATE of watched columns: rows are selected again, by primary key, to see the scopes they enter
+    * returning=True: RETURNING is used instead (PostgreSQL):
+      a DELETE, or an UPDATE of columns no scope watches, only needs one statement.
+      The rows touched are always the ones RETURNING reports.
+
+    With a Connection that's not in a transaction, one is started, and committed when done.
+    With a Session, its transaction is used.
+
+    NOTE: FOR UPDATE locks the rows selected, but not the rows that start to match the condition in between
+        (phantoms: inserted or updated by another transaction). Without RETURNING, they're missed.
+        With RETURNING, they're found, but their scopes before the change are not known: only the scopes they enter.
+        Use returning=True, or the SERIALIZABLE isolation level, if that matters.
+
+    Args:
+        connection: Session, or Connection, to execute the statement with
+        model: The model class the statement's table is mapped to
+        statement: UPDATE or DELETE statement. An UPDATE has to have its .values(): not at execution time
+        *scopes: Scopes to invalidate the rows for
+        returning: Use RETURNING. NOTE: the result's rows are consumed then
+    Returns:
+        (the result of the statement, deduplicated dependencies)
+    Raises:
+        ValueError: an UPDATE of primary keys, without .values(), or with many sets of values
+    """
+    # Connection: run everything in one transaction. A Session has one already
+    if isinstance(connection, sa.engine.Connection) and not connection.in_transaction():
+        with connection.begin():
+            return _sa_bulk_dependencies(connection, model, statement, scopes, returning)
+    return _sa_bulk_dependencies(connection, model, statement, scopes, returning)
+
+
+def _sa_bulk_dependencies(connection, model: type, statement: Union[Update, Delete], scopes: Iterable[Scopes],
+                          returning: bool) -> Tuple[Any, List[DependencyBase]]:
+    mapper: Mapper = sa.inspect(model)
+    is_update = isinstance(statement, Update)
+
+    # Columns to load: primary keys, and whatever the scopes watch
+    watched = frozenset().union(*(scope.watched_names() for scope in scopes))
+    attrs = {prop.key: prop.columns[0] for prop in mapper.column_attrs if prop.key in watched}
+    attrs.update((mapper.get_property_by_column(column).key, column) for column in mapper.primary_key)
+    columns = list(attrs.values())
+
+    # Attributes modified by the statement. None for DELETE: everything changes
+    modified = _sa_statement_modified_names(mapper, statement) if is_update else None
+    if modified is not None and modified & {mapper.get_property_by_column(column).key for column in mapper.primary_key}:
+        raise ValueError('Bulk updates of primary keys are not supported')
+    scopes_modified = modified is None or bool(modified & watched)
+
+    # Rows before the change: needed when rows may leave scopes, unless RETURNING gives them to us (DELETE)
+    old_rows = None
+    if not (returning and (not is_update or not scopes_modified)):
+        old_rows = connection.execute(sa.select(columns).where(_sa_statement_where(statement)).with_for_update()).fetchall()
+
+    # Execute
+    if returning:
+        result = connection.execute(statement.returning(*columns))
+        returned_rows = result.fetchall()
+    else:
+        result = connection.execute(statement)
+        returned_rows = None
+
+    # Rows after the change
+    if not is_update:
+        old_rows, new_rows = (old_rows if old_rows is not None else returned_rows), None
+    elif returned_rows is not None:
+        new_rows = returned_rows
+    elif scopes_modified and old_rows:
+        new_rows = _sa_select_by_primary_key(connection, mapper, attrs, old_rows)
+    else:
+        new_rows = old_rows
+
+    # Instances: for extractor functions
+    keys = list(attrs)
+    old_instances = _sa_rows_to_instances(mapper, keys, old_rows) if old_rows is not None else {}
+    if new_rows is old_rows:
+        new_instances = old_instances
+    else:
+        new_instances = _sa_rows_to_instances(mapper, keys, new_rows) if new_rows is not None else {}
+
+    # The rows touched. RETURNING knows them for sure; the SELECT before may be off by concurrent changes
+    if returned_rows is not None:
+        identities = (new_instances if is_update else old_instances).keys()
+    else:
+        identities = new_instances.keys() | old_instances.keys()
+
+    # Dependencies. Deduplicated: dependencies are compared by key
+    model_name = mapper.class_.__name__
+    ret = dict.fromkeys(PrimaryKey.many(model_name, (PrimaryKey._instance_identity_to_str(identity) for identity in identities)))
+    for scope in scopes:
+        for identity in identities:
+            new, old = new_instances.get(identity), old_instances.get(identity)
+            # Scopes the row enters, and those it leaves
+            if new is not None:
+                ret.update(dict.fromkeys(scope.object_invalidates(new, modified, previous=old if old is not new else None)))
+            else:
+                ret.update(dict.fromkeys(scope.object_invalidates(old)))
+    return result, list(ret)
+
+
+def _sa_statement_where(statement: Union[Update, Delete]):
+    """ Get the WHERE clause of an UPDATE/DELETE statement """
+    if SA_VERSION >= (1, 4):
+        whereclause = statement.whereclause
+    else:
+        whereclause = statement._whereclause
+    return whereclause if whereclause is not None else sa.true()
+
+
+def _sa_statement_modified_names(mapper: Mapper, statement: Update) -> Set[str]:
+    """ Get the names of attributes an UPDATE statement modifies
+
+    Raises:
+        ValueError: can't tell: no values(), or many sets of them
+    """
+    if SA_VERSION >= (1, 4):
+        if statement._multi_values:
+            raise ValueError('Bulk updates with multiple sets of values are not supported')
+        elif statement._ordered_values:
+            names = [name for name, _ in statement._ordered_values]
+        else:
+            names = list(statement._values or ())
+    else:
+        if statement._has_multi_parameters:
+            raise ValueError('Bulk updates with multiple sets of values are not supported')
+        # With `preserve_parameter_order=True`, it's a dict as well
+        names = list(statement.parameters or ())
+
+    # Values given to execute() are not in the statement: then we'd miss the scopes rows enter
+    if not names:
+        raise ValueError('Bulk updates need .values(): values given at execution time are not seen')
+
+    ret = set()
+    for name in names:
+        # Model.attribute
+        if hasattr(name, 'property'):
+            ret.add(name.property.key)
+        # Column, or column name
+        else:
+            column = mapper.local_table.c[name] if isinstance(name, str) else name
+            ret.add(mapper.get_property_by_column(column).key)
+    return ret
+
+
+def _sa_select_by_primary_key(connection, mapper: Mapper, attrs: Dict[str, sa.Column], rows: list, chunk_size: int = 1000) -> list:
+    """ Select rows again, by their primary keys """
+    keys, columns = list(attrs), list(attrs.values())
+    primary_key = mapper.primary_key
+    positions = [keys.index(mapper.get_property_by_column(column).key) for column in primary_key]
+    column = primary_key[0] if len(primary_key) == 1 else sa.tuple_(*primary_key)
+
+    ret = []
+    for i in range(0, len(rows), chunk_size):
+        chunk = rows[i:i + chunk_size]
+        if len(primary_key) == 1:
+            values = [row[positions[0]] for row in chunk]
+        else:
+            values = [tuple(row[position] for position in positions) for row in chunk]
+        ret.extend(connection.execute(sa.select(columns).where(column.in_(values))).fetchall())
+    return ret
+
+
+def _sa_rows_to_instances(mapper: Mapper, keys: List[str], rows: list) -> Dict[tuple, object]:
+    """ Make transient instances from rows: { identity => instance } """
+    pk_keys = [mapper.get_property_by_column(column).key for column in mapper.primary_key]
+
+    ret = {}
+    for row in rows:
+        instance = mapper.class_manager.new_instance()
+        for key, value in zip(keys, row):
+            set_committed_value(instance, key, value)
+        ret[tuple(getattr(instance, key) for key in pk_keys)] = instance
+    return ret
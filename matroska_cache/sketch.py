@@ -0,0 +1,64 @@
+""" Compact streaming counters """
+from array import array
+from typing import Hashable
+
+# Counters are 32-bit: they saturate at this value
+MAX_COUNT = 0xFFFFFFFF
+
+
+class CountMinSketch:
+    """ Approximate frequency counter with a fixed memory footprint
+
+    Counts are never underestimated; they may be overestimated because of hash collisions.
+    With `width=4096` and `depth=4`, it uses 64 KiB (32-bit counters) no matter how many keys are counted.
+
+    Counters age: after `reset_after` additions, every counter is halved, so that old popularity fades away.
+    (This is the TinyLFU "reset" operation)
+
+    Hashing uses Python's hash(), so the sketch is per-process: don't persist it.
+
+    Not thread-safe: concurrent add() calls may lose counts or halve them twice. Lock it if you share it between threads.
+    """
+    __slots__ = 'width', 'depth', '_mask', '_tables', '_additions', 'reset_after'
+
+    def __init__(self, width: int = 4096, depth: int = 4, *, reset_after: int = None):
+        """
+        Args:
+            width: The number of counters per row. Rounded up to a power of 2
+            depth: The number of rows (hash functions)
+            reset_after: Halve all counters after that many additions. Default: 10 * width
+        """
+        self.width = 1 << max(width - 1, 1).bit_length()
+        self.depth = depth
+        self._mask = self.width - 1
+        self._tables = [array('I', bytes(self.width * array('I').itemsize)) for _ in range(depth)]
+        self._additions = 0
+        self.reset_after = reset_after or 10 * self.width
+
+    def add(self, key: Hashable, count: int = 1) -> int:
+        """ Count `key`; return its new estimated count """
+        estimate = None
+        for row, table in enumerate(self._tables):
+            i = hash((row, key)) & self._mask
+            table[i] = min(table[i] + count, MAX_COUNT)
+            estimate = table[i] if estimate is None else min(estimate, table[i])
+
+        self._additions += count
+        if self._additions >= self.reset_after:
+            self.decay()
+        return estimate
+
+    def estimate(self, key: Hashable) -> int:
+        """ Get the estimated count for `key` """
+        return min(table[hash((row, key)) & self._mask] for row, table in enumerate(self._tables))
+
+    def decay(self):
+        """ Halve all counters """
+        for table in self._tables:
+            for i, value in enumerate(table):
+                if value:
+                    table[i] = value >> 1
+        self._additions //= 2
+
+    def __getitem__(self, key: Hashable) -> int:
+        return self.estimate(key)
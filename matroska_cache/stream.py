@@ -0,0 +1,296 @@
+""" Invalidation stream: publish invalidations to a Redis Stream, and apply them elsewhere
+
+Other services, and other regions, keep their own caches of the same data.
+They have to learn about invalidations somehow: polling, or short TTLs, are both bad.
+
+The publisher appends the dependency keys of every invalidate() to a Redis Stream:
+
+    cache.stream = InvalidationStream(redis, origin='eu-1')
+    cache.invalidate(dep.Id('article', 1))  # -> XADD matroska::invalidations * keys '["id:article:1"]' origin eu-1
+
+Appends are batched: invalidations within `max_delay` seconds go into one stream entry.
+Batched invalidations wait in process memory: close() the stream to append them; it's also done at exit.
+With `max_delay > 0`, publishing is at-most-once: invalidations still waiting when the process crashes are lost.
+Use `max_delay=0` when every invalidation has to reach the stream.
+The stream is capped at about `maxlen` entries: a consumer that lags further behind than that misses invalidations.
+
+A consumer, in another service or region, applies them to its own backend:
+
+    consumer = InvalidationConsumer(redis, remote_backend, group='us-1', consumer=socket.gethostname(), ignore_origin='us-1')
+    consumer.run(stop_event)  # or call consumer.poll() in your own loop
+
+Consumers use consumer groups: every group gets every invalidation; consumers within a group share the work.
+Delivery is at-least-once: entries are acknowledged only after they've been applied;
+entries of a consumer that died are claimed by another one after `claim_idle` seconds.
+Invalidating twice is harmless.
+
+NOTE: requires Redis 5.0+: Redis Streams.
+NOTE: cross-region: point both at the same Redis, or replicate the stream to the other region.
+"""
+import atexit
+import json
+import logging
+import threading
+import time
+from collections import Counter
+from typing import Iterable, List, Optional, Tuple
+
+from redis import Redis, ResponseError
+
+from .backends.base import MatroskaCacheBackendBase
+from .dep.base import DependencyBase
+from .dep.raw_key import RawKey
+
+logger = logging.getLogger(__name__)
+
+# Default stream name
+DEFAULT_STREAM = 'matroska::invalidations'
+
+
+class InvalidationStream:
+    """ Publishes invalidations to a Redis Stream
+
+    Set it as `MatroskaCache.stream`
+    """
+
+    def __init__(self, redis: Redis, *,
+                 stream: str = DEFAULT_STREAM,
+                 maxlen: int = 100000,
+                 max_delay: float = 0.05,
+                 batch_size: int = 1000,
+                 origin: str = None,
+                 ):
+        """
+        Args:
+            redis: The Redis that has the stream
+            stream: Stream key name
+            maxlen: Cap the stream at about that many entries (approximately: cheaper)
+            max_delay: Collect invalidations for that many seconds, and append them as one entry. 0: append right away.
+                Collected invalidations are lost if the process crashes: at-most-once
+            batch_size: Append right away when that many dependency keys are collected
+            origin: The name of this cache: lets consumers skip invalidations they've made themselves
+        """
+        self.redis = redis
+        self.stream = stream
+        self.maxlen = maxlen
+        self.max_delay = max_delay
+        self.batch_size = batch_size
+        self.origin = origin
+
+        # Dependency keys waiting to be appended
+        self._buffer: List[str] = []
+        self._timer: Optional[threading.Timer] = None
+        self._lock = threading.Lock()
+        self._closed = False
+
+        # The timer thread is a daemon: flush at exit, or the last invalidations are lost
+        atexit.register(self._flush_at_exit)
+
+    def publish(self, dependencies: Iterable[DependencyBase]):
+        """ Publish invalidated dependencies """
+        with self._lock:
+            self._buffer.extend(dependency.cached_key() for dependency in dependencies)
+
+            # Append right away
+            if self.max_delay <= 0 or self._closed or len(self._buffer) >= self.batch_size:
+                keys = self._take()
+            # Append later. In a background thread
+            else:
+                if self._timer is None:
+                    self._timer = threading.Timer(self.max_delay, self._flush_in_background)
+                    self._timer.daemon = True
+                    self._timer.start()
+                return
+
+        self._append(keys)
+
+    def flush(self):
+        """ Append everything collected so far """
+        with self._lock:
+            keys = self._take()
+        if keys:
+            self._append(keys)
+
+    def close(self):
+        """ Append everything collected so far, and stop the timer. Later invalidations are appended right away """
+        with self._lock:
+            self._closed = True
+        self.flush()
+        atexit.unregister(self._flush_at_exit)
+
+    def _flush_in_background(self):
+        try:
+            self.flush()
+        except Exception:
+            # Errors in the timer thread would go unnoticed; report them
+            logger.exception('Failed to publish invalidations')
+
+    def _flush_at_exit(self):
+        try:
+            self.flush()
+        except Exception:
+            logger.exception('Failed to publish invalidations at exit')
+
+    def _take(self) -> List[str]:
+        """ Take the buffer contents. Call with the lock held """
+        keys, self._buffer = self._buffer, []
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        return keys
+
+    def _append(self, keys: List[str]):
+        fields = {'keys': json.dumps(list(dict.fromkeys(keys))), 'ts': int(time.time() * 1000)}
+        if self.origin is not None:
+            fields['origin'] = self.origin
+
+        self.redis.xadd(self.stream, fields, maxlen=self.maxlen, approximate=True)
+
+
+class InvalidationConsumer:
+    """ Reads invalidations from a Redis Stream and applies them to a backend """
+
+    def __init__(self, redis: Redis, backend: MatroskaCacheBackendBase, *,
+                 group: str,
+                 consumer: str,
+                 stream: str = DEFAULT_STREAM,
+                 batch_size: int = 100,
+                 block: float = 1.0,
+                 claim_idle: float = 60.0,
+                 ignore_origin: str = None,
+                 start_id: str = '$',
+                 ):
+        """
+        Args:
+            redis: The Redis that has the stream
+            backend: The backend to invalidate
+            group: Consumer group name. Every group gets every invalidation
+            consumer: The name of this consumer within the group. Keep it stable across restarts:
+                on start, it gets the entries that it has not acknowledged before
+            stream: Stream key name
+            batch_size: Read that many entries at once
+            block: Wait for new entries for that many seconds
+            claim_idle: Take over entries that other consumers have not acknowledged for that many seconds
+            ignore_origin: Skip entries published with this `origin`: invalidations made by this very cache
+            start_id: When the group is created, start with: '$' new entries, '0' the whole stream
+        """
+        self.redis = redis
+        self.backend = backend
+        self.group = group
+        self.consumer = consumer
+        self.stream = stream
+        self.batch_size = batch_size
+        self.block = block
+        self.claim_idle = claim_idle
+        self.ignore_origin = ignore_origin
+        self.start_id = start_id
+
+        # Counters: 'entries', 'keys', 'claimed', 'ignored'
+        self.stats = Counter()
+
+        # Before reading new entries, re-read the ones delivered to us but not acknowledged: we may have crashed
+        self._recovered = False
+        self._group_created = False
+
+    def create_group(self):
+        """ Create the consumer group, unless it exists """
+        try:
+            self.redis.xgroup_create(self.stream, self.group, id=self.start_id, mkstream=True)
+        except ResponseError as e:
+            if 'BUSYGROUP' not in str(e):
+                raise
+        self._group_created = True
+
+    def poll(self, block: float = None) -> int:
+        """ Read a batch of entries and apply them
+
+        Args:
+            block: Wait for new entries for that many seconds. Default: `self.block`. 0: don't wait
+        Returns:
+            The number of entries processed
+        """
+        if not self._group_created:
+            self.create_group()
+
+        # Our own unacknowledged entries
+        if not self._recovered:
+            entries = self._read('0', block=None)
+            if not entries:
+                self._recovered = True
+        # Entries of dead consumers
+        else:
+            entries = self._claim()
+
+        # New entries
+        if not entries:
+            entries = self._read('>', block=self.block if block is None else block)
+
+        if entries:
+            try:
+                self._apply(entries)
+            except Exception:
+                # Not acknowledged: they're pending on us. Re-read them next time, or they're only retried after a restart
+                self._recovered = False
+                raise
+        return len(entries)
+
+    def run(self, stop: threading.Event):
+        """ Poll until `stop` is set. Errors are logged, and polling goes on """
+        while not stop.is_set():
+            try:
+                self.poll()
+            except Exception:
+                logger.exception('Failed to apply invalidations')
+                stop.wait(self.block)
+
+    def _read(self, id: str, block: Optional[float]) -> List[Tuple[str, dict]]:
+        response = self.redis.xreadgroup(
+            self.group, self.consumer, {self.stream: id},
+            count=self.batch_size,
+            # NOTE: BLOCK 0 waits forever; None doesn't wait
+            block=int(block * 1000) if block else None,
+        )
+        return [entry for _, entries in response or () for entry in entries]
+
+    def _claim(self) -> List[Tuple[str, dict]]:
+        """ Claim entries that other consumers have not acknowledged for too long """
+        claim_idle_ms = int(self.claim_idle * 1000)
+        pending = self.redis.xpending_range(self.stream, self.group, '-', '+', self.batch_size)
+        ids = [
+            info['message_id']
+            for info in pending
+            if info['time_since_delivered'] >= claim_idle_ms and _str(info['consumer']) != self.consumer
+        ]
+        if not ids:
+            return []
+
+        entries = self.redis.xclaim(self.stream, self.group, self.consumer, claim_idle_ms, ids)
+        self.stats['claimed'] += len(entries)
+        return entries
+
+    def _apply(self, entries: List[Tuple[str, dict]]):
+        """ Invalidate all entries at once; acknowledge them """
+        keys = {}
+        for _, fields in entries:
+            # Trimmed away, or deleted: XCLAIM returns no fields
+            if not fields:
+                continue
+
+            fields = {_str(name): _str(value) for name, value in fields.items()}
+            if self.ignore_origin is not None and fields.get('origin') == self.ignore_origin:
+                self.stats['ignored'] += 1
+                continue
+            keys.update(dict.fromkeys(json.loads(fields['keys'])))
+
+        if keys:
+            self.backend.invalidate([RawKey(key) for key in keys])
+
+        # Acknowledge only when applied: at-least-once
+        self.redis.xack(self.stream, self.group, *(id for id, _ in entries))
+        self.stats['entries'] += len(entries)
+        self.stats['keys'] += len(keys)
+
+
+def _str(value) -> str:
+    """ Decode bytes: for clients without `decode_responses` """
+    return value.decode() if isinstance(value, bytes) else value
@@ -0,0 +1,206 @@
+""" Cache warming: recompute invalidated entries before anyone asks for them
+
+When a popular entry is invalidated, the next user request pays the full price of recomputing it.
+Warmers recompute such entries in the background, right after invalidate() has removed them.
+
+Example:
+    cache.warmers = WarmingRegistry(max_workers=4, rate_limit=20)
+
+    @cache.warmers.warms('articles-list:*')
+    def warm_articles_list(key: str):
+        category = key.split(':', 1)[1]
+        cache.put(key, load_articles(category), *article_scopes.condition(category=category), expires=600)
+
+Every key removed by invalidate() that matches a warmer is scheduled for recomputing.
+Keys are deduplicated while they're waiting or running; hot keys (by the recent get() hits) go first;
+the `rate_limit` makes sure that a massive invalidation won't turn into a stampede on your database.
+"""
+import fnmatch
+import heapq
+import itertools
+import logging
+import threading
+import time
+from concurrent.futures import Executor, Future, ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple, Union
+
+from .dep.base import DependencyBase
+
+logger = logging.getLogger(__name__)
+
+WarmerFunc = Callable[[str], None]
+
+
+@dataclass
+class Warmer:
+    """ A registered recompute function """
+    # The function that recomputes the entry and put()s it into the cache
+    func: WarmerFunc
+
+    # fnmatch() pattern for cache keys. None matches any key
+    pattern: Optional[str]
+
+    # Dependency filter: a dependency class, or a prefix of dependency key(). None matches any dependency
+    dependency: Union[type, str, None]
+
+    __slots__ = 'func', 'pattern', 'dependency'
+
+    def matches_key(self, key: str) -> bool:
+        return self.pattern is None or fnmatch.fnmatchcase(key, self.pattern)
+
+    def matches_dependencies(self, dependencies: Iterable[DependencyBase]) -> bool:
+        if self.dependency is None:
+            return True
+        elif isinstance(self.dependency, str):
+            return any(dependency.cached_key().startswith(self.dependency) for dependency in dependencies)
+        else:
+            return any(isinstance(dependency, self.dependency) for dependency in dependencies)
+
+
+class WarmingRegistry:
+    """ Warmers and the scheduler that runs them """
+
+    def __init__(self, executor: Executor = None, *,
+                 max_workers: int = 4,
+                 rate_limit: Optional[float] = None,
+                 max_queue: int = 10000,
+                 hits_decay: float = 60.0,
+                 ):
+        """ Init the warming scheduler
+
+        Args:
+            executor: The pool to run warmers on. Default: a ThreadPoolExecutor with `max_workers`.
+                With a ProcessPoolExecutor, warmer functions have to be picklable and use their own cache connection.
+            max_workers: The number of worker threads for the default executor.
+                With a custom `executor`, the max number of warmers run at once: set it to the size of your pool
+            rate_limit: Max number of warmer runs per second. Default: unlimited
+            max_queue: Max number of keys waiting to be warmed. Others are dropped.
+            hits_decay: Every that many seconds, hit counts are halved, so that only recent hits matter
+        """
+        self.warmers: List[Warmer] = []
+
+        self._executor = executor or ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='matroska-warm')
+        self._max_workers = max_workers
+        self._rate_limit = rate_limit
+        self._max_queue = max_queue
+
+        # Recent hits: { key => count }
+        self._hits: Dict[str, float] = {}
+        self._hits_decay = hits_decay
+        self._hits_decayed_at = time.monotonic()
+
+        # The queue: heap of (-hits, seq, key, warmer)
+        self._queue: List[Tuple[float, int, str, Warmer]] = []
+        self._seq = itertools.count()
+        # Keys that are waiting in the queue: used for deduplication.
+        # Running keys are not here: if invalidated again while being recomputed, they have to be recomputed again.
+        self._scheduled: Set[str] = set()
+        self._running = 0
+        self._next_run_at = 0.0
+
+        self._lock = threading.Condition()
+        self._dispatcher: Optional[threading.Thread] = None
+
+    def warms(self, pattern: str = None, *, dependency: Union[type, str] = None):
+        """ Decorator for a function that recomputes cache entries
+
+        The function receives the cache key and is expected to put() it back into the cache.
+
+        Args:
+            pattern: fnmatch() pattern for the keys this function can recompute. Example: 'articles-list:*'
+            dependency: Only warm keys invalidated through this dependency.
+                A dependency class (e.g. `ConditionalDependency`), or a key prefix (e.g. 'condition:article:')
+        """
+        def decorator(fn: WarmerFunc):
+            self.warmers.append(Warmer(func=fn, pattern=pattern, dependency=dependency))
+            return fn
+        return decorator
+
+    def record_hit(self, key: str):
+        """ Count a cache hit. Hot keys are warmed first """
+        # Called from every request thread
+        with self._lock:
+            now = time.monotonic()
+            if now - self._hits_decayed_at > self._hits_decay:
+                self._hits_decayed_at = now
+                self._hits = {k: v / 2 for k, v in self._hits.items() if v >= 1}
+            self._hits[key] = self._hits.get(key, 0) + 1
+
+    def schedule(self, keys: Iterable[str], dependencies: Iterable[DependencyBase]):
+        """ Schedule recomputing of `keys` that have just been invalidated through `dependencies` """
+        dependencies = list(dependencies)
+        warmers = [warmer for warmer in self.warmers if warmer.matches_dependencies(dependencies)]
+        if not warmers:
+            return
+
+        with self._lock:
+            for key in keys:
+                # Deduplicate
+                if key in self._scheduled:
+                    continue
+
+                # Find the warmer
+                warmer = next((warmer for warmer in warmers if warmer.matches_key(key)), None)
+                if warmer is None:
+                    continue
+
+                # Drop if overloaded
+                if len(self._queue) >= self._max_queue:
+                    logger.warning(f'Warming queue is full; dropped {key!r}')
+                    continue
+
+                heapq.heappush(self._queue, (-self._hits.get(key, 0), next(self._seq), key, warmer))
+                self._scheduled.add(key)
+
+            self._start_dispatcher()
+            self._lock.notify_all()
+
+    def _start_dispatcher(self):
+        if self._dispatcher is None:
+            self._dispatcher = threading.Thread(target=self._dispatch, name='matroska-warm-dispatcher', daemon=True)
+            self._dispatcher.start()
+
+    def _dispatch(self):
+        """ Dispatcher thread: feed the executor with the hottest keys, respecting the rate limit """
+        while True:
+            with self._lock:
+                # Wait for a job and a free worker. Keeping the queue here, not in the executor, is what makes priorities work
+                while not self._queue or self._running >= self._max_workers:
+                    self._lock.wait()
+                _, _, key, warmer = heapq.heappop(self._queue)
+                self._scheduled.discard(key)
+                self._running += 1
+
+            # Rate limit
+            if self._rate_limit:
+                now = time.monotonic()
+                if self._next_run_at > now:
+                    time.sleep(self._next_run_at - now)
+                self._next_run_at = max(now, self._next_run_at) + 1 / self._rate_limit
+
+            future = self._executor.submit(warmer.func, key)
+            future.add_done_callback(lambda future, key=key: self._done(key, future))
+
+    def _done(self, key: str, future: Future):
+        with self._lock:
+            self._running -= 1
+            self._lock.notify_all()
+
+        if future.exception() is not None:
+            logger.error(f'Warmer failed for {key!r}', exc_info=future.exception())
+
+    def wait_idle(self, timeout: Optional[float] = None) -> bool:
+        """ Wait until all scheduled keys are warmed
+
+        Returns:
+            True if idle, False on timeout
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._lock:
+            while self._queue or self._running:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._lock.wait(remaining)
+            return True
@@ -0,0 +1,120 @@
+""" Memory benchmark: plain keys vs. small values packed into hashes
+
+Puts the same entries into a real Redis twice, with `RedisBackend()` and with `RedisBackend(small_values=)`,
+and compares `used_memory`. Also times put() and get() for both.
+
+Run it:
+
+    python -m tests.benchmark                                     # spawns a local redis-server
+    python -m tests.benchmark --url redis://localhost:6379/15 --entries 100000 --value-size 100
+
+NOTE: it runs FLUSHDB on the database it's given!
+"""
+import argparse
+import contextlib
+import random
+import string
+import time
+from typing import Any, Dict
+
+from redis import Redis
+
+from matroska_cache import dep
+from matroska_cache.backends.redis import RedisBackend
+
+from .stress import spawn_redis_server
+
+
+def measure_memory(redis: Redis, *, entries: int, value_size: int, dependencies: int, seed: int = 0, **options) -> Dict[str, Any]:
+    """ Put `entries` into an empty database; measure the memory they take, and the time put() and get() take
+
+    Args:
+        redis: Redis client, `decode_responses=True`. The database is flushed!
+        entries: The number of entries to put
+        value_size: The length of every value
+        dependencies: Every entry depends on that many dependencies, from a pool of `entries // 10`
+        **options: RedisBackend options
+    """
+    rng = random.Random(seed)
+    backend = RedisBackend(redis, prefix='bench', **options)
+    pool = [dep.Id('article', i) for i in range(max(entries // 10, dependencies))]
+    values = [''.join(rng.choices(string.ascii_letters, k=value_size)) for _ in range(100)]
+
+    redis.flushdb()
+    used_before = redis.info('memory')['used_memory']
+
+    started_at = time.perf_counter()
+    for i in range(entries):
+        backend.put(f'entry-{i}', values[i % len(values)], rng.sample(pool, dependencies), expires=3600)
+    put_seconds = time.perf_counter() - started_at
+
+    used = redis.info('memory')['used_memory'] - used_before
+
+    started_at = time.perf_counter()
+    for i in range(entries):
+        backend.get(f'entry-{i}')
+    get_seconds = time.perf_counter() - started_at
+
+    redis.flushdb()
+    return {
+        'used_memory': used,
+        'bytes_per_entry': used / entries,
+        'put_us': put_seconds / entries * 1e6,
+        'get_us': get_seconds / entries * 1e6,
+    }
+
+
+def compare(redis: Redis, *, entries: int, value_size: int, dependencies: int, small_buckets: int = None) -> Dict[str, Dict[str, Any]]:
+    """ Measure plain keys vs. small values
+
+    Returns:
+        { 'plain' => measurements, 'small' => measurements }
+    """
+    # Small hashes have to stay listpacks. Redis 7.0+ accepts both names
+    redis.config_set('hash-max-ziplist-value', max(value_size * 2, 64))
+    redis.config_set('hash-max-ziplist-entries', 256)
+
+    if small_buckets is None:
+        small_buckets = max(entries // 100, 1)
+
+    return {
+        'plain': measure_memory(redis, entries=entries, value_size=value_size, dependencies=dependencies),
+        'small': measure_memory(redis, entries=entries, value_size=value_size, dependencies=dependencies,
+                                small_values=value_size * 2, small_buckets=small_buckets),
+    }
+
+
+def format_report(results: Dict[str, Dict[str, Any]]) -> str:
+    lines = []
+    for mode, result in results.items():
+        lines.append(f'{mode:>6}: {result["used_memory"]:>12} bytes, {result["bytes_per_entry"]:7.1f} bytes/entry, '
+                     f'put {result["put_us"]:7.1f}us, get {result["get_us"]:7.1f}us')
+    saved = 1 - results['small']['used_memory'] / results['plain']['used_memory']
+    lines.append(f'Saved: {saved:.1%}')
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare Redis memory usage: plain keys vs. small values')
+    parser.add_argument('--url', help='Redis URL. The database is flushed! Default: spawn a local redis-server')
+    parser.add_argument('--entries', type=int, default=20000)
+    parser.add_argument('--value-size', type=int, default=100)
+    parser.add_argument('--dependencies', type=int, default=0, help='Dependencies per entry')
+    parser.add_argument('--small-buckets', type=int, default=None, help='Default: entries / 100')
+    args = parser.parse_args()
+
+    with contextlib.ExitStack() as stack:
+        url = args.url or stack.enter_context(spawn_redis_server())
+        results = compare(
+            Redis.from_url(url, decode_responses=True),
+            entries=args.entries,
+            value_size=args.value_size,
+            dependencies=args.dependencies,
+            small_buckets=args.small_buckets,
+        )
+
+    print(format_report(results))
+
+
+if __name__ == '__main__':
+    main()
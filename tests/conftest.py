@@ -1,3 +1,5 @@
+import os
+
 import pytest
 from fakeredis import FakeRedis
 
@@ -5,3 +7,23 @@ from fakeredis import FakeRedis
 @pytest.fixture()
 def redis():
     return FakeRedis(encoding="utf-8", decode_responses=True)
+
+
+@pytest.fixture()
+def redis_cluster():
+    """ A real Redis Cluster client. Skipped unless REDIS_CLUSTER_URL is set.
+
+    Start a local cluster of 3 redis-server processes:
+
+        for port in 7000 7001 7002; do redis-server --port $port --cluster-enabled yes --cluster-config-file nodes-$port.conf --save '' --daemonize yes; done
+        redis-cli --cluster create 127.0.0.1:7000 127.0.0.1:7001 127.0.0.1:7002 --cluster-yes
+        REDIS_CLUSTER_URL=redis://127.0.0.1:7000 pytest tests/
+    """
+    url = os.environ.get('REDIS_CLUSTER_URL')
+    if not url:
+        pytest.skip('Set REDIS_CLUSTER_URL to test against a Redis Cluster')
+
+    RedisCluster = pytest.importorskip('redis.cluster').RedisCluster
+    redis = RedisCluster.from_url(url, decode_responses=True)
+    redis.flushall()
+    return redis
@@ -0,0 +1,327 @@
+""" Concurrency stress test for cache backends
+
+Many workers do interleaved put() / get() / invalidate() on keys with overlapping dependencies,
+and every operation is logged with its start and end time.
+The log is then checked for the invariant:
+
+    after invalidate(d) returns, no entry that depended on d is readable
+
+That is, a get() must not return a value if it was put() before an invalidation of one of its dependencies started,
+and that invalidation had completed before the get() started.
+Operations that overlap in time are concurrent, and nothing is guaranteed about them.
+
+Run it:
+
+    python -m tests.stress --backend fakeredis
+    python -m tests.stress --backend redis                       # spawns a local redis-server
+    python -m tests.stress --backend redis --url redis://localhost:6379/0 --processes
+    python -m tests.stress --backend sqlite --processes
+
+Use it from tests:
+
+    result = run_stress(functools.partial(fakeredis_backend, server), workers=8, operations=500)
+    assert not result.violations
+"""
+import argparse
+import bisect
+import contextlib
+import functools
+import multiprocessing
+import os
+import random
+import shutil
+import socket
+import subprocess
+import tempfile
+import threading
+import time
+from collections import Counter
+from dataclasses import dataclass, field
+from typing import Callable, Dict, Iterator, List, Tuple
+
+from matroska_cache import dep
+from matroska_cache.backends.base import MatroskaCacheBackendBase, NotInCache
+
+
+# Makes a backend for a worker. Must be picklable in process mode: use functools.partial() on a module-level function
+BackendFactory = Callable[[], MatroskaCacheBackendBase]
+
+
+@dataclass
+class StressResult:
+    """ The result of run_stress() """
+    # The number of operations, and how long they took
+    operations: int
+    seconds: float
+    # get() calls that found something
+    hits: int
+    # Backend counters, summed over workers. E.g. RedisBackend: 'watch_retries', 'watch_giveups'
+    stats: Counter
+    # Invariant violations: human-readable descriptions
+    violations: List[str] = field(default_factory=list)
+
+    @property
+    def throughput(self) -> float:
+        """ Operations per second """
+        return self.operations / self.seconds if self.seconds else 0.0
+
+    def report(self) -> str:
+        lines = [
+            f'{self.operations} operations in {self.seconds:.2f}s: {self.throughput:.0f} ops/s, {self.hits} hits',
+            'Backend stats: ' + (', '.join(f'{k}={v}' for k, v in sorted(self.stats.items())) or '-'),
+            f'Violations: {len(self.violations)}',
+        ]
+        lines.extend(f'  {violation}' for violation in self.violations[:20])
+        return '\n'.join(lines)
+
+
+def run_stress(backend_factory: BackendFactory, *,
+               workers: int = 8,
+               operations: int = 1000,
+               keys: int = 50,
+               dependencies: int = 10,
+               dependencies_per_key: int = 3,
+               processes: bool = False,
+               seed: int = 0,
+               ) -> StressResult:
+    """ Run a stress test against a backend
+
+    Args:
+        backend_factory: Makes a backend. Every worker makes its own.
+        workers: The number of concurrent workers
+        operations: The number of operations per worker
+        keys: The number of cache keys to work with
+        dependencies: The number of distinct dependencies. Fewer dependencies = more contention.
+        dependencies_per_key: The number of dependencies every key has
+        processes: Use processes instead of threads
+        seed: Random seed, for reproducibility
+    """
+    # Which key depends on what. Same for every worker
+    rnd = random.Random(seed)
+    key_dependencies = {
+        f'key-{i}': tuple(sorted(rnd.sample(range(dependencies), min(dependencies_per_key, dependencies))))
+        for i in range(keys)
+    }
+    args = [(backend_factory, key_dependencies, operations, seed + n, n) for n in range(workers)]
+
+    started_at = time.monotonic()
+    if processes:
+        with multiprocessing.get_context('spawn').Pool(workers) as pool:
+            logs = pool.starmap(_worker, args)
+    else:
+        logs = [None] * workers
+        barrier = threading.Barrier(workers)
+
+        def thread(n: int):
+            barrier.wait()
+            logs[n] = _worker(*args[n])
+
+        threads = [threading.Thread(target=thread, args=(n,)) for n in range(workers)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+    seconds = time.monotonic() - started_at
+
+    # Merge logs
+    log = WorkerLog()
+    for worker_log in logs:
+        log.merge(worker_log)
+
+    return StressResult(
+        operations=workers * operations,
+        seconds=seconds,
+        hits=len(log.gets),
+        stats=log.stats,
+        violations=find_violations(log, key_dependencies),
+    )
+
+
+@dataclass
+class WorkerLog:
+    """ What a worker did """
+    # value => put() end time
+    puts: Dict[str, float] = field(default_factory=dict)
+    # (key, value, start time): get() calls that found something
+    gets: List[Tuple[str, str, float]] = field(default_factory=list)
+    # (dependency, start time, end time)
+    invalidations: List[Tuple[int, float, float]] = field(default_factory=list)
+    # Backend counters
+    stats: Counter = field(default_factory=Counter)
+
+    def merge(self, other: 'WorkerLog'):
+        self.puts.update(other.puts)
+        self.gets.extend(other.gets)
+        self.invalidations.extend(other.invalidations)
+        self.stats.update(other.stats)
+
+
+def _worker(backend_factory: BackendFactory, key_dependencies: Dict[str, Tuple[int, ...]], operations: int, seed: int, n: int) -> WorkerLog:
+    """ Do random operations, log them """
+    backend = backend_factory()
+    rnd = random.Random(seed)
+    all_keys = list(key_dependencies)
+    all_dependencies = sorted({d for deps in key_dependencies.values() for d in deps})
+    clock = time.monotonic
+    log = WorkerLog()
+
+    for i in range(operations):
+        op = rnd.random()
+        if op < 0.4:
+            key = rnd.choice(all_keys)
+            started_at = clock()
+            try:
+                value = backend.get(key)
+            except NotInCache:
+                continue
+            log.gets.append((key, value, started_at))
+        elif op < 0.8:
+            key = rnd.choice(all_keys)
+            value = f'{key}@{n}.{i}'
+            stored = backend.put(key, value, [dep.Tag(f'd{d}') for d in key_dependencies[key]], expires=600)
+            if stored is not False:
+                log.puts[value] = clock()
+        else:
+            d = rnd.choice(all_dependencies)
+            started_at = clock()
+            backend.invalidate([dep.Tag(f'd{d}')])
+            log.invalidations.append((d, started_at, clock()))
+
+    log.stats.update(getattr(backend, 'stats', None) or {})
+    return log
+
+
+def find_violations(log: WorkerLog, key_dependencies: Dict[str, Tuple[int, ...]]) -> List[str]:
+    """ Find get() calls that returned values which had to be invalidated """
+    # Per dependency: invalidations sorted by start time, and the earliest end time among those that start later
+    invalidation_starts: Dict[int, List[float]] = {}
+    earliest_end_after: Dict[int, List[float]] = {}
+    by_dependency: Dict[int, List[Tuple[float, float]]] = {}
+    for d, started_at, ended_at in log.invalidations:
+        by_dependency.setdefault(d, []).append((started_at, ended_at))
+    for d, invalidations in by_dependency.items():
+        invalidations.sort()
+        invalidation_starts[d] = [started_at for started_at, _ in invalidations]
+        suffix_min = [float('inf')] * (len(invalidations) + 1)
+        for i in range(len(invalidations) - 1, -1, -1):
+            suffix_min[i] = min(suffix_min[i + 1], invalidations[i][1])
+        earliest_end_after[d] = suffix_min
+
+    violations = []
+    for key, value, get_started_at in log.gets:
+        put_ended_at = log.puts.get(value)
+        if put_ended_at is None:
+            violations.append(f'get({key!r}) returned {value!r}, which was never put')
+            continue
+        for d in key_dependencies[key]:
+            if d not in invalidation_starts:
+                continue
+            # Invalidations that started after the put() ended ...
+            i = bisect.bisect_right(invalidation_starts[d], put_ended_at)
+            # ... and the earliest of them to end, ended before the get() started
+            if earliest_end_after[d][i] < get_started_at:
+                violations.append(f'get({key!r}) returned {value!r} after its dependency d{d} was invalidated')
+                break
+    return violations
+
+
+# region Backends
+
+def fakeredis_backend(server, **options) -> MatroskaCacheBackendBase:
+    """ RedisBackend on a fakeredis server. Threads only: every client has to share the `server` """
+    from fakeredis import FakeRedis
+    from matroska_cache.backends.redis import RedisBackend
+    return RedisBackend(FakeRedis(server=server, decode_responses=True), prefix='stress', **options)
+
+
+def redis_backend(url: str, prefix: str = 'stress', **options) -> MatroskaCacheBackendBase:
+    """ RedisBackend on a real Redis """
+    from redis import Redis
+    from matroska_cache.backends.redis import RedisBackend
+    return RedisBackend(Redis.from_url(url, decode_responses=True), prefix=prefix, **options)
+
+
+def sqlite_backend(path: str) -> MatroskaCacheBackendBase:
+    from matroska_cache.backends.sqlite import SQLiteBackend
+    return SQLiteBackend(path)
+
+
+@contextlib.contextmanager
+def spawn_redis_server() -> Iterator[str]:
+    """ Start a throwaway redis-server on a free port; yield its URL """
+    executable = shutil.which('redis-server')
+    if executable is None:
+        raise RuntimeError('redis-server is not installed')
+
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+
+    process = subprocess.Popen(
+        [executable, '--port', str(port), '--bind', '127.0.0.1', '--save', '', '--appendonly', 'no'],
+        stdout=subprocess.DEVNULL,
+    )
+    try:
+        # Wait until it accepts connections
+        from redis import Redis, ConnectionError
+        url = f'redis://127.0.0.1:{port}/0'
+        for _ in range(100):
+            try:
+                Redis.from_url(url).ping()
+                break
+            except ConnectionError:
+                time.sleep(0.05)
+        else:
+            raise RuntimeError('redis-server did not start')
+        yield url
+    finally:
+        process.terminate()
+        process.wait()
+
+# endregion
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Stress-test a cache backend for concurrency bugs')
+    parser.add_argument('--backend', choices=('fakeredis', 'redis', 'sqlite'), default='fakeredis')
+    parser.add_argument('--url', help='Redis URL. Default: spawn a local redis-server')
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--operations', type=int, default=1000, help='Operations per worker')
+    parser.add_argument('--keys', type=int, default=50)
+    parser.add_argument('--dependencies', type=int, default=10)
+    parser.add_argument('--processes', action='store_true', help='Use processes instead of threads')
+    parser.add_argument('--small-values', type=int, default=0, help='RedisBackend(small_values=)')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    with contextlib.ExitStack() as stack:
+        if args.backend == 'fakeredis':
+            if args.processes:
+                parser.error('fakeredis is in-process: it does not support --processes')
+            from fakeredis import FakeServer
+            factory = functools.partial(fakeredis_backend, FakeServer(), small_values=args.small_values)
+        elif args.backend == 'redis':
+            url = args.url or stack.enter_context(spawn_redis_server())
+            # A fresh prefix: leftovers from previous runs would look like violations
+            factory = functools.partial(redis_backend, url, prefix=f'stress-{os.getpid()}-{time.time():.0f}',
+                                        small_values=args.small_values)
+        else:
+            tmpdir = stack.enter_context(tempfile.TemporaryDirectory())
+            factory = functools.partial(sqlite_backend, os.path.join(tmpdir, 'cache.sqlite'))
+
+        result = run_stress(
+            factory,
+            workers=args.workers,
+            operations=args.operations,
+            keys=args.keys,
+            dependencies=args.dependencies,
+            processes=args.processes,
+            seed=args.seed,
+        )
+
+    print(result.report())
+    raise SystemExit(1 if result.violations else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,23 @@
+import asyncio
+import contextlib
 import dataclasses
+import functools
+import io
+import json
+import os
+import shutil
+import subprocess
+import sys
+import threading
+import time
 from typing import MutableMapping
+from unittest import mock
 
 import pytest
 import sqlalchemy as sa
 import sqlalchemy.ext.declarative
 from fakeredis import FakeRedis
+from redis import WatchError
 
 from matroska_cache import MatroskaCache, dep, NotInCache
 from matroska_cache import sa_dependencies
@@ -12,6 +25,31 @@ from matroska_cache.backends.redis import RedisBackend
 from .lib import sa_set_committed_state
 
 
+def run_threads(n: int, target):
+    """ Run `target(i)` in `n` threads; re-raise the first error """
+    errors = []
+
+    def run(i: int):
+        try:
+            target(i)
+        except Exception as e:
+            errors.append(e)
+
+    # Switch threads often: to catch races
+    switch_interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    try:
+        threads = [threading.Thread(target=run, args=(i,)) for i in range(n)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        sys.setswitchinterval(switch_interval)
+    if errors:
+        raise errors[0]
+
+
 def test_cache_plain_dependencies(redis: FakeRedis):
     """ Test Matroska cache with plain dependencies """
     cache = MatroskaCache(backend=RedisBackend(redis, prefix='cache'))
@@ -184,6 +222,7 @@ def test_collection_dependencies(redis: FakeRedis):
             # scopes (rdep)
             'cache::rdep::condition:book:&category=sci-fi&',
             'cache::rdep::condition:book::InvalidateAll',
+            'cache::rdep::condition:book::fallback:category',
         }
 
         # Make sure they're all going to expire
@@ -253,3 +292,1241 @@ def test_collection_dependencies(redis: FakeRedis):
 
     main()
 
+
+
+def test_deferred_invalidation(redis: FakeRedis):
+    """ Test deferred_invalidation(): batching, deduplication, background mode """
+    cache = MatroskaCache(backend=RedisBackend(redis, prefix='cache'))
+
+    # Count calls to the backend
+    backend_calls = []
+    backend_invalidate = cache.backend.invalidate
+    cache.backend.invalidate = lambda dependencies: (backend_calls.append(list(dependencies)), backend_invalidate(dependencies))
+
+    # Deferred: nothing is invalidated until the block exits
+    cache.put('a', 1, dep.Id('article', 1), expires=100)
+    cache.put('b', 2, dep.Tag('homepage'), expires=100)
+    with cache.deferred_invalidation():
+        cache.invalidate(dep.Id('article', 1))
+        with cache.deferred_invalidation():  # nested: joins the outer one
+            cache.invalidate(dep.Id('article', 1), dep.Tag('homepage'))
+        assert cache.has('a') and cache.has('b')
+        assert backend_calls == []
+
+    # One call, deduplicated
+    assert backend_calls == [[dep.Id('article', 1), dep.Tag('homepage')]]
+    assert not cache.has('a') and not cache.has('b')
+
+    # Failed block: still invalidated
+    cache.put('a', 1, dep.Id('article', 1), expires=100)
+    with pytest.raises(ZeroDivisionError):
+        with cache.deferred_invalidation():
+            cache.invalidate(dep.Id('article', 1))
+            1/0
+    assert not cache.has('a')
+
+    # Background mode
+    cache.put('a', 1, dep.Id('article', 1), expires=100)
+    with cache.deferred_invalidation(background=True):
+        cache.invalidate(dep.Id('article', 1))
+    assert cache.wait_invalidated(timeout=5)
+    assert not cache.has('a')
+
+
+def test_warming(redis: FakeRedis):
+    """ Test warmers: invalidated keys are recomputed in the background """
+    from matroska_cache.warming import WarmingRegistry
+    from matroska_cache.dep.scopes import ConditionalDependency
+
+    cache = MatroskaCache(backend=RedisBackend(redis, prefix='cache'))
+    cache.warmers = WarmingRegistry(max_workers=1)
+    warmed = []
+
+    @cache.warmers.warms('articles:*', dependency=ConditionalDependency)
+    def warm_articles(key: str):
+        warmed.append(key)
+        cache.put(key, 'warm', *article_scopes.condition(category=key.split(':')[1]), expires=100)
+
+    article_scopes = dep.Scopes('article', production_mode=False)
+
+    @article_scopes.describes('category')
+    def article_category(article: dict):
+        return {'category': article['category']}
+
+    cache.put('articles:python', 'cold', *article_scopes.condition(category='python'), dep.Id('article', 1), expires=100)
+    cache.put('articles:rust', 'cold', *article_scopes.condition(category='rust'), expires=100)
+    cache.put('other', 'cold', *article_scopes.condition(category='python'), expires=100)
+
+    # Invalidated by Id: not a dependency this warmer is interested in
+    assert cache.invalidate(dep.Id('article', 1)) == ['articles:python']
+    assert cache.warmers.wait_idle(timeout=5)
+    assert warmed == []
+
+    # Invalidated by condition: warmed. 'other' does not match the pattern
+    cache.put('articles:python', 'cold', *article_scopes.condition(category='python'), expires=100)
+    article_scopes.invalidate_for({'category': 'python'}, cache)
+    assert cache.warmers.wait_idle(timeout=5)
+    assert warmed == ['articles:python']
+    assert cache.get('articles:python') == 'warm'
+    assert cache.get('articles:rust') == 'cold'
+    assert not cache.has('other')
+
+    # Hits are counted from many request threads at once
+    registry = WarmingRegistry(max_workers=1, hits_decay=0.001)
+    run_threads(4, lambda n: [registry.record_hit(f'key-{n}-{i}') for i in range(20000)])
+
+    # A custom executor: `max_workers` still limits how many warmers run at once
+    from concurrent.futures import ThreadPoolExecutor
+    registry = WarmingRegistry(ThreadPoolExecutor(8), max_workers=2)
+    running, max_running, lock = [0], [0], threading.Lock()
+
+    @registry.warms()
+    def warm_slowly(key: str):
+        with lock:
+            running[0] += 1
+            max_running[0] = max(max_running[0], running[0])
+        time.sleep(0.01)
+        with lock:
+            running[0] -= 1
+
+    registry.schedule([f'key-{i}' for i in range(10)], [dep.Id('article', 1)])
+    assert registry.wait_idle(timeout=5)
+    assert max_running[0] == 2
+
+
+def test_inspect_dependencies(redis: FakeRedis):
+    """ Test the dependency graph inspection tool """
+    from matroska_cache.inspect import inspect_dependencies, format_report
+
+    cache = MatroskaCache(backend=RedisBackend(redis, prefix='cache'))
+    for i in range(5):
+        cache.put(f'article-{i}', i, dep.Id('article', i), dep.Tag('articles'), expires=100)
+    cache.put('tags', 1, dep.Tag('other'), expires=100)
+
+    # Simulate an expired data key
+    redis.delete('cache::data::article-0')
+
+    report = inspect_dependencies(redis, 'cache', top=2, scan_count=3)
+    assert report['types']['id']['dependencies'] == 5
+    assert report['types']['id']['histogram'] == {'1': 5}
+    assert report['types']['id']['dead_members'] == 1
+    assert report['types']['tag']['dependencies'] == 2
+    assert report['types']['tag']['members'] == 6
+    assert report['types']['tag']['histogram'] == {'1': 1, '4-7': 1}
+    assert report['top'][0] == {'dependency': 'tag:articles', 'members': 5}
+    assert len(report['top']) == 2
+
+    # Formats fine
+    assert 'tag:articles' in format_report(report)
+
+
+def test_admission_policy(redis: FakeRedis):
+    """ Test cost-aware admission """
+    from matroska_cache.admission import AdmissionPolicy
+
+    cache = MatroskaCache(backend=RedisBackend(redis, prefix='cache'))
+    decisions = []
+    cache.admission = AdmissionPolicy(reject_below=0.01, cap_below=0.1, capped_expires=30, hooks=[decisions.append])
+
+    # Unknown cost: stored
+    cache.put('a', 'x' * 1024, expires=600)
+    assert cache.has('a')
+
+    # Cheap, large, never requested: rejected
+    cache.put('b', 'x' * 10240, expires=600, cost=0.001)
+    assert not cache.has('b')
+
+    # Requested a few times: now it's worth a capped TTL
+    for i in range(5):
+        with pytest.raises(NotInCache):
+            cache.get('b')
+    cache.put('b', 'x' * 10240, expires=600, cost=0.1)
+    assert cache.has('b')
+    assert redis.ttl('cache::data::b') == 30
+
+    # Expensive: stored as is
+    cache.put('c', 'x' * 1024, expires=600, cost=1)
+    assert redis.ttl('cache::data::c') == 600
+
+    # Reported through the hook
+    assert [(d.key, d.reason, d.frequency) for d in decisions] == [
+        ('a', 'unknown-cost', 0),
+        ('b', 'reject', 0),
+        ('b', 'cap', 5),
+        ('c', 'admit', 0),
+    ]
+
+    # The payload is serialized once: for the admission policy, the recorder, and the backend
+    from matroska_cache.replay import Recorder
+    cache.recorder = Recorder(io.BytesIO())
+    with mock.patch('json.dumps', wraps=json.dumps) as dumps:
+        cache.put('d', {'title': 'x' * 1024}, expires=600, cost=1)
+    assert dumps.call_count == 1
+    assert decisions[-1].size == len(json.dumps({'title': 'x' * 1024}))
+    assert cache.get('d') == {'title': 'x' * 1024}
+
+    # The sketch: 32-bit counters that saturate
+    from matroska_cache.sketch import CountMinSketch, MAX_COUNT
+    sketch = CountMinSketch(4096, 4, reset_after=2 ** 40)
+    assert sum(len(table) * table.itemsize for table in sketch._tables) == 64 * 1024
+    assert sketch.add('a', MAX_COUNT - 1) == MAX_COUNT - 1
+    assert sketch.add('a', 10) == MAX_COUNT
+
+    # Counted from many request threads at once: nothing is lost
+    policy = AdmissionPolicy(sketch=CountMinSketch(reset_after=2 ** 40))
+    run_threads(4, lambda n: [policy.record_access('hot') for i in range(5000)])
+    assert policy.sketch.estimate('hot') == 20000
+
+
+def test_import_time():
+    """ Import time regression test: `import matroska_cache` is fast and does not import heavy stuff """
+    # Import it in a clean interpreter
+    process = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c',
+         'import sys, matroska_cache; print(" ".join(m for m in ("sqlalchemy", "redis", "pkg_resources") if m in sys.modules))'],
+        cwd=os.path.dirname(os.path.dirname(__file__)),
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, check=True,
+    )
+
+    # Nothing heavy is imported
+    assert process.stdout.strip() == ''
+
+    # Cumulative import time, microseconds. Format: "import time: self | cumulative | name"
+    import_times = {
+        name.strip(): int(cumulative)
+        for _, cumulative, name in (line.rsplit('|', 2) for line in process.stderr.splitlines() if line.startswith('import time:') and '|' in line)
+        if cumulative.strip().isdigit()
+    }
+    assert import_times['matroska_cache'] < IMPORT_TIME_BUDGET_US
+
+    # Lazy attributes still work
+    import matroska_cache
+    assert matroska_cache.__version__
+    assert matroska_cache.sa_dependencies
+    assert dep.PrimaryKey
+
+
+# `import matroska_cache` must not take longer than this
+IMPORT_TIME_BUDGET_US = 300_000
+
+
+def test_cluster_mode(redis: FakeRedis):
+    """ Test the Redis Cluster mode of RedisBackend, on a single node """
+    from matroska_cache.backends.cluster import key_slot
+
+    # Slots: same as CLUSTER KEYSLOT
+    assert key_slot('123456789') == 12739
+    assert key_slot('{user1000}.following') == key_slot('user1000') == 3443
+
+    check_cluster_mode(redis)
+
+    # TTLs are only prolonged
+    cache = MatroskaCache(backend=RedisBackend(redis, prefix='cache', cluster=True))
+    cache.put('a', 1, dep.Tag('t'), expires=100)
+    cache.put('b', 1, dep.Tag('t'), expires=10)
+    assert redis.ttl('cache::rdep::tag:t') == 100
+
+
+def test_cluster_mode_real_cluster(redis_cluster):
+    """ Test the Redis Cluster mode against a real cluster """
+    check_cluster_mode(redis_cluster)
+
+
+def check_cluster_mode(redis):
+    cache = MatroskaCache(backend=RedisBackend(redis, prefix='cache', cluster=True))
+
+    # Keys all over the slots
+    for i in range(20):
+        cache.put(f'article-{i}', i, dep.Id('article', i), dep.Tag('articles'), expires=100)
+    assert cache.get('article-1') == 1
+
+    # Invalidate one
+    assert cache.invalidate(dep.Id('article', 1)) == ['article-1']
+    assert not cache.has('article-1')
+    assert cache.has('article-2')
+
+    # Invalidate all. 'article-1' is still referenced by the tag, so it's reported again
+    assert sorted(cache.invalidate(dep.Tag('articles'), dep.Id('article', 5))) == sorted(f'article-{i}' for i in range(20))
+    assert not cache.has('article-2')
+
+    # Rdep sets are cleaned up
+    assert redis.scard('cache::rdep::tag:articles') == 0
+
+
+def test_read_replicas(redis: FakeRedis):
+    """ Test read replicas routing and the read-your-invalidations guard """
+    # Replicas: separate servers. We'll simulate replication lag by writing to them directly
+    replicas = [FakeRedis(encoding="utf-8", decode_responses=True) for _ in range(2)]
+    backend = RedisBackend(redis, prefix='cache', replicas=replicas, read_your_invalidations=60)
+    cache = MatroskaCache(backend=backend)
+
+    # Writes go to the primary
+    cache.put('a', 1, dep.Id('article', 1), expires=100)
+    assert redis.get('cache::data::a') == 'j1'
+
+    # Reads go to the replicas, round-robin
+    for replica in replicas:
+        replica.set('cache::data::a', 'sreplica')
+        replica.set('cache::data::b', 'sb')
+    assert cache.get('a') == 'replica'
+    assert cache.get_many(['a', 'b', 'z']) == {'a': 'replica', 'b': 'b'}
+    assert cache.has('b')
+
+    # Invalidate: read from the primary for a while, so that a lagging replica does not resurrect the entry
+    cache.invalidate(dep.Id('article', 1))
+    assert not cache.has('a')
+    assert cache.get_many(['a', 'b']) == {}
+
+    # Window is over: back to replicas
+    backend._read_primary_until = 0
+    assert cache.has('a')
+
+
+def test_coarsening(redis: FakeRedis):
+    """ Test dependency coarsening: huge lists of Ids collapse into buckets """
+    from matroska_cache.dep.bucket import Coarsening
+
+    cache = MatroskaCache(backend=RedisBackend(redis, prefix='cache'))
+    cache.coarsening = Coarsening(threshold=10, buckets=8)
+
+    # Below the threshold: as is
+    cache.put('few', 1, *[dep.Id('article', i) for i in range(10)], expires=100)
+    assert redis.exists('cache::rdep::id:article:9')
+
+    # Above the threshold: buckets
+    cache.put('many', 1, *[dep.Id('article', i) for i in range(1000)], dep.Id('user', 1), dep.Tag('t'), expires=100)
+    rdep_keys = {key for key in redis.keys('cache::rdep::*') if 'cache::data::many' in redis.smembers(key)}
+    assert len(rdep_keys) == 8 + 2
+    assert 'cache::rdep::id:article:bucket:0' in rdep_keys
+    assert 'cache::rdep::id:user:1' in rdep_keys
+
+    # Invalidate by Id: the bucket is invalidated as well
+    cache.invalidate(dep.Id('article', 500))
+    assert not cache.has('many')
+    assert cache.has('few')
+
+    # Range buckets
+    cache.coarsening = Coarsening(threshold=10, range_size=1000)
+    cache.put('many', 1, *[dep.PrimaryKey('Article', str(i)) for i in range(1000, 3000)], expires=100)
+    assert {key for key in redis.keys('cache::rdep::pk:*')} == {'cache::rdep::pk:Article:bucket:1', 'cache::rdep::pk:Article:bucket:2'}
+    cache.invalidate(dep.PrimaryKey('Article', 5000))
+    assert cache.has('many')
+    cache.invalidate(dep.PrimaryKey('Article', 2999))
+    assert not cache.has('many')
+
+
+@pytest.mark.parametrize('cluster', [False, True])
+def test_nested_entries(redis: FakeRedis, cluster: bool):
+    """ Test CacheKey dependencies: cascading invalidation """
+    cache = MatroskaCache(backend=RedisBackend(redis, prefix='cache', cluster=cluster))
+
+    # article -> page -> site
+    cache.put('article-1', 1, dep.Id('article', 1), expires=100)
+    cache.put('article-2', 2, dep.Id('article', 2), expires=100)
+    cache.put('page', [1, 2], dep.CacheKey('article-1'), dep.CacheKey('article-2'), expires=100)
+    cache.put('site', ['page'], dep.CacheKey('page'), expires=100)
+    cache.put('other', 1, dep.CacheKey('article-2'), expires=100)
+
+    # Cascade, transitively
+    assert sorted(cache.invalidate(dep.Id('article', 1))) == ['article-1', 'page', 'site']
+    assert not cache.has('site')
+    assert cache.has('article-2') and cache.has('other')
+
+    # delete() cascades too, and reports the cascaded keys
+    cache.put('page', [2], dep.CacheKey('article-2'), expires=100)
+    with cache.loader():
+        assert cache.get('page') == [2]
+        assert sorted(cache.delete('article-2')) == ['other', 'page']
+        with pytest.raises(NotInCache):
+            cache.get('page')  # not memoized
+    assert not cache.has('other')
+
+    # ... but without dependents, it's just an UNLINK: no transaction
+    cache.put('lonely', 1, expires=100)
+    with mock.patch.object(redis, 'pipeline', wraps=redis.pipeline) as pipeline:
+        assert cache.delete('lonely') == []
+    assert [call.kwargs for call in pipeline.call_args_list] == [{'transaction': False}]
+    assert not cache.has('lonely')
+
+    # Cycles are fine
+    cache.put('a', 1, dep.CacheKey('b'), expires=100)
+    cache.put('b', 1, dep.CacheKey('a'), dep.Tag('b'), expires=100)
+    assert sorted(cache.invalidate(dep.Tag('b'))) == ['a', 'b']
+    assert not cache.has('a')
+
+
+def test_get_tree(redis: FakeRedis):
+    """ Test get_tree(): fragments assembly """
+    from matroska_cache.fragments import fragment
+
+    cache = MatroskaCache(backend=RedisBackend(redis, prefix='cache'))
+
+    # Count round-trips
+    mgets = []
+    mget = redis.mget
+    redis.mget = lambda keys: (mgets.append(keys), mget(keys))[1]
+
+    cache.put('widget-1', {'w': 1, 'more': fragment('widget-3')}, expires=100)
+    cache.put('widget-2', {'w': 2, 'more': fragment('widget-3')}, expires=100)
+    cache.put('widget-3', {'w': 3, 'loop': fragment('dashboard')}, expires=100)
+    cache.put('dashboard', {
+        'title': 'Dashboard',
+        'widgets': [fragment('widget-1'), fragment('widget-2'), fragment('widget-missing')],
+    }, dep.CacheKey('widget-1'), dep.CacheKey('widget-2'), expires=100)
+
+    tree = cache.get_tree('dashboard')
+    assert tree.value == {
+        'title': 'Dashboard',
+        'widgets': [
+            {'w': 1, 'more': {'w': 3, 'loop': fragment('dashboard')}},  # cycle: left as is
+            {'w': 2, 'more': {'w': 3, 'loop': fragment('dashboard')}},
+            fragment('widget-missing'),  # missing: left as is
+        ],
+    }
+    assert tree.missing == {'widget-missing'}
+    assert len(mgets) == 3  # one per level
+
+    # Root missing
+    with pytest.raises(NotInCache):
+        cache.get_tree('nothing')
+
+
+def test_hotspots(redis: FakeRedis):
+    """ Test hot-spot tracking and the in-process cache for hot keys """
+    from matroska_cache.hotspots import HotspotTracker, LocalCache
+
+    cache = MatroskaCache(backend=RedisBackend(redis, prefix='cache'))
+    dumps = []
+    cache.hotspots = HotspotTracker(k=2, hot_threshold=5, local_ttl=60, dump_interval=0, on_dump=dumps.append)
+
+    cache.put('hot', 1, dep.Tag('homepage'), dep.Id('article', 1), expires=100)
+    cache.put('warm', 2, dep.Tag('homepage'), expires=100)
+    cache.put('cold', 3, dep.Tag('homepage'), expires=100)
+    for i in range(10):
+        cache.get('hot')
+    for i in range(3):
+        cache.get('warm')
+    cache.get('cold')
+    cache.invalidate(dep.Id('article', 2))
+
+    # Top offenders
+    assert cache.hotspots.top('get') == [('hot', 10), ('warm', 3)]
+    assert cache.hotspots.top('put', 1) == [('tag:homepage', 3)]
+    assert cache.hotspots.top('invalidate') == [('id:article:2', 1)]
+    assert dumps[-1] == cache.hotspots.dump()
+
+    # Hot keys are served from the process memory
+    redis.set('cache::data::hot', 'schanged behind our back')
+    assert cache.get('hot') == 1
+    assert cache.get('warm') == 2
+
+    # ... but local invalidations are seen
+    cache.invalidate(dep.Id('article', 1))
+    with pytest.raises(NotInCache):
+        cache.get('hot')
+
+    # on_dump is called without any locks held: a slow logger doesn't stall the cache
+    def on_dump(dump):
+        assert not tracker._lock.locked() and not any(lock.locked() for lock in tracker._channel_locks.values())
+        dumps.append(dump)
+        if len(dumps) == 1:
+            tracker.record('get', ['from-on-dump'])  # would deadlock under the lock
+
+    dumps = []
+    tracker = HotspotTracker(k=2, dump_interval=0, on_dump=on_dump)
+    tracker.record('get', ['a'])
+    assert [dump['get'] for dump in dumps] == [[('a', 1)], [('a', 1), ('from-on-dump', 1)]]
+
+    # TopK keeps its weakest candidate up to date
+    from matroska_cache.hotspots import TopK
+    topk = TopK(k=3)
+    for key in 'aabbbcddddeaaaaf':
+        topk.add(key)
+        if len(topk._candidates) == topk.k:
+            assert topk._min_count == min(topk._candidates.values()) == topk._candidates[topk._min_key]
+    assert topk.top() == [('a', 6), ('d', 4), ('b', 3)]
+    topk.decay()
+    assert topk._min_count == topk._candidates[topk._min_key] == 1
+
+    # The in-process cache is used from many request threads at once, and evicts while they read
+    local = LocalCache(ttl=60, max_size=50)
+    run_threads(4, lambda n: [(local.put(f'key-{n}-{i}', i), local.get(f'key-{n}-{i - 1}')) for i in range(5000)])
+    assert len(local._data) <= 50
+
+
+@pytest.mark.parametrize('cluster', [False, True])
+def test_race_safe_put(redis: FakeRedis, cluster: bool):
+    """ Test begin() tokens: refuse to put data computed before an invalidation """
+    cache = MatroskaCache(backend=RedisBackend(redis, prefix='cache', cluster=cluster, race_protection=True))
+
+    # No invalidation: stored
+    token = cache.begin(dep.Id('article', 1))
+    assert cache.put('article-1', 'fresh', dep.Id('article', 1), expires=100, token=token)
+    assert cache.get('article-1') == 'fresh'
+
+    # Invalidated in between: refused
+    token = cache.begin(dep.Id('article', 1), dep.Tag('articles'))
+    cache.invalidate(dep.Tag('articles'))  # another request
+    assert not cache.put('article-1', 'stale', dep.Id('article', 1), expires=100, token=token)
+    assert cache.get('article-1') == 'fresh'
+
+    # Invalidated before begin(): fine
+    token = cache.begin(dep.Id('article', 1), dep.Tag('articles'))
+    assert cache.put('article-1', 'fresher', dep.Id('article', 1), expires=100, token=token)
+    assert cache.get('article-1') == 'fresher'
+
+    # Versions are forgotten eventually
+    assert redis.ttl('cache::ver::tag:articles') > 0
+
+    # Nested entries: the invalidation cascades through `CacheKey`, and so do versions
+    cache.put('inner', 1, dep.Id('article', 5), expires=100)
+    token = cache.begin(dep.CacheKey('inner'))
+    cache.invalidate(dep.Id('article', 5))
+    assert not cache.put('outer', [1], dep.CacheKey('inner'), expires=100, token=token)
+
+    # Not supported without race protection
+    with pytest.raises(NotImplementedError):
+        MatroskaCache(backend=RedisBackend(redis, prefix='cache')).begin(dep.Id('article', 1))
+
+
+def test_sqlite_backend(tmp_path):
+    """ Test SQLiteBackend """
+    from matroska_cache.backends.sqlite import SQLiteBackend
+
+    path = str(tmp_path / 'cache.sqlite')
+    cache = MatroskaCache(backend=SQLiteBackend(path, race_protection=True))
+
+    # Plain dependencies
+    cache.put('articles-list', [{'id': 1}, {'id': 2}], dep.Id('article', 1), dep.Id('article', 2), expires=100)
+    cache.put('string', 'hey', expires=100)
+    assert cache.get('articles-list') == [{'id': 1}, {'id': 2}]
+    assert cache.get_many(['string', 'missing']) == {'string': 'hey'}
+    assert cache.invalidate(dep.Tag('hop')) == []
+    assert cache.invalidate(dep.Id('article', 1)) == ['articles-list']
+    assert not cache.has('articles-list')
+    with pytest.raises(NotInCache):
+        cache.get('articles-list')
+
+    # Shared between processes: another connection sees it
+    other = MatroskaCache(backend=SQLiteBackend(path))
+    assert other.get('string') == 'hey'
+    other.delete('string')
+    assert not cache.has('string')
+
+    # Nested entries
+    cache.put('inner', 1, dep.Id('article', 1), expires=100)
+    cache.put('outer', 2, dep.CacheKey('inner'), expires=100)
+    assert sorted(cache.invalidate(dep.Id('article', 1))) == ['inner', 'outer']
+
+    # Race protection
+    token = cache.begin(dep.Id('article', 1))
+    cache.invalidate(dep.Id('article', 1))
+    assert not cache.put('a', 1, dep.Id('article', 1), expires=100, token=token)
+    token = cache.begin(dep.Id('article', 1))
+    assert cache.put('a', 1, dep.Id('article', 1), expires=100, token=token)
+    with pytest.raises(NotImplementedError):
+        other.begin(dep.Id('article', 1))
+
+    # Expiration & cleanup
+    cache.put('expired', 1, dep.Id('article', 1), expires=-1)
+    assert not cache.has('expired')
+    cache.backend.cleanup()
+    c = cache.backend._connection()
+    assert c.execute('SELECT COUNT(*) FROM deps WHERE key = ?', ('expired',)).fetchone() == (0,)
+
+    # Size cap: entries that expire soonest are evicted
+    cache.backend.max_size = 100
+    for i in range(5):
+        cache.put(f'big-{i}', 'x' * 40, dep.Tag('big'), expires=100 + i)
+    cache.backend.cleanup()
+    assert [key for key in ('a', 'big-0', 'big-1', 'big-2', 'big-3', 'big-4') if cache.has(key)] == ['big-3', 'big-4']
+
+
+@pytest.mark.parametrize('backend', ['fakeredis', 'fakeredis-small', 'sqlite', 'redis-server'])
+def test_concurrency_stress(backend: str, tmp_path):
+    """ Concurrent put/get/invalidate: no stale reads after invalidate() returns """
+    from fakeredis import FakeServer
+    from . import stress
+
+    with contextlib.ExitStack() as stack:
+        if backend == 'fakeredis':
+            factory = functools.partial(stress.fakeredis_backend, FakeServer())
+        elif backend == 'fakeredis-small':
+            factory = functools.partial(stress.fakeredis_backend, FakeServer(), small_values=200, small_buckets=4)
+        elif backend == 'sqlite':
+            factory = functools.partial(stress.sqlite_backend, str(tmp_path / 'cache.sqlite'))
+        else:
+            if not shutil.which('redis-server'):
+                pytest.skip('redis-server is not installed')
+            factory = functools.partial(stress.redis_backend, stack.enter_context(stress.spawn_redis_server()))
+
+        result = stress.run_stress(factory, workers=4, operations=200, keys=20, dependencies=5)
+
+    assert result.hits > 0
+    assert not result.violations, result.report()
+    assert result.stats['watch_giveups'] == 0
+
+
+def test_sliding_expiration(redis: FakeRedis):
+    """ Test put(max_lifetime=): reads extend the TTL """
+    cache = MatroskaCache(backend=RedisBackend(redis, prefix='cache', sliding_expiration=True))
+
+    cache.put('sliding', {'a': 1}, dep.Id('article', 1), expires=10, max_lifetime=100)
+    cache.put('fixed', 'fixed', dep.Id('article', 1), expires=10)
+
+    # Dependencies live as long as the data may
+    assert 90 < redis.ttl('cache::rdep::id:article:1') <= 100
+
+    # Fresh: not extended
+    assert cache.get('sliding') == {'a': 1}
+    assert cache.backend.stats['sliding_extensions'] == 0
+
+    # Less than half the window remains: extended
+    redis.pexpire('cache::data::sliding', 2000)
+    redis.pexpire('cache::data::fixed', 2000)
+    assert cache.get_many(['sliding', 'fixed']) == {'sliding': {'a': 1}, 'fixed': 'fixed'}
+    assert redis.ttl('cache::data::sliding') > 5
+    assert redis.ttl('cache::data::fixed') <= 2
+    assert cache.backend.stats['sliding_extensions'] == 1
+
+    # Rate limited: no more EXPIREs until the next half-window
+    for i in range(10):
+        cache.get('sliding')
+    assert cache.backend.stats['sliding_extensions'] == 1
+
+    # Never beyond `max_lifetime`
+    cache.put('short', 'short', expires=10, max_lifetime=3)
+    redis.pexpire('cache::data::short', 1000)
+    assert cache.get('short') == 'short'
+    assert redis.pttl('cache::data::short') <= 3000
+
+    # Invalidation works as usual
+    assert sorted(cache.invalidate(dep.Id('article', 1))) == ['fixed', 'sliding']
+
+    # Not enabled
+    cache = MatroskaCache(backend=RedisBackend(redis, prefix='cache'))
+    with pytest.raises(NotImplementedError):
+        cache.put('sliding', 1, expires=10, max_lifetime=100)
+
+
+def test_loader(redis: FakeRedis):
+    """ Test loader(): batched & memoized reads """
+    cache = MatroskaCache(backend=RedisBackend(redis, prefix='cache'))
+    cache.put('a', {'a': 1}, dep.Id('article', 1), expires=100)
+    cache.put('b', 'b', dep.Id('article', 2), expires=100)
+
+    # Count round-trips
+    calls = []
+    get_many = cache.backend.get_many
+    cache.backend.get_many = lambda keys: calls.append(sorted(keys)) or get_many(keys)
+
+    with cache.loader():
+        a, b, c = cache.get_deferred('a'), cache.get_deferred('b'), cache.get_deferred('c')
+        assert not a.done()
+        assert a.result() == {'a': 1}
+        assert b.done() and b.result() == 'b'
+        with pytest.raises(NotInCache):
+            c.result()
+        assert calls == [['a', 'b', 'c']]
+
+        # Memoized: same object, no round-trip
+        assert cache.get('a') is a.result()
+        assert cache.get_many(['a', 'b', 'c']) == {'a': {'a': 1}, 'b': 'b'}
+        assert len(calls) == 1
+
+        # Writes are seen
+        cache.put('c', 'c', expires=100)
+        cache.invalidate(dep.Id('article', 1))
+        assert cache.get_many(['a', 'c']) == {'c': 'c'}
+        assert calls[1:] == [['a', 'c']]
+
+    # Outside: not memoized
+    assert cache.get_deferred('b').result() == 'b'
+    assert cache.get('b') == 'b'
+
+    # asyncio: keys are collected for one tick
+    async def main():
+        with cache.loader():
+            return await asyncio.gather(cache.get_deferred('b'), cache.get_deferred('c'))
+
+    calls.clear()
+    assert asyncio.run(main()) == ['b', 'c']
+    assert calls == [['b', 'c']]
+
+
+def test_adaptive_ttl(redis: FakeRedis):
+    """ Test adaptive TTLs """
+    from matroska_cache.adaptive import AdaptiveTTL
+
+    cache = MatroskaCache(backend=RedisBackend(redis, prefix='cache'))
+    cache.adaptive_ttl = AdaptiveTTL(redis, prefix='cache', min_ttl=10, max_ttl=10000, sample_rate=1.0, min_samples=10, refresh_interval=0)
+
+    # Not enough data: `expires` is used
+    cache.put('volatile-0', 1, dep.Id('volatile', 0), expires=600)
+    assert redis.ttl('cache::data::volatile-0') == 600
+
+    # Volatile entries: invalidated soon after they're born
+    for i in range(1, 20):
+        cache.put(f'volatile-{i}', 1, dep.Id('volatile', i), expires=600)
+    redis.delete('cache::born::volatile-0')  # as if it was put long ago: never mind
+    for i in range(1, 20):
+        cache.invalidate(dep.Id('volatile', i))
+    stats = cache.adaptive_ttl.stats('volatile-*')
+    assert stats['puts'] == 20 and stats['invalidations'] == 19
+    assert 600 <= stats['exposure'] < 610  # mostly, the one that was never invalidated
+
+    cache.put('volatile-100', 1, expires=600)
+    assert redis.ttl('cache::data::volatile-100') < 600
+
+    # Stable entries: never invalidated -> max_ttl
+    for i in range(10):
+        cache.put(f'stable-{i}', 1, expires=600)
+    cache.put('stable-100', 1, expires=600)
+    assert redis.ttl('cache::data::stable-100') == 10000
+
+
+def test_record_replay(redis: FakeRedis, tmp_path):
+    """ Test recording traffic, and replaying it """
+    from matroska_cache.replay import Recorder, read_log, replay, format_report, OP_GET, OP_PUT, OP_INVALIDATE
+
+    # Record
+    log = str(tmp_path / 'traffic.bin')
+    cache = MatroskaCache(backend=RedisBackend(redis, prefix='cache'))
+    cache.recorder = Recorder(log)
+    cache.put('article-1', 'x' * 100, dep.Id('article', 1), expires=100)
+    cache.put('page', [1, 2], dep.CacheKey('article-1'), expires=100)
+    assert cache.get('article-1')
+    cache.invalidate(dep.Id('article', 1))
+    with pytest.raises(NotInCache):
+        cache.get('page')
+    assert cache.get_many(['article-1']) == {}
+    cache.recorder.close()
+
+    records = list(read_log(log))
+    assert [r.op for r in records] == [OP_PUT, OP_PUT, OP_GET, OP_INVALIDATE, OP_GET, OP_GET]
+    assert records[0].size == 100 and records[0].dependencies == ('id:article:1',)
+    assert [r.hit for r in records if r.op == OP_GET] == [True, False, False]
+    assert 'article' not in records[1].dependencies[0]  # hashed
+
+    # Replay: against a different backend
+    report = replay(log, MatroskaCache(backend=RedisBackend(FakeRedis(decode_responses=True), prefix='replay')))
+    assert report['operations'] == {'get': 3, 'put': 2, 'invalidate': 1}
+    assert report['hit_rate'] == report['recorded_hit_rate'] == 1 / 3
+    assert report['fan_out'] == {'mean': 2, 'max': 2}  # cascaded to the page
+    assert 'Hit rate: 33.3%' in format_report(report)
+
+    # Tens of thousands of dependencies fit; recording failures never break the cache
+    log = str(tmp_path / 'many.bin')
+    cache.recorder = Recorder(log)
+    cache.recorder.record_put('many', 1, dep.Id.many('a', range(70000)), 100)
+    cache.put('too-long', 1, dep.Tag('x' * 70000), expires=100)
+    assert cache.get('too-long') == 1
+    cache.recorder.close()
+    assert [(r.op, len(r.dependencies)) for r in read_log(log)] == [(OP_PUT, 70000), (OP_GET, 0)]  # the failed put() is dropped
+
+
+def test_range_scopes(redis: FakeRedis):
+    """ Test Scopes with Range() and In() conditions """
+    from datetime import date, timedelta
+
+    cache = MatroskaCache(backend=RedisBackend(redis, prefix='cache'))
+    article_scopes = dep.Scopes('article', production_mode=False, buckets={
+        'price': dep.NumericBuckets(100),
+        'created': dep.DateBuckets(timedelta(days=7)),
+    })
+
+    @article_scopes.describes('status', 'price')
+    def article_status_price(article: dict):
+        return {'status': article['status'], 'price': article['price']}
+
+    @article_scopes.describes('created')
+    def article_created(article: dict):
+        return {'created': article['created']}
+
+    # Ranges expand into buckets; IN lists into values
+    deps = article_scopes.condition(status=dep.In('draft', 'published'), price=dep.Range(150, 320))
+    assert sorted(d.key() for d in deps) == [
+        'condition:article:&price=#1&status=draft&',
+        'condition:article:&price=#1&status=published&',
+        'condition:article:&price=#2&status=draft&',
+        'condition:article:&price=#2&status=published&',
+        'condition:article:&price=#3&status=draft&',
+        'condition:article:&price=#3&status=published&',
+        'condition:article::InvalidateAll',
+        'condition:article::fallback:price&status',
+    ]
+
+    cache.put('cheap', 1, *article_scopes.condition(status='published', price=dep.Range(0, 199)), expires=100)
+    cache.put('expensive', 1, *article_scopes.condition(status=dep.In('published'), price=dep.Range(500, None)), expires=100)
+    cache.put('this-week', 1, *article_scopes.condition(created=dep.Range(date(2020, 1, 1), date(2020, 1, 3))), expires=100)
+
+    # A cheap article: only invalidates the bucket it's in, and the wildcard
+    article = {'status': 'published', 'price': 150, 'created': date(2019, 1, 1)}
+    assert sorted(cache.invalidate(*article_scopes.object_invalidates(article))) == ['cheap', 'expensive']
+    cache.put('cheap', 1, *article_scopes.condition(status='published', price=dep.Range(0, 199)), expires=100)
+
+    # Modified: it leaves the old bucket, enters the new one
+    new = {**article, 'price': 250, 'created': date(2020, 1, 2)}
+    assert sorted(cache.invalidate(*article_scopes.object_invalidates(new, previous=article))) == ['cheap', 'this-week']
+
+    # A range on a field without buckets
+    with pytest.raises(RuntimeError):
+        article_scopes.condition(status=dep.Range('a', 'b'), price=1)
+
+
+def test_scopes_fallback(redis: FakeRedis):
+    """ Test Scopes fallbacks in production mode: per-signature, rate-limited, reported """
+    cache = MatroskaCache(backend=RedisBackend(redis, prefix='cache'))
+    events = []
+    article_scopes = dep.Scopes('article', production_mode=True, on_fallback=events.append, fallback_interval=60)
+
+    @article_scopes.describes('category')
+    def article_category(article: dict):
+        return {'category': article['category']}
+
+    @article_scopes.describes('author')
+    def article_author(article: dict):
+        return {'author': article['author']}
+
+    def put_all():
+        cache.put('by-category', 1, *article_scopes.condition(category='python'), expires=100)
+        cache.put('by-author', 1, *article_scopes.condition(author='kolypto'), expires=100)
+        cache.put('undeclared', 1, *article_scopes.condition(tag='python'), expires=100)
+
+    put_all()
+    assert [(e.signature, e.reason) for e in events] == [(('tag',), 'undeclared-signature')]
+
+    # A working save: only invalidates the undeclared one
+    assert cache.invalidate(*article_scopes.object_invalidates({'category': 'rust', 'author': 'someone'})) == ['undeclared']
+
+    # A broken extractor: only invalidates its own signature
+    put_all()
+    events.clear()
+    assert sorted(cache.invalidate(*article_scopes.object_invalidates({'category': 'rust'}))) == ['by-author', 'undeclared']
+    assert [(e.signature, e.reason, e.suppressed) for e in events] == [(('author',), 'extractor-error', False)]
+    assert isinstance(events[0].error, KeyError)
+
+    # Rate-limited: reported, but not invalidated again
+    put_all()
+    events.clear()
+    assert cache.invalidate(*article_scopes.object_invalidates({'category': 'rust'})) == ['undeclared']
+    assert [(e.signature, e.suppressed) for e in events] == [(('author',), True)]
+
+
+def test_tenants(redis: FakeRedis):
+    """ Test for_tenant(): namespaces, byte accounting, LRU eviction """
+    cache = MatroskaCache(backend=RedisBackend(redis, prefix='cache'))
+    acme = cache.for_tenant('acme', quota_bytes=4000)
+    other = cache.for_tenant('other')
+
+    # Namespaces
+    acme.put('list', 'acme', dep.Id('article', 1), expires=100)
+    other.put('list', 'other', dep.Id('article', 1), expires=100)
+    assert acme.get('list') == 'acme' and other.get('list') == 'other'
+    assert acme.invalidate(dep.Id('article', 1)) == ['list']
+    assert other.get('list') == 'other'
+    assert acme.backend.usage() == {'used': 0, 'quota': 4000, 'entries': 0}
+
+    # Accounting
+    acme.put('a', 'x' * 100, dep.Id('article', 1), dep.Tag('t'), expires=100)
+    used = acme.backend.usage()['used']
+    assert used > 100
+    acme.put('a', 'x' * 200, dep.Id('article', 1), dep.Tag('t'), expires=100)  # overwrite
+    assert acme.backend.usage()['used'] == used + 100
+    acme.delete('a')
+    assert acme.backend.usage() == {'used': 0, 'quota': 4000, 'entries': 0}
+
+    # Eviction: least recently used first, with their rdep members
+    for i in range(5):
+        acme.put(f'big-{i}', 'x' * 300, dep.Id('article', i), dep.Tag('big'), expires=100)
+    acme.backend._touched.clear()
+    acme.get('big-0')  # recently used
+    for i in range(5, 8):
+        acme.put(f'big-{i}', 'x' * 300, dep.Id('article', i), dep.Tag('big'), expires=100)
+
+    usage = acme.backend.usage()
+    assert usage['used'] <= 4000 * 0.9
+    assert acme.has('big-0') and acme.has('big-7')
+    assert not acme.has('big-1')
+    assert 'cache::tenant:acme::data::big-1' not in redis.smembers('cache::tenant:acme::rdep::tag:big')
+    assert not redis.exists('cache::tenant:acme::fdep::big-1')
+    assert usage['used'] == acme.backend.recount()
+
+    # Other tenants are not affected
+    assert other.get('list') == 'other'
+
+    # Expired entries: their accounting is reconciled
+    expiring = cache.for_tenant('expiring')
+    for i in range(50):
+        expiring.put(f'e-{i}', 'x' * 100, dep.Id('article', i), expires=100)
+        redis.pexpire(f'cache::tenant:expiring::data::e-{i}', 1)
+    expiring.put('alive', 'x' * 100, expires=100)
+    time.sleep(0.01)
+    entries = expiring.backend.usage()['entries']  # put() may have reconciled some already
+    assert expiring.backend.reconcile() == entries - 1
+    assert expiring.backend.usage() == {'used': expiring.backend.recount(), 'quota': None, 'entries': 1}
+
+    # ... and eviction forgets expired entries before it evicts live ones
+    expiring = cache.for_tenant('expiring', quota_bytes=4000)
+    for i in range(10):
+        expiring.put(f'e-{i}', 'x' * 300, expires=100)
+        redis.pexpire(f'cache::tenant:expiring::data::e-{i}', 1)
+    time.sleep(0.01)
+    expiring.put('big', 'x' * 300, expires=100)
+    assert expiring.has('alive') and expiring.has('big')
+    assert expiring.backend.stats['evictions'] == 0
+    expiring.backend.reconcile()
+    assert expiring.backend.usage()['entries'] == 2
+
+    # Eviction that makes no progress stops: it's tried again on the next put()
+    stalled = cache.for_tenant('stalled', quota_bytes=1000)
+    with mock.patch.object(stalled.backend, '_remove', return_value=0) as remove:
+        for i in range(10):
+            stalled.put(f'big-{i}', 'x' * 300, expires=100)
+    assert remove.called and stalled.backend.usage()['used'] > 1000
+    stalled.put('big', 'x' * 300, expires=100)
+    assert stalled.backend.usage()['used'] <= 1000
+
+    # recount() gives up after 10 conflicts, like everything else
+    used = stalled.backend.usage()['used']
+    conflicting = mock.MagicMock(hvals=mock.Mock(return_value=[]), execute=mock.Mock(side_effect=WatchError))
+    conflicting.__enter__.return_value = conflicting
+    with mock.patch.object(redis, 'pipeline', return_value=conflicting):
+        assert stalled.backend.recount() == used  # left as is
+    assert conflicting.execute.call_count == 10
+    assert stalled.backend.stats['watch_giveups'] == 1
+
+    # Per-key state is not shared: the in-process cache must not serve one tenant's data to another
+    from matroska_cache.hotspots import HotspotTracker
+    cache.hotspots = HotspotTracker(hot_threshold=1, local_ttl=60)
+    a, b = cache.for_tenant('a'), cache.for_tenant('b')
+    a.put('dashboard', 'SECRET-A', expires=100)
+    assert a.get('dashboard') == a.get('dashboard') == 'SECRET-A'
+    with pytest.raises(NotInCache):
+        b.get('dashboard')
+    assert b.hotspots is None and b.adaptive_ttl is None and b.recorder is None
+
+
+def test_dependency_keys(redis: FakeRedis):
+    """ Test cached keys, key-based equality, interning, bulk constructors """
+    PrimaryKey = dep.PrimaryKey
+
+    class Article(sa.ext.declarative.declarative_base()):
+        __tablename__ = 'articles'
+        id = sa.Column(sa.Integer, primary_key=True)
+
+    # Compared and hashed by key
+    assert dep.Id('article', 1) == dep.Id('article', '1')
+    assert dep.Id('article', 1) != dep.Tag('article:1')
+    assert len({dep.Id('article', 1), dep.Id('article', 1), dep.Tag('a')}) == 2
+    assert dep.Id('article', 1) != 'id:article:1'
+
+    # Keys are computed once
+    tag = dep.Tag('a')
+    assert tag.cached_key() is tag.cached_key() == 'tag:a'
+    assert tag.prefixed_key('cache::rdep::') is tag.prefixed_key('cache::rdep::') == 'cache::rdep::tag:a'
+    assert tag.prefixed_key('other::') == 'other::tag:a'
+
+    # Modified: the cached keys are dropped
+    tag = dep.Tag('a')
+    tag.prefixed_key('cache::rdep::')
+    tag.name = 'b'
+    assert tag.cached_key() == 'tag:b' and tag.prefixed_key('cache::rdep::') == 'cache::rdep::tag:b'
+    assert tag == dep.Tag('b') and hash(tag) == hash(dep.Tag('b'))
+    ids = dep.Id.many('article', [1])
+    ids[0].id = 2
+    assert ids[0].cached_key() == 'id:article:2'
+
+    # Interned
+    assert dep.Tag.interned('homepage') is dep.Tag.interned('homepage')
+    assert dep.Tag.interned('homepage') == dep.Tag('homepage')
+
+    # Bulk
+    ids = dep.Id.many('article', [1, 2, 3])
+    assert ids == [dep.Id('article', 1), dep.Id('article', 2), dep.Id('article', 3)]
+    assert [d.key() for d in ids] == [d.cached_key() for d in ids]
+    assert PrimaryKey.many(Article, [10]) == [PrimaryKey('Article', 10)]
+    assert PrimaryKey.many(Article, [10])[0].cached_key() == 'pk:Article:10'
+    article = sa_set_committed_state(Article(), id=10)
+    assert PrimaryKey.from_instances([article]) == [PrimaryKey.from_instance(article)] == [PrimaryKey(Article, 10)]
+
+    # Backends work with them
+    cache = MatroskaCache(backend=RedisBackend(redis, prefix='cache'))
+    cache.put('list', 'data', *ids, expires=60)
+    assert cache.invalidate(dep.Id('article', '2')) == ['list']
+
+
+def test_invalidation_stream(redis: FakeRedis):
+    """ Test InvalidationStream and InvalidationConsumer """
+    from redis import ResponseError
+    from matroska_cache.stream import InvalidationStream, InvalidationConsumer
+
+    try:
+        redis.xadd('probe', {'a': 1})
+    except ResponseError:
+        pytest.skip('This Redis does not support streams')
+
+    cache = MatroskaCache(backend=RedisBackend(redis, prefix='local'))
+    cache.stream = InvalidationStream(redis, stream='invalidations', max_delay=10, batch_size=3, origin='local')
+    remote = MatroskaCache(backend=RedisBackend(redis, prefix='remote'))
+    consumer = InvalidationConsumer(redis, remote.backend, stream='invalidations', group='remote', consumer='c1', ignore_origin='remote')
+    consumer.create_group()
+
+    remote.put('article-1', '...', dep.Id('article', 1), expires=60)
+    remote.put('article-2', '...', dep.Id('article', 2), expires=60)
+    remote.put('homepage', '...', dep.Tag('homepage'), expires=60)
+
+    # Batched: nothing is appended until the batch is full, or flushed
+    cache.invalidate(dep.Id('article', 1))
+    assert redis.xlen('invalidations') == 0
+    cache.invalidate(dep.Id('article', 2), dep.Tag('homepage'))
+    assert redis.xlen('invalidations') == 1
+
+    assert consumer.poll(block=0) == 1
+    assert not remote.has('article-1') and not remote.has('article-2') and not remote.has('homepage')
+    assert consumer.stats['keys'] == 3
+
+    # At-least-once: a consumer that crashed before acknowledging gets its entries again
+    remote.put('article-1', '...', dep.Id('article', 1), expires=60)
+    cache.invalidate(dep.Id('article', 1))
+    cache.stream.flush()
+    redis.xreadgroup('remote', 'c2', {'invalidations': '>'})  # c2 reads, and crashes
+    assert consumer.poll(block=0) == 0
+    assert remote.has('article-1')
+
+    restarted = InvalidationConsumer(redis, remote.backend, stream='invalidations', group='remote', consumer='c2')
+    assert restarted.poll(block=0) == 1
+    assert not remote.has('article-1')
+
+    # Own invalidations are ignored
+    echo = InvalidationStream(redis, stream='invalidations', max_delay=0, origin='remote')
+    echo.publish([dep.Id('article', 1)])
+    assert consumer.poll(block=0) == 1
+    assert consumer.stats['ignored'] == 1
+
+    # close() appends what's collected, and stops batching
+    length = redis.xlen('invalidations')
+    cache.invalidate(dep.Id('article', 3))
+    assert redis.xlen('invalidations') == length
+    cache.stream.close()
+    assert redis.xlen('invalidations') == length + 1
+    assert cache.stream._timer is None
+    cache.invalidate(dep.Id('article', 4))
+    assert redis.xlen('invalidations') == length + 2
+
+
+def test_invalidation_consumer_retries():
+    """ Test InvalidationConsumer: entries that failed to apply are retried. Stream commands are mocked: fakeredis 1.x has no streams """
+    from matroska_cache.stream import InvalidationConsumer
+
+    new = [('1-0', {'keys': '["id:article:1"]'})]
+    pending = []  # delivered to our consumer, not acknowledged
+
+    def xreadgroup(group, consumer, streams, count=None, block=None):
+        id, = streams.values()
+        if id == '>':
+            pending.extend(new)
+            entries = new[:]
+            new.clear()
+        else:
+            entries = pending[:]
+        return [('invalidations', entries)] if entries else []
+
+    def xack(stream, group, *ids):
+        pending[:] = [entry for entry in pending if entry[0] not in ids]
+
+    redis = mock.Mock(xreadgroup=xreadgroup, xack=xack)
+    redis.xpending_range.side_effect = lambda *args: [
+        {'message_id': id, 'consumer': 'c1', 'time_since_delivered': 0, 'times_delivered': 1} for id, _ in pending
+    ]
+    backend = mock.Mock()
+    backend.invalidate.side_effect = [ConnectionError('backend is down'), ['article-1']]
+    consumer = InvalidationConsumer(redis, backend, stream='invalidations', group='remote', consumer='c1')
+
+    # Failed: not acknowledged
+    with pytest.raises(ConnectionError):
+        consumer.poll(block=0)
+    assert pending
+
+    # Retried on the next poll, without a restart
+    assert consumer.poll(block=0) == 1
+    assert backend.invalidate.call_count == 2
+    assert not pending
+    assert consumer.stats['entries'] == 1
+
+
+def test_sa_bulk_dependencies():
+    """ Test sa_bulk_dependencies(): bulk UPDATE/DELETE """
+    from matroska_cache import sa_bulk_dependencies
+
+    Base = sa.ext.declarative.declarative_base()
+
+    class Article(Base):
+        __tablename__ = 'articles'
+        id = sa.Column(sa.Integer, primary_key=True)
+        category = sa.Column('category_name', sa.String)
+        title = sa.Column(sa.String)
+
+    article_scopes = dep.Scopes('article', production_mode=False)
+
+    @article_scopes.describes('category')
+    def article_category(article: Article):
+        return {'category': article.category}
+
+    engine = sa.create_engine('sqlite://')
+    Base.metadata.create_all(engine)
+    connection = engine.connect()
+    connection.execute(Article.__table__.insert(), [
+        {'id': 1, 'category_name': 'python', 'title': 'a'},
+        {'id': 2, 'category_name': 'python', 'title': 'b'},
+        {'id': 3, 'category_name': 'go', 'title': 'c'},
+    ])
+
+    def keys(dependencies):
+        return sorted(dependency.key() for dependency in dependencies)
+
+    # UPDATE of a watched column: rows leave one scope and enter another
+    statement = sa.update(Article.__table__).where(Article.id <= 2).values({Article.category: 'rust'})
+    result, dependencies = sa_bulk_dependencies(connection, Article, statement, article_scopes)
+    assert result.rowcount == 2
+    assert keys(dependencies) == [
+        'condition:article:&category=python&',
+        'condition:article:&category=rust&',
+        'pk:Article:1',
+        'pk:Article:2',
+    ]
+    assert connection.execute(sa.select([Article.category]).where(Article.id == 1)).scalar() == 'rust'
+
+    # UPDATE of an unwatched column: no scopes to invalidate
+    statement = sa.update(Article.__table__).where(Article.category == 'go').values(title='x')
+    result, dependencies = sa_bulk_dependencies(connection, Article, statement, article_scopes)
+    assert keys(dependencies) == ['pk:Article:3']
+
+    # DELETE
+    statement = sa.delete(Article.__table__).where(Article.id >= 2)
+    result, dependencies = sa_bulk_dependencies(connection, Article, statement, article_scopes)
+    assert keys(dependencies) == [
+        'condition:article:&category=go&',
+        'condition:article:&category=rust&',
+        'pk:Article:2',
+        'pk:Article:3',
+    ]
+
+    # Primary keys can't be updated
+    with pytest.raises(ValueError):
+        sa_bulk_dependencies(connection, Article, sa.update(Article.__table__).values(id=10), article_scopes)
+
+    # Can't tell what's modified: values at execution time, or many sets of them
+    from matroska_cache.sa_tools import SA_VERSION
+    with pytest.raises(ValueError):
+        sa_bulk_dependencies(connection, Article, sa.update(Article.__table__).where(Article.id == 1), article_scopes)
+    if SA_VERSION >= (1, 4):
+        with pytest.raises(ValueError):
+            statement = sa.update(Article.__table__).values([{'title': 'x'}, {'title': 'y'}])
+            sa_bulk_dependencies(connection, Article, statement, article_scopes)
+
+    # Ordered values
+    if SA_VERSION >= (1, 4):
+        statement = sa.update(Article.__table__).ordered_values((Article.category, 'go'), (Article.title, 'y'))
+    else:
+        statement = sa.update(Article.__table__, preserve_parameter_order=True).values([(Article.category, 'go'), (Article.title, 'y')])
+    result, dependencies = sa_bulk_dependencies(connection, Article, statement.where(Article.id == 1), article_scopes)
+    assert keys(dependencies) == [
+        'condition:article:&category=go&',
+        'condition:article:&category=rust&',
+        'pk:Article:1',
+    ]
+
+    # Rows are selected FOR UPDATE, in the same transaction as the statement
+    from sqlalchemy.dialects import postgresql
+    executed = []
+
+    @sa.event.listens_for(connection, 'before_execute')
+    def before_execute(connection, clauseelement, multiparams, params):
+        executed.append((str(clauseelement.compile(dialect=postgresql.dialect())), connection.in_transaction()))
+
+    connection.execute(Article.__table__.insert(), [{'id': 4, 'category_name': 'go', 'title': 'd'}])
+    executed.clear()
+    statement = sa.update(Article.__table__).where(Article.id == 4).values({Article.category: 'rust'})
+    sa_bulk_dependencies(connection, Article, statement, article_scopes)
+    assert len(executed) == 3  # select, update, select again
+    assert executed[0][0].endswith('FOR UPDATE')
+    assert all(in_transaction for _, in_transaction in executed)
+    assert not connection.in_transaction()  # committed
+    assert connection.execute(sa.select([Article.category]).where(Article.id == 4)).scalar() == 'rust'
+
+
+def test_small_values(redis: FakeRedis):
+    """ Test RedisBackend(small_values=): small values packed into hashes """
+    backend = RedisBackend(redis, prefix='cache', small_values=20, small_buckets=2, small_sweep_every=3, sliding_expiration=True)
+    cache = MatroskaCache(backend=backend)
+
+    # Small values go into buckets; large ones get keys of their own
+    cache.put('small', 'x', dep.Id('article', 1), expires=100)
+    cache.put('large', 'x' * 100, dep.Id('article', 1), expires=100)
+    cache.put('sliding', 'x', dep.Id('article', 1), expires=100, max_lifetime=1000)
+    assert not redis.exists('cache::data::small')
+    assert redis.exists('cache::data::large') and redis.exists('cache::data::sliding')
+    assert sum(redis.hlen(f'cache::small::{n}') for n in range(2)) == 1
+
+    # Reads
+    assert cache.get('small') == 'x' and cache.has('small')
+    assert cache.get_many(['small', 'large', 'sliding', 'missing']) == {'small': 'x', 'large': 'x' * 100, 'sliding': 'x'}
+
+    # A value lives in one place
+    cache.put('small', 'x' * 100, expires=100)
+    assert redis.exists('cache::data::small')
+    assert sum(redis.hlen(f'cache::small::{n}') for n in range(2)) == 0
+    cache.put('small', 'y', dep.Id('article', 1), expires=100)
+    assert not redis.exists('cache::data::small')
+    assert cache.get('small') == 'y'
+
+    # Invalidation
+    assert sorted(cache.invalidate(dep.Id('article', 1))) == ['large', 'sliding', 'small']
+    assert not cache.has('small') and cache.get_many(['small', 'large']) == {}
+
+    # Delete; race-safe put
+    cache.put('small', 'x', expires=100)
+    cache.delete('small')
+    assert not cache.has('small')
+    backend.race_protection = True
+    token = cache.begin(dep.Id('article', 1))
+    assert cache.put('small', 'z', dep.Id('article', 1), expires=100, token=token)
+    assert cache.get('small') == 'z'
+
+    # Expiration: expired values are not returned, and are swept
+    cache.put('expired', 'x', expires=-1)
+    assert not cache.has('expired')
+    with pytest.raises(NotInCache):
+        cache.get('expired')
+    assert backend.sweep_small_values() == 1
+    assert backend.stats['small_swept'] == 1
+    assert cache.get('small') == 'z'
+
+    # Tenants store small values too: eviction and reconciliation remove their fields
+    tenant = MatroskaCache(backend=RedisBackend(redis, prefix='t', small_values=20, small_buckets=2)).for_tenant('acme', quota_bytes=1000)
+    for i in range(20):
+        tenant.put(f'v-{i}', 'x', dep.Id('article', i), expires=100)
+    assert not redis.exists('t::tenant:acme::data::v-19') and tenant.get('v-19') == 'x'
+    assert tenant.backend.stats['evictions'] > 0 and not tenant.has('v-0')
+    assert sum(redis.hlen(f't::tenant:acme::small::{n}') for n in range(2)) == tenant.backend.usage()['entries']
+
+    assert tenant.backend.reconcile() == 0  # live small values are not taken for expired ones
+    tenant.put('expired', 'x', expires=-1)
+    entries = tenant.backend.usage()['entries']
+    assert tenant.backend.reconcile() == 1
+    assert sum(redis.hlen(f't::tenant:acme::small::{n}') for n in range(2)) == tenant.backend.usage()['entries'] == entries - 1
+
+
+def test_small_values_memory():
+    """ Small values take less memory: on a real Redis """
+    from redis import Redis
+    from . import benchmark, stress
+
+    if not shutil.which('redis-server'):
+        pytest.skip('redis-server is not installed')
+
+    with stress.spawn_redis_server() as url:
+        results = benchmark.compare(Redis.from_url(url, decode_responses=True), entries=2000, value_size=100, dependencies=0)
+
+    assert results['small']['used_memory'] < results['plain']['used_memory'] * 0.8, benchmark.format_report(results)